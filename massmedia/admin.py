@@ -1,19 +1,29 @@
+import hashlib
+import json
+
 import django
+from django.conf.urls import patterns, url
 from django.contrib import admin
 from django.contrib.admin.widgets import AdminFileWidget, AdminURLFieldWidget
 from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.core.urlresolvers import reverse
+from django.db.models.signals import post_delete, post_save
 from django.http import HttpResponse
 from django import template
 from django.shortcuts import render_to_response
+from django.utils.cache import patch_cache_control
 from django.utils.safestring import mark_safe
 from django.utils.translation import ugettext as _
 from django.utils.html import escape
 
 from django.contrib.admin.options import IS_POPUP_VAR
+from django.contrib.admin.views.main import ChangeList
 
 from models import (Image, Video, Audio, Flash, Collection, Embed, Document,
-    CollectionRelation, MediaTemplate)
+    CollectionRelation, MediaTemplate, COLLECTION_LIMITS)
 import settings
+from massmedia import search
 from forms import (ImageCreationForm, VideoCreationForm, AudioCreationForm,
     FlashCreationForm, DocumentCreationForm, EmbedCreationForm)
 
@@ -44,21 +54,53 @@ class AdminExternalURLWidget(AdminURLFieldWidget):
         return mark_safe(u''.join(output))
 
 
+CONTENT_TYPES_CACHE_KEY = 'massmedia.collection_content_types'
+CONTENT_TYPES_MAX_AGE = 365 * 24 * 3600
+
+
+def collection_content_types():
+    """
+    Return a ``(version, map)`` tuple for the content types that can be added
+    to a collection. The map goes from content type id to the
+    ``app_label/model`` part of its admin URL; the version changes whenever
+    the map does.
+    """
+    cached = cache.get(CONTENT_TYPES_CACHE_KEY)
+    if cached is None:
+        ctypes = ContentType.objects.filter(**COLLECTION_LIMITS).order_by('id')
+        ct_map = dict((str(pk), '%s/%s' % (app_label, model))
+                      for pk, app_label, model in ctypes.values_list('id', 'app_label', 'model'))
+        version = hashlib.md5(json.dumps(ct_map, sort_keys=True)).hexdigest()[:12]
+        cached = (version, ct_map)
+        cache.set(CONTENT_TYPES_CACHE_KEY, cached)
+    return cached
+
+
+def clear_collection_content_types(sender, **kwargs):
+    cache.delete(CONTENT_TYPES_CACHE_KEY)
+post_save.connect(clear_collection_content_types, sender=ContentType)
+post_delete.connect(clear_collection_content_types, sender=ContentType)
+
+
 class GenericCollectionInlineModelAdmin(admin.options.InlineModelAdmin):
     ct_field = 'content_type'
     ct_fk_field = 'object_id'
     fields = ('content_type', 'object_id', 'position')
     extra = 3
 
-    def __init__(self, parent_model, admin_site):
-        super(GenericCollectionInlineModelAdmin, self).__init__(parent_model, admin_site)
-        ctypes = ContentType.objects.all().order_by('id').values_list('id', 'app_label', 'model')
-        elements = ["%s: '%s/%s'" % (x, y, z) for x, y, z in ctypes]
-        self.content_types = "{%s}" % ",".join(elements)
+    def content_types_url(self):
+        """
+        The versioned URL of the content type map, so browsers can cache it
+        until it changes
+        """
+        version, ct_map = collection_content_types()
+        return '%s?v=%s' % (
+            reverse('admin:massmedia_collection_content_types', current_app=self.admin_site.name),
+            version)
 
     def get_formset(self, request, obj=None):
         result = super(GenericCollectionInlineModelAdmin, self).get_formset(request, obj)
-        result.content_types = self.content_types
+        result.content_types_url = self.content_types_url()
         result.ct_fk_field = self.ct_fk_field
         return result
 
@@ -67,6 +109,22 @@ class GenericCollectionTabularInline(GenericCollectionInlineModelAdmin):
     template = 'admin/edit_inlines/gen_coll_tabular.html'
 
 
+class MediaChangeList(ChangeList):
+    """
+    Leaves the model admin's ``list_defer`` fields out of the changelist query,
+    except when its ``list_editable`` fields are saved
+    """
+    def get_queryset(self, request):
+        qs = super(MediaChangeList, self).get_queryset(request)
+        list_defer = getattr(self.model_admin, 'list_defer', ())
+        # The list_editable formset saves the objects it is posted. A deferred
+        # object's signals are sent by a proxy class, so receivers registered
+        # elsewhere with sender=<model> wouldn't hear those saves.
+        if list_defer and not (self.list_editable and request.method == 'POST'):
+            qs = qs.defer(*list_defer)
+        return qs
+
+
 class MediaAdmin(admin.ModelAdmin):
     fieldsets = (
         (None, {'fields': ('title', 'caption')}),
@@ -94,11 +152,28 @@ class MediaAdmin(admin.ModelAdmin):
     list_display = ('title', 'author_name', 'mime_type', 'public', 'creation_date')
     list_filter = ('site', 'creation_date', 'public')
     list_editable = ('public',)
+    list_select_related = ('author', 'site')
+    # Fields the changelist doesn't show, so they aren't loaded and decoded
+    list_defer = ('metadata', 'caption')
     prepopulated_fields = {'slug': ('title',)}
     date_hierarchy = 'creation_date'
     search_fields = ('caption', 'file')
     add_form_template = 'admin/massmedia/content_add_form.html'
 
+    def get_changelist(self, request, **kwargs):
+        return MediaChangeList
+
+    def get_search_results(self, request, queryset, search_term):
+        """
+        Find the objects matching the terms in the full-text index, as well
+        as those the ``search_fields`` lookup finds, such as by file name
+        """
+        found, use_distinct = super(MediaAdmin, self).get_search_results(
+            request, queryset, search_term)
+        if not settings.SEARCH_INDEX or not search.terms(search_term):
+            return found, use_distinct
+        return found | search.filter_matching(queryset, search_term), use_distinct
+
     def get_fieldsets(self, request, obj=None):
         """
         Return add_fieldsets if it is a new object and the form has specified
@@ -164,6 +239,9 @@ class ImageAdmin(MediaAdmin):
     list_display = ('render_thumb', 'title', 'creation_date')
     list_display_links = ('render_thumb', 'title', )
     list_editable = tuple()
+    list_select_related = ()
+    # The thumbnails and the popup's insert links show the caption
+    list_defer = ('metadata', )
     add_fieldsets = (
         (_("Content"), {'fields': ('external_url', 'file', 'caption')}),
         (_("Rights"), {'fields': ('public', 'reproduction_allowed')}),
@@ -203,6 +281,8 @@ class ImageAdmin(MediaAdmin):
 class VideoAdmin(MediaAdmin):
     list_display = ('title', 'thumb', 'author_name', 'mime_type',
                     'public', 'creation_date')
+    list_select_related = ('author', 'site', 'thumbnail')
+    list_defer = ('metadata', 'caption', 'thumbnail__metadata', 'thumbnail__caption')
     fieldsets = (
         (None, {'fields': ('title', 'caption')}),
         (_("Content"), {'fields': (('file', 'external_url'), 'thumbnail')}),
@@ -253,6 +333,27 @@ class CollectionAdmin(admin.ModelAdmin):
     search_fields = ('caption',)
     inlines = (CollectionInline,)
 
+    def get_urls(self):
+        urls = patterns('',
+            url(r'^content_types/$',
+                self.admin_site.admin_view(self.content_types_view, cacheable=True),
+                name='massmedia_collection_content_types'),
+        )
+        return urls + super(CollectionAdmin, self).get_urls()
+
+    def content_types_view(self, request):
+        """
+        The content type map used by the collection inline's lookup links,
+        as JSON. Requests for the current version may be cached for good.
+        """
+        version, ct_map = collection_content_types()
+        response = HttpResponse(json.dumps(ct_map), content_type='application/json')
+        if request.GET.get('v') == version:
+            patch_cache_control(response, private=True, max_age=CONTENT_TYPES_MAX_AGE)
+        else:
+            patch_cache_control(response, private=True, no_cache=True)
+        return response
+
     class Media:
         js = (
             'http://code.jquery.com/jquery-1.4.2.min.js',
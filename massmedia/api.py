@@ -0,0 +1,226 @@
+"""
+A read-only JSON API for the public media.
+
+``/api/<mediatype>/`` lists the newest objects of one type, or the ones
+named in ``ids=1,2,3``. ``/api/`` takes one such list of ids per media type
+(``?image=1,2&video=3``) so a page can fetch all of its media in a single
+request. ``fields=title,thumbnail`` limits the fields returned, and only
+the columns they need are loaded. Thumbnail and rendition URLs are read
+with one extra query per media type, not one per object.
+"""
+import json
+
+from django.http import Http404, HttpResponse, HttpResponseBadRequest
+
+from massmedia import models
+from massmedia.conditional import (add_cache_headers, etag_for, list_validators,
+    not_modified)
+from massmedia.settings import API_LIMIT
+
+MEDIA_TYPES = dict((m._meta.object_name.lower(), m) for m in models.SEARCH_MODELS)
+
+# The columns each field is built from
+FIELDS = {
+    'id': (),
+    'type': (),
+    'title': ('title', ),
+    'slug': ('slug', ),
+    'url': ('slug', ),
+    'caption': ('caption', ),
+    'author': ('author', 'one_off_author'),
+    'creation_date': ('creation_date', ),
+    'modified': ('modified', ),
+    'mime_type': ('mime_type', ),
+    'width': ('width', ),
+    'height': ('height', ),
+    'media_url': ('external_url', 'file'),
+    'thumbnail': ('thumbnail', 'thumb_width', 'thumb_height'),
+    'renditions': (),
+}
+DEFAULT_FIELDS = ('id', 'type', 'title', 'slug', 'url', 'caption', 'author',
+                  'creation_date', 'modified', 'mime_type', 'width', 'height',
+                  'media_url', 'thumbnail', 'renditions')
+
+
+class APIError(Exception):
+    pass
+
+
+def parse_ids(value):
+    try:
+        return [int(i) for i in value.split(',') if i.strip()]
+    except ValueError:
+        raise APIError('ids must be a comma separated list of numbers')
+
+
+def parse_limit(value):
+    """
+    The number of objects asked for, at most ``API_LIMIT``
+    """
+    try:
+        limit = int(value)
+    except ValueError:
+        raise APIError('limit must be a number')
+    if limit < 1:
+        raise APIError('limit must be at least 1')
+    return min(limit, API_LIMIT)
+
+
+def parse_fields(value):
+    if not value:
+        return DEFAULT_FIELDS
+    fields = [f for f in value.split(',') if f]
+    unknown = [f for f in fields if f not in FIELDS]
+    if unknown:
+        raise APIError('Unknown fields: %s' % ', '.join(unknown))
+    return fields
+
+
+def file_url(model, field_name, name):
+    if not name:
+        return None
+    return model._meta.get_field(field_name).storage.url(name)
+
+
+class MediaQuery(object):
+    """
+    The requested fields of some objects of one media type
+    """
+    def __init__(self, mediatype, fields, ids=None, limit=API_LIMIT):
+        self.mediatype = mediatype
+        self.model = MEDIA_TYPES[mediatype]
+        self.fields = fields
+        self.ids = ids
+        self.limit = limit
+
+    @property
+    def queryset(self):
+        model_fields = set(f.name for f in self.model._meta.fields)
+        columns = set(c for f in self.fields for c in FIELDS[f] if c in model_fields)
+        if 'renditions' in self.fields and self.model is models.Image:
+            columns.update(['external_url', 'file'])
+        queryset = self.model.objects.public().only('modified', *columns)
+        if 'author' in columns:
+            queryset = queryset.select_related('author')
+        if self.ids is not None:
+            return queryset.filter(pk__in=self.ids)
+        return queryset
+
+    def validators(self):
+        return list_validators(self.queryset)
+
+    def fetch(self):
+        if self.ids is None:
+            objects = list(self.queryset[:self.limit])
+        else:
+            by_pk = self.queryset.in_bulk(self.ids[:self.limit])
+            objects = [by_pk[pk] for pk in self.ids[:self.limit] if pk in by_pk]
+        thumbnails = self.thumbnails(objects) if 'thumbnail' in self.fields else {}
+        renditions = self.renditions(objects) if 'renditions' in self.fields else {}
+        return [self.serialize(obj, thumbnails, renditions) for obj in objects]
+
+    def thumbnails(self, objects):
+        """
+        Thumbnail URLs of the images used as video thumbnails, by image id
+        """
+        if self.model is not models.Video:
+            return {}
+        ids = set(obj.thumbnail_id for obj in objects if obj.thumbnail_id)
+        return dict((pk, file_url(models.Image, 'thumbnail', name)) for pk, name in
+                    models.Image.objects.filter(pk__in=ids).values_list('pk', 'thumbnail'))
+
+    def renditions(self, objects):
+        """
+        The public variations of each image, by original id
+        """
+        if self.model is not models.Image:
+            return {}
+        renditions = {}
+        variations = models.Image.objects.public().filter(
+            original__in=[obj.pk for obj in objects]).values_list(
+            'original', 'pk', 'external_url', 'file', 'width', 'height')
+        for original, pk, external_url, name, width, height in variations:
+            renditions.setdefault(original, []).append({
+                'id': pk,
+                'url': external_url or file_url(models.Image, 'file', name),
+                'width': width,
+                'height': height,
+            })
+        return renditions
+
+    def serialize(self, obj, thumbnails, renditions):
+        data = {}
+        for field in self.fields:
+            if field == 'id':
+                value = obj.pk
+            elif field == 'type':
+                value = self.mediatype
+            elif field == 'url':
+                value = obj.get_absolute_url()
+            elif field == 'author':
+                value = obj.author_name
+            elif field in ('creation_date', 'modified'):
+                value = getattr(obj, field).isoformat()
+            elif field == 'media_url':
+                try:
+                    value = obj.media_url
+                except ValueError:  # No file
+                    value = None
+            elif field == 'thumbnail':
+                if self.model is models.Image:
+                    value = obj.thumbnail.url if obj.thumbnail else None
+                elif self.model is models.Video:
+                    value = thumbnails.get(obj.thumbnail_id)
+                else:
+                    value = None
+            elif field == 'renditions':
+                value = renditions.get(obj.pk, [])
+            else:
+                value = getattr(obj, field)
+            data[field] = value
+        return data
+
+
+def respond(request, queries, build):
+    """
+    Answer with ``build()`` as JSON, or ``304 Not Modified`` when none of the
+    objects of ``queries`` have changed
+    """
+    validators = [q.validators() for q in queries]
+    last_modified = max([lm for lm, etag in validators if lm] or [None])
+    etag = etag_for(*([etag for lm, etag in validators] + [q.fields for q in queries]))
+    response = not_modified(request, last_modified, etag)
+    if response is None:
+        response = HttpResponse(json.dumps(build()), content_type='application/json')
+        add_cache_headers(response, last_modified, etag)
+    return response
+
+
+def media_list(request, mediatype):
+    """
+    Objects of one media type: the newest, or those named in ``ids``
+    """
+    if mediatype not in MEDIA_TYPES:
+        raise Http404
+    try:
+        fields = parse_fields(request.GET.get('fields'))
+        ids = parse_ids(request.GET['ids']) if 'ids' in request.GET else None
+        limit = parse_limit(request.GET.get('limit', API_LIMIT))
+    except APIError, e:
+        return HttpResponseBadRequest(unicode(e))
+    query = MediaQuery(mediatype, fields, ids, limit)
+    return respond(request, [query], lambda: {'objects': query.fetch()})
+
+
+def media_batch(request):
+    """
+    Objects of several media types at once, named as ``<mediatype>=<ids>``
+    """
+    try:
+        fields = parse_fields(request.GET.get('fields'))
+        queries = [MediaQuery(mediatype, fields, parse_ids(request.GET[mediatype]))
+                   for mediatype in sorted(MEDIA_TYPES) if mediatype in request.GET]
+    except APIError, e:
+        return HttpResponseBadRequest(unicode(e))
+    return respond(request, queries,
+                   lambda: dict((q.mediatype, q.fetch()) for q in queries))
@@ -0,0 +1,217 @@
+"""
+Title autocomplete across all media types.
+
+Each process keeps a ``PrefixIndex`` of media titles in memory: a sorted
+list of the words of every title, searched with ``bisect``. Saving or
+deleting media writes a ``MediaChange``, and the index replays the changes
+made since it last looked, at most every ``AUTOCOMPLETE_REFRESH`` seconds, so
+edits made by other processes show up without rebuilding it. The log is only
+written when the ``AUTOCOMPLETE`` setting is on, and each process writing it
+prunes the old changes from time to time.
+"""
+import re
+import threading
+import time
+from bisect import bisect_left, insort
+from datetime import timedelta
+
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import Q
+from django.utils import timezone
+
+from massmedia.settings import (AUTOCOMPLETE_LIMIT, AUTOCOMPLETE_LOG_AGE,
+    AUTOCOMPLETE_REFRESH)
+from massmedia.utils import connect_media_signals
+
+# Changes are replayed again for this many seconds after they were made, to
+# pick up those whose transaction committed after a later change's
+REPLAY_OVERLAP = 60
+
+
+def words(text):
+    return re.findall(r'\w+', (text or u'').lower(), re.UNICODE)
+
+
+class PrefixIndex(object):
+    """
+    Titles indexed by the prefixes of their words.
+
+    ``entries`` is a sorted list of ``(word, content type id, object id)``
+    tuples, one for each distinct word of each title.
+    """
+    def __init__(self):
+        self.entries = []
+        self.titles = {}
+
+    def __len__(self):
+        return len(self.titles)
+
+    def load(self, items):
+        """
+        Add many ``(content type id, object id, title)`` items, sorting once
+        """
+        for ct_id, pk, title in items:
+            self.titles[(ct_id, pk)] = title
+            self.entries.extend((word, ct_id, pk) for word in set(words(title)))
+        self.entries.sort()
+
+    def add(self, ct_id, pk, title):
+        self.remove(ct_id, pk)
+        self.titles[(ct_id, pk)] = title
+        for word in set(words(title)):
+            insort(self.entries, (word, ct_id, pk))
+
+    def remove(self, ct_id, pk):
+        title = self.titles.pop((ct_id, pk), None)
+        if title is None:
+            return
+        for word in set(words(title)):
+            entry = (word, ct_id, pk)
+            i = bisect_left(self.entries, entry)
+            if i < len(self.entries) and self.entries[i] == entry:
+                del self.entries[i]
+
+    def lookup(self, query, content_type_ids=None, limit=AUTOCOMPLETE_LIMIT):
+        """
+        Return up to ``limit`` ``(content type id, object id, title)`` items
+        whose titles have a word starting with each word of ``query``
+        """
+        query_words = words(query)
+        if not query_words:
+            return []
+        # Walk the entries of the longest word, the most selective, and
+        # check the rest against the titles found
+        prefix = max(query_words, key=len)
+        others = list(query_words)
+        others.remove(prefix)
+
+        entries = self.entries
+        results = []
+        seen = set()
+        i = bisect_left(entries, (prefix, ))
+        while i < len(entries) and len(results) < limit:
+            word, ct_id, pk = entries[i]
+            if not word.startswith(prefix):
+                break
+            i += 1
+            if (ct_id, pk) in seen or (content_type_ids and ct_id not in content_type_ids):
+                continue
+            seen.add((ct_id, pk))
+            title = self.titles[(ct_id, pk)]
+            if others:
+                title_words = words(title)
+                if not all(any(w.startswith(o) for w in title_words) for o in others):
+                    continue
+            results.append((ct_id, pk, title))
+        return results
+
+
+class AutocompleteIndex(object):
+    """
+    The process's ``PrefixIndex``, built on first use and kept up to date
+    from the ``MediaChange`` log
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.index = None
+        self.last_change_id = 0
+        self.checked = 0
+        self.pruned = 0
+
+    def prune(self):
+        """
+        Delete the changes old enough to have been replayed by any process
+        still running
+        """
+        from massmedia.models import MediaChange
+        MediaChange.objects.filter(
+            created__lt=timezone.now() - timedelta(seconds=AUTOCOMPLETE_LOG_AGE)).delete()
+        self.pruned = time.time()
+
+    def build(self):
+        from massmedia.models import MediaChange, SEARCH_MODELS
+        last_change = list(MediaChange.objects.order_by('-id').values_list('id', flat=True)[:1])
+        index = PrefixIndex()
+        for model in SEARCH_MODELS:
+            ct_id = ContentType.objects.get_for_model(model).pk
+            index.load((ct_id, pk, title) for pk, title in
+                       model._base_manager.values_list('pk', 'title').iterator())
+        self.index = index
+        self.last_change_id = last_change[0] if last_change else 0
+        self.checked = time.time()
+
+    def refresh(self):
+        """
+        Replay the changes logged since the last check. An index left idle
+        for half the log's lifetime may have missed pruned changes, so it is
+        built again.
+        """
+        from massmedia.models import MediaChange
+        now = time.time()
+        if self.index is None or now - self.checked > AUTOCOMPLETE_LOG_AGE / 2:
+            self.build()
+            return
+        if now - self.checked < AUTOCOMPLETE_REFRESH:
+            return
+        # Ids are handed out before commit, so a change can show up after
+        # one with a higher id; recent ones are replayed in id order again
+        since = timezone.now() - timedelta(seconds=now - self.checked + REPLAY_OVERLAP)
+        changes = MediaChange.objects.filter(
+            Q(id__gt=self.last_change_id) | Q(created__gte=since)).order_by('id').values_list(
+            'id', 'content_type_id', 'object_id', 'title', 'action')
+        for change_id, ct_id, pk, title, action in changes:
+            self.apply(ct_id, pk, title, action)
+            self.last_change_id = max(change_id, self.last_change_id)
+        self.checked = now
+
+    def apply(self, ct_id, pk, title, action):
+        from massmedia.models import MediaChange
+        if action == MediaChange.DELETE:
+            self.index.remove(ct_id, pk)
+        else:
+            self.index.add(ct_id, pk, title)
+
+    def record(self, obj, action):
+        """
+        Log a change to ``obj`` and apply it to this process's index
+        """
+        from massmedia.models import MediaChange
+        if action == MediaChange.SAVE and obj.__dict__.get('_logged_title') == obj.title:
+            return  # Saved again without a new title
+        ct_id = ContentType.objects.get_for_model(obj).pk
+        MediaChange.objects.create(content_type_id=ct_id, object_id=obj.pk,
+                                   title=obj.title, action=action)
+        obj._logged_title = obj.title if action == MediaChange.SAVE else None
+        if time.time() - self.pruned > AUTOCOMPLETE_LOG_AGE / 24:
+            self.prune()
+        with self.lock:
+            if self.index is not None:
+                self.apply(ct_id, obj.pk, obj.title, action)
+
+    def lookup(self, query, models=None, limit=AUTOCOMPLETE_LIMIT):
+        content_type_ids = None
+        if models:
+            content_type_ids = set(ContentType.objects.get_for_model(m).pk for m in models)
+        with self.lock:
+            self.refresh()
+            return self.index.lookup(query, content_type_ids, min(limit, AUTOCOMPLETE_LIMIT))
+
+
+titles = AutocompleteIndex()
+
+
+def record_save(obj):
+    from massmedia.models import MediaChange
+    titles.record(obj, MediaChange.SAVE)
+
+
+def record_delete(obj):
+    from massmedia.models import MediaChange
+    titles.record(obj, MediaChange.DELETE)
+
+
+def connect_signals(*models):
+    """
+    Log the changes to the titles of ``models``
+    """
+    connect_media_signals(models, record_save, record_delete)
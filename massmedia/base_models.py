@@ -56,6 +56,10 @@ class Media(models.Model):
     creation_date = models.DateTimeField(
         _("Creation Date"),
         auto_now_add=True)
+    modified = models.DateTimeField(
+        _("Modified"),
+        auto_now=True,
+        db_index=True)
     author = models.ForeignKey(
         User,
         blank=True, null=True,
@@ -109,6 +113,8 @@ class Media(models.Model):
 
     class Meta:
         ordering = ('-creation_date',)
+        # For the public listings: objects.public() ordered by -creation_date
+        index_together = [('site', 'public', 'creation_date')]
         abstract = True
 
     def __unicode__(self):
@@ -116,15 +122,15 @@ class Media(models.Model):
 
     @property
     def author_name(self):
-        if self.author:
-            return self.author.full_name
+        if self.author_id:
+            return self.author.get_full_name() or self.author.username
         else:
             return self.one_off_author
 
     @models.permalink
     def get_absolute_url(self):
         return ('massmedia_detail', (), {
-            'mediatype': self.__class__.__name__.lower(),
+            'mediatype': self._meta.concrete_model.__name__.lower(),
             'slug': self.slug
         })
 
@@ -135,7 +141,12 @@ class Media(models.Model):
     def save(self, *args, **kwargs):
         if self.site_id is None:
             self.site = Site.objects.get_current()
-        super(Media, self).save(*args, **kwargs)
+        # Indexed by the save below, once the mime type and metadata are set
+        self._incomplete = True
+        try:
+            super(Media, self).save(*args, **kwargs)
+        finally:
+            self._incomplete = False
 
         # That save needs to come before we look at the file otherwise the
         # self.file.path is incorrect.
@@ -147,6 +158,8 @@ class Media(models.Model):
 
         if not self.metadata and hasattr(self, 'file') and self.file and EXTRACT_METADATA:
             self.parse_metadata()
+        # The object exists now, even if it was created
+        kwargs.pop('force_insert', None)
         try:
             super(Media, self).save(*args, **kwargs)
         except Exception, e:
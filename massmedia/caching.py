@@ -0,0 +1,102 @@
+"""
+Stale-while-revalidate caching for values that are slow to fetch, such as
+remote feeds.
+
+Readers always get the last good value, even after it has gone stale. The
+first reader to notice that it is stale takes a lock (see ``locks``) and
+refreshes it in a background thread, so only one process makes the slow
+call. When the fetch fails the old value is kept and the next attempt is
+put off with an exponential backoff.
+"""
+import logging
+import threading
+import time
+
+from django.core.cache import cache
+
+from massmedia.locks import get_lock
+
+CACHE_LENGTH = 3600  # How long a value is fresh
+STALE_LENGTH = 7 * 24 * 3600  # How long a stale value is kept around to serve
+CALL_LENGTH = 10  # How long a refresher holds the lock
+RETRY_MIN = 30  # Backoff after the first failed fetch, doubled for each failure
+RETRY_MAX = CACHE_LENGTH
+
+logger = logging.getLogger(__name__)
+
+
+def lock_key(key):
+    return '%s.lock' % key
+
+
+def acquire_lock(key, timeout=CALL_LENGTH):
+    """
+    Try to become the one process refreshing ``key``, returning the lock to
+    release afterwards, or ``None``
+    """
+    lock = get_lock(lock_key(key), timeout)
+    if lock.acquire():
+        return lock
+    return None
+
+
+def set_value(key, val, timeout=CACHE_LENGTH):
+    """
+    Store a freshly fetched value, good for ``timeout`` seconds
+    """
+    cache.set(key, (val, time.time() + timeout, 0), STALE_LENGTH)
+
+
+def refresh(key, fetch, timeout=CACHE_LENGTH, stale_val=None, failures=0, lock=None):
+    """
+    Call ``fetch`` and store the result. On failure keep ``stale_val`` and
+    back off before the next try. ``lock`` is released either way.
+    """
+    try:
+        val = fetch()
+    except Exception:
+        failures += 1
+        delay = min(RETRY_MIN * 2 ** (failures - 1), RETRY_MAX)
+        logger.exception("Refreshing %s failed %d time(s), retrying in %ds",
+                         key, failures, delay)
+        cache.set(key, (stale_val, time.time() + delay, failures), STALE_LENGTH)
+        return stale_val
+    else:
+        set_value(key, val, timeout)
+        return val
+    finally:
+        if lock is not None:
+            lock.release()
+
+
+def get_or_refresh(key, fetch, timeout=CACHE_LENGTH, background=True):
+    """
+    Return the value cached under ``key``, refreshing it with ``fetch()``
+    when it is stale.
+
+    A stale value is returned straight away while a single refresher updates
+    it, in a thread unless ``background`` is ``False``. When nothing has been
+    cached yet there is nothing to serve, so the caller that gets the lock
+    fetches the value itself and any others get ``None``.
+    """
+    packed_val = cache.get(key)
+    try:
+        val, refresh_time, failures = packed_val
+    except (TypeError, ValueError):
+        lock = acquire_lock(key)
+        if lock is None:
+            return None
+        return refresh(key, fetch, timeout, lock=lock)
+
+    if time.time() < refresh_time:
+        return val
+    lock = acquire_lock(key)
+    if lock is not None:
+        if background:
+            thread = threading.Thread(target=refresh,
+                                      args=(key, fetch, timeout, val, failures, lock))
+            thread.daemon = True
+            thread.start()
+        else:
+            return refresh(key, fetch, timeout, val, failures, lock)
+    return val
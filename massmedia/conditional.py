@@ -0,0 +1,92 @@
+"""
+Conditional GET for the public media views.
+
+The validators come from the ``modified`` timestamps: one object's for a
+detail page, the newest of the queryset's (with its size, so removals show
+up) for a list. They are read with a single small query, so a request whose
+``If-None-Match`` or ``If-Modified-Since`` still matches gets a
+``304 Not Modified`` without loading the objects or rendering a template.
+"""
+import calendar
+import hashlib
+
+from django.db.models import Count, Max
+from django.http import HttpResponseNotModified
+from django.utils import timezone
+from django.utils.cache import patch_cache_control
+from django.utils.http import http_date, parse_etags, parse_http_date_safe, quote_etag
+
+from massmedia.settings import CACHE_CONTROL
+
+
+def etag_for(*parts):
+    return hashlib.md5('|'.join(unicode(p) for p in parts).encode('utf-8')).hexdigest()
+
+
+def timestamp(dt):
+    if timezone.is_naive(dt):
+        # Without USE_TZ the database gives local times
+        dt = timezone.make_aware(dt, timezone.get_default_timezone())
+    return calendar.timegm(dt.utctimetuple())
+
+
+def object_validators(queryset):
+    """
+    ``(last modified, etag)`` of the only object in ``queryset``, or
+    ``(None, None)`` when there isn't one
+    """
+    row = list(queryset.values_list('pk', 'modified')[:1])
+    if not row:
+        return None, None
+    pk, modified = row[0]
+    return modified, etag_for(queryset.model._meta, pk, modified)
+
+
+def list_validators(queryset):
+    """
+    ``(last modified, etag)`` of everything in ``queryset``
+    """
+    stats = queryset.order_by().aggregate(latest=Max('modified'), count=Count('pk'))
+    return stats['latest'], etag_for(queryset.model._meta, stats['count'], stats['latest'])
+
+
+def add_cache_headers(response, last_modified=None, etag=None, cache_control=None):
+    """
+    Adds the validators and the ``cache_control`` directives, by default the
+    ``CACHE_CONTROL`` setting, to ``response``
+    """
+    if cache_control is None:
+        cache_control = CACHE_CONTROL
+    if etag and not response.has_header('ETag'):
+        response['ETag'] = quote_etag(etag)
+    if last_modified and not response.has_header('Last-Modified'):
+        response['Last-Modified'] = http_date(timestamp(last_modified))
+    if cache_control:
+        patch_cache_control(response, **cache_control)
+    return response
+
+
+def not_modified(request, last_modified=None, etag=None, cache_control=None):
+    """
+    A ``304 Not Modified`` response when the client's copy of a GET or HEAD
+    request is still current, otherwise ``None``. ``If-None-Match`` wins
+    over ``If-Modified-Since`` when both are sent.
+    """
+    if request.method not in ('GET', 'HEAD'):
+        return None
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if_modified_since = request.META.get('HTTP_IF_MODIFIED_SINCE')
+    if if_none_match:
+        if not etag:
+            return None
+        etags = parse_etags(if_none_match)
+        if '*' not in etags and etag not in etags:
+            return None
+    elif if_modified_since:
+        if_modified_since = parse_http_date_safe(if_modified_since)
+        if (if_modified_since is None or last_modified is None or
+                timestamp(last_modified) > if_modified_since):
+            return None
+    else:
+        return None
+    return add_cache_headers(HttpResponseNotModified(), last_modified, etag, cache_control)
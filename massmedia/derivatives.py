@@ -0,0 +1,125 @@
+"""
+Make several resized copies of an image from a single decode.
+
+Decoding a large original is most of the cost of resizing it, so the
+original is decoded once, for JPEGs at the smallest scale the decoder can
+give (``draft``) that is still big enough for every copy. The copies are
+then made largest first, each one scaled down from the previous full-frame
+copy rather than from the original.
+"""
+import time
+
+try:
+    import Image as PilImage
+except ImportError:
+    from PIL import Image as PilImage
+
+
+class Target(object):
+    """
+    A copy to make: scaled down to fit ``width`` x ``height``, or with
+    ``crop`` to fill it and cropped to the center
+    """
+    def __init__(self, width=None, height=None, crop=False):
+        self.width = width
+        self.height = height
+        self.crop = bool(crop and width and height)
+
+    def __repr__(self):
+        return '<Target %sx%s%s>' % (self.width or '', self.height or '',
+                                     '-crop' if self.crop else '')
+
+    def frame_size(self, size):
+        """
+        The size the whole of an image of ``size`` is scaled to before it is
+        cropped. Only cropped copies are ever scaled up, to fill their size.
+        """
+        im_width, im_height = size
+        width = float(self.width or im_width) / im_width
+        height = float(self.height or im_height) / im_height
+        if self.crop:
+            scale = max(width, height)
+        else:
+            scale = min(1.0, width, height)
+        return (max(int(round(im_width * scale)), 1), max(int(round(im_height * scale)), 1))
+
+    def make(self, im, frame):
+        """
+        This copy of ``im``, scaled to ``frame`` and then cropped
+        """
+        if frame != im.size:
+            im = im.resize(frame, PilImage.ANTIALIAS)
+        if self.crop and frame != (self.width, self.height):
+            left = (frame[0] - self.width) // 2
+            top = (frame[1] - self.height) // 2
+            im = im.crop((left, top, left + self.width, top + self.height))
+        return im
+
+
+def decode(f, targets):
+    """
+    Decode the image in the file ``f``, only as big as ``targets`` need, in
+    a mode that can be resized smoothly
+    """
+    im = PilImage.open(f)
+    frames = [target.frame_size(im.size) for target in targets]
+    if im.format == 'JPEG':
+        im.draft(im.mode, (max(w for w, h in frames), max(h for w, h in frames)))
+    im.load()
+    if im.mode not in ('L', 'RGB', 'RGBA'):
+        has_alpha = im.mode in ('LA', 'PA') or 'transparency' in im.info
+        im = im.convert('RGBA' if has_alpha else 'RGB')
+    return im
+
+
+def cascade(im, targets):
+    """
+    Yield ``(target, copy)`` for each target, largest first, scaling each
+    from the smallest full-frame image made so far that is big enough
+    """
+    source = im
+    for target in sorted(targets, key=lambda t: t.frame_size(im.size), reverse=True):
+        frame = target.frame_size(im.size)
+        if source.size[0] < frame[0] or source.size[1] < frame[1]:
+            source = im
+        copy = target.make(source, frame)
+        yield target, copy
+        if not target.crop:
+            source = copy
+
+
+def make(f, targets):
+    """
+    ``{target: copy}`` for an image file, decoded once
+    """
+    return dict(cascade(decode(f, targets), targets))
+
+
+def make_independently(path, targets):
+    """
+    ``{target: copy}``, decoding the image again for each target as separate
+    jobs would
+    """
+    copies = {}
+    for target in targets:
+        with open(path, 'rb') as f:
+            copies.update(make(f, [target]))
+    return copies
+
+
+def compare(path, targets, encode=None):
+    """
+    Seconds taken to make (and ``encode``, if given) the copies of the image
+    at ``path`` independently and with one decode
+    """
+    def run(func, arg):
+        start = time.time()
+        copies = func(arg, targets)
+        if encode is not None:
+            for copy in copies.values():
+                encode(copy)
+        return time.time() - start
+    independent = run(make_independently, path)
+    with open(path, 'rb') as f:
+        cascaded = run(make, f)
+    return independent, cascaded
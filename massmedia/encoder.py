@@ -0,0 +1,58 @@
+"""
+JPEG encoding to a byte budget.
+
+The size of a JPEG at a given quality depends on what is in the picture, so
+a fixed quality makes some thumbnails far bigger than others. ``encode``
+instead looks for the highest quality, within bounds, whose output fits the
+budget, with a binary search over the quality: about 6 encodes for the
+default range. The output is progressive and Huffman optimized, and no
+EXIF or ICC data is copied from the original.
+"""
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+from massmedia.settings import THUMB_BYTES, THUMB_QUALITY_RANGE
+
+DEFAULT_QUALITY = 75  # PIL's default
+
+
+def encode_jpeg(im, quality):
+    if im.mode not in ('L', 'RGB'):
+        im = im.convert('RGB')
+    out = StringIO()
+    im.save(out, format='JPEG', quality=quality, optimize=True, progressive=True)
+    return out.getvalue()
+
+
+def encode(im, budget=THUMB_BYTES, quality=None, quality_range=THUMB_QUALITY_RANGE):
+    """
+    Return ``(data, quality)``: ``im`` as a JPEG of at most ``budget`` bytes,
+    at the highest quality in ``quality_range`` that fits. When even the
+    lowest quality is too big, that is used.
+
+    An explicit ``quality``, such as the one recorded the last time, skips
+    the search, so encoding the same picture again gives the same file.
+    Without a budget ``DEFAULT_QUALITY`` is used.
+    """
+    if im.mode not in ('L', 'RGB'):
+        im = im.convert('RGB')
+    if quality is None and not budget:
+        quality = DEFAULT_QUALITY
+    if quality is not None:
+        return encode_jpeg(im, quality), quality
+
+    low, high = quality_range
+    best = None
+    while low <= high:
+        middle = (low + high) // 2
+        data = encode_jpeg(im, middle)
+        if len(data) <= budget:
+            best = data, middle
+            low = middle + 1
+        else:
+            high = middle - 1
+    if best is None:
+        return encode_jpeg(im, quality_range[0]), quality_range[0]
+    return best
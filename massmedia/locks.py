@@ -0,0 +1,154 @@
+"""
+Locks that keep expensive work, like making an image variant or refreshing
+a feed, down to one process at a time.
+
+With a cache shared between processes (memcached, redis, a database) the
+lock is a key added to the cache, so it works across machines. A cache that
+lives inside each process (locmem, dummy) can't do that, so a ``flock`` on a
+file in ``LOCK_DIR`` is used instead, which covers the processes of one
+machine: the setups that keep their media on local storage.
+"""
+import hashlib
+import os
+import tempfile
+import time
+import uuid
+
+from django.core.cache import cache
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.utils.encoding import force_bytes
+
+from massmedia.settings import LOCK_DIR, LOCK_TIMEOUT, LOCK_WAIT
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+POLL_INTERVAL = 0.05
+
+
+class LockTimeout(Exception):
+    """
+    Another process held the lock for longer than we could wait
+    """
+
+
+class Lock(object):
+    def __init__(self, key, timeout=LOCK_TIMEOUT):
+        self.key = key
+        self.timeout = timeout
+
+    def try_acquire(self):
+        raise NotImplementedError
+
+    def release(self):
+        raise NotImplementedError
+
+    def acquire(self, wait=0):
+        """
+        Take the lock, waiting up to ``wait`` seconds for another holder to
+        release it. Returns whether it was taken.
+        """
+        deadline = time.time() + wait
+        while not self.try_acquire():
+            if time.time() >= deadline:
+                return False
+            time.sleep(POLL_INTERVAL)
+        return True
+
+    def __enter__(self):
+        if not self.acquire(LOCK_WAIT):
+            raise LockTimeout(self.key)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class CacheLock(Lock):
+    """
+    A key added to the cache, which expires after ``timeout`` seconds in
+    case its holder dies
+    """
+    def __init__(self, key, timeout=LOCK_TIMEOUT):
+        super(CacheLock, self).__init__(key, timeout)
+        self.cache_key = 'massmedia.lock.%s' % hashlib.md5(force_bytes(key)).hexdigest()
+        self.token = None
+
+    def try_acquire(self):
+        token = uuid.uuid4().hex
+        if cache.add(self.cache_key, token, self.timeout):
+            self.token = token
+            return True
+        return False
+
+    def release(self):
+        # Don't delete a lock that expired and was taken by someone else
+        if self.token is not None and cache.get(self.cache_key) == self.token:
+            cache.delete(self.cache_key)
+        self.token = None
+
+
+class FileLock(Lock):
+    """
+    An exclusive ``flock`` on a file, dropped by the system if its holder
+    dies, so ``timeout`` isn't needed
+    """
+    def __init__(self, key, timeout=LOCK_TIMEOUT):
+        super(FileLock, self).__init__(key, timeout)
+        directory = LOCK_DIR or os.path.join(tempfile.gettempdir(), 'massmedia-locks')
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:  # Made by another process in the meantime
+                pass
+        self.path = os.path.join(directory, '%s.lock' % hashlib.md5(force_bytes(key)).hexdigest())
+        self.fd = None
+
+    def try_acquire(self):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            os.close(fd)
+            return False
+        self.fd = fd
+        return True
+
+    def release(self):
+        if self.fd is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
+
+
+def get_lock(key, timeout=LOCK_TIMEOUT):
+    """
+    The lock for ``key`` that works best with the configured cache
+    """
+    if fcntl is not None and isinstance(cache, (LocMemCache, DummyCache)):
+        return FileLock(key, timeout)
+    return CacheLock(key, timeout)
+
+
+def single_flight(key, done, make, wait=LOCK_WAIT, timeout=LOCK_TIMEOUT):
+    """
+    Return ``done()`` if it is true, otherwise ``make()`` it, with only one
+    process making it at a time. The others wait up to ``wait`` seconds and
+    get the first one's result through ``done()``, or ``LockTimeout``.
+    """
+    result = done()
+    if result:
+        return result
+    lock = get_lock(key, timeout)
+    if not lock.acquire(wait):
+        result = done()
+        if result:
+            return result
+        raise LockTimeout(key)
+    try:
+        return done() or make()
+    finally:
+        lock.release()
@@ -0,0 +1,80 @@
+import gc
+import time
+from optparse import make_option
+
+from django.contrib import admin
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.test.client import RequestFactory
+
+from massmedia.models import Image
+from massmedia.templatetags.massmedia_admin import results, thumbnails_for_result
+
+# Columns that cost the same to render either way are left out
+GRID_COLUMNS = ('title', 'mime_type', 'public', 'creation_date', 'author_name')
+
+
+def image_changelist(rows, list_display=None):
+    """
+    The admin changelist of the first ``rows`` images, as a superuser sees it
+    """
+    model_admin = admin.site._registry[Image]
+    request = RequestFactory().get('/admin/massmedia/image/')
+    request.user = User(is_superuser=True, is_staff=True)
+    cl = model_admin.get_changelist(request)(request, Image,
+        list_display or model_admin.list_display, model_admin.list_display_links,
+        model_admin.list_filter, model_admin.date_hierarchy,
+        model_admin.search_fields, model_admin.list_select_related,
+        rows, rows, model_admin.list_editable, model_admin)
+    if list_display:
+        cl.list_display_links = list_display[:1]
+    cl.formset = None
+    cl.result_list = list(cl.result_list)
+    return cl
+
+
+def per_row(cl):
+    """
+    The grid's rows, working out every column and change URL for each row
+    """
+    return [list(thumbnails_for_result(cl, res, None)) for res in cl.result_list]
+
+
+def fastest(func, cl, rounds):
+    best = None
+    gc.disable()
+    try:
+        for i in range(rounds):
+            start = time.time()
+            func(cl)
+            elapsed = time.time() - start
+            best = min(elapsed, best or elapsed)
+    finally:
+        gc.enable()
+    return best
+
+
+class Command(BaseCommand):
+    help = ('Compare rendering the image changelist grid with one column plan and '
+            'with the columns and change URL worked out for each row')
+    option_list = BaseCommand.option_list + (
+        make_option('-n', '--rows', dest='rows', default='500',
+            help='Number of images on the page'
+        ),
+        make_option('-r', '--rounds', dest='rounds', default='5',
+            help='Render the page this many times and keep the fastest'
+        ),
+    )
+
+    def handle(self, *args, **options):
+        rows = int(options.get('rows') or 1)
+        rounds = int(options.get('rounds') or 1)
+        cl = image_changelist(rows, GRID_COLUMNS)
+        if not cl.result_list:
+            raise CommandError('There are no images to list')
+        if list(results(cl)) != per_row(cl):
+            raise CommandError('The planned rows differ from the per row ones')
+        per_row_time = fastest(per_row, cl, rounds)
+        planned_time = fastest(lambda cl: list(results(cl)), cl, rounds)
+        self.stdout.write('%d rows: %.1f -> %.1f ms' % (
+            len(cl.result_list), per_row_time * 1000, planned_time * 1000))
@@ -0,0 +1,49 @@
+import random
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from massmedia.autocomplete import PrefixIndex
+
+
+def random_titles(count, seed=1):
+    """
+    ``(content type id, object id, title)`` items of four words each, drawn
+    from a vocabulary of 5,000 made up words
+    """
+    rand = random.Random(seed)
+    vocabulary = [''.join(rand.choice('abcdefghijklmnopqrstuvwxyz') for i in range(rand.randint(3, 10)))
+                  for i in range(5000)]
+    return vocabulary, [(rand.randint(1, 6), pk, u' '.join(rand.sample(vocabulary, 4)))
+                        for pk in range(count)]
+
+
+def sample_queries(vocabulary):
+    return ['a', 'ab', 'abc', vocabulary[0][:4], '%s %s' % (vocabulary[1][:2], 'e')]
+
+
+class Command(BaseCommand):
+    help = 'Time building the autocomplete prefix index and looking up titles in it'
+    option_list = BaseCommand.option_list + (
+        make_option('-n', '--titles', dest='titles', default='50000',
+            help='Number of generated titles to index'
+        ),
+        make_option('-l', '--limit', dest='limit', default='20',
+            help='Most suggestions returned by each lookup'
+        ),
+    )
+
+    def handle(self, *args, **options):
+        count = int(options.get('titles') or 1)
+        limit = int(options.get('limit') or 1)
+        vocabulary, items = random_titles(count)
+        index = PrefixIndex()
+        start = time.time()
+        index.load(items)
+        self.stdout.write('Indexed %d titles in %.1f ms' % (count, (time.time() - start) * 1000))
+        for query in sample_queries(vocabulary):
+            start = time.time()
+            results = index.lookup(query, limit=limit)
+            self.stdout.write('%r: %d suggestions in %.2f ms' % (
+                query, len(results), (time.time() - start) * 1000))
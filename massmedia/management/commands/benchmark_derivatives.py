@@ -0,0 +1,48 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from massmedia import derivatives, mogrify
+from massmedia.management.commands.benchmark_thumbnails import image_paths
+from massmedia.settings import DERIVATIVES, THUMB_SIZE
+
+
+class Command(BaseCommand):
+    args = '<image file or directory> [...]'
+    help = 'Compare making several resized copies of images from one decode with decoding for each'
+    option_list = BaseCommand.option_list + (
+        make_option('-s', '--sizes', dest='sizes', default=None,
+            help='Comma separated specs such as 1200x,600x400-crop; the thumbnail and DERIVATIVES by default'
+        ),
+    )
+
+    def handle(self, *args, **options):
+        if not args:
+            raise CommandError('Give at least one image file or directory')
+        if options.get('sizes'):
+            specs = options['sizes'].split(',')
+        else:
+            specs = ['%sx%s' % THUMB_SIZE] + [spec for spec, ext in DERIVATIVES]
+        try:
+            targets = [derivatives.Target(*mogrify.parse_spec(spec)) for spec in specs]
+        except ValueError, e:
+            raise CommandError(e)
+
+        count, independent_total, cascaded_total = 0, 0.0, 0.0
+        for path in image_paths(args):
+            try:
+                independent, cascaded = derivatives.compare(
+                    path, targets, lambda im: mogrify.encode(im, 'JPEG'))
+            except IOError, e:
+                self.stderr.write('Skipping %s: %s' % (path, e))
+                continue
+            self.stdout.write('%s: %.1f -> %.1f ms' % (path, independent * 1000, cascaded * 1000))
+            count += 1
+            independent_total += independent
+            cascaded_total += cascaded
+
+        if not count:
+            raise CommandError('No images found')
+        self.stdout.write('%d images, %d sizes: %.1f -> %.1f ms per image (%.1f%% saved)' % (
+            count, len(targets), independent_total * 1000 / count, cascaded_total * 1000 / count,
+            100.0 * (independent_total - cascaded_total) / independent_total))
@@ -0,0 +1,47 @@
+import cPickle as pickle
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from massmedia.youtube import YouTubeBase, parse_playlist
+
+
+def legacy_playlist(xml):
+    """
+    The playlist the way it was cached before the compact format
+    """
+    import gdata.youtube
+    feed = gdata.youtube.YouTubeVideoFeedFromString(xml)
+    return YouTubeBase.convert_to_python(feed.__dict__)
+
+
+def timed(func, xml, rounds):
+    start = time.time()
+    for i in range(rounds):
+        result = func(xml)
+    return result, (time.time() - start) / rounds
+
+
+class Command(BaseCommand):
+    args = '<playlist feed file> [...]'
+    help = 'Compare the size and building time of compact cached playlists with the gdata objects'
+    option_list = BaseCommand.option_list + (
+        make_option('-r', '--rounds', dest='rounds', default='5',
+            help='Number of times to build each playlist'
+        ),
+    )
+
+    def handle(self, *args, **options):
+        if not args:
+            raise CommandError('Give at least one saved YouTube playlist feed')
+        rounds = int(options.get('rounds') or 1)
+
+        for path in args:
+            xml = open(path).read()
+            legacy, legacy_time = timed(legacy_playlist, xml, rounds)
+            compact, compact_time = timed(parse_playlist, xml, rounds)
+            legacy_size = len(pickle.dumps(legacy, pickle.HIGHEST_PROTOCOL))
+            compact_size = len(pickle.dumps(compact, pickle.HIGHEST_PROTOCOL))
+            self.stdout.write('%s: %d -> %d bytes, %.1f -> %.1f ms' % (
+                path, legacy_size, compact_size, legacy_time * 1000, compact_time * 1000))
@@ -0,0 +1,92 @@
+import os
+import time
+from optparse import make_option
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+from django.core.management.base import BaseCommand, CommandError
+
+from massmedia import encoder
+from massmedia.models import is_image
+from massmedia.settings import THUMB_BYTES, THUMB_SIZE
+
+try:
+    import Image as PilImage
+except ImportError:
+    from PIL import Image as PilImage
+
+
+def image_paths(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                for filename in sorted(filenames):
+                    if is_image(filename):
+                        yield os.path.join(dirpath, filename)
+        else:
+            yield path
+
+
+def timed(func, *args, **kwargs):
+    start = time.time()
+    result = func(*args, **kwargs)
+    return result, time.time() - start
+
+
+def plain_jpeg(im):
+    """
+    A thumbnail encoded the way they were before byte budgets
+    """
+    out = StringIO()
+    im.save(out, format='JPEG')
+    return out.getvalue()
+
+
+class Command(BaseCommand):
+    args = '<image file or directory> [...]'
+    help = 'Compare the size and encoding time of thumbnails made to a byte budget with plain JPEGs'
+    option_list = BaseCommand.option_list + (
+        make_option('-b', '--budget', dest='budget', default=None,
+            help='Byte budget for each thumbnail, THUMB_BYTES by default'
+        ),
+    )
+
+    def handle(self, *args, **options):
+        if not args:
+            raise CommandError('Give at least one image file or directory')
+        budget = int(options.get('budget') or THUMB_BYTES or 0)
+        if not budget:
+            raise CommandError('Give a --budget or set THUMB_BYTES')
+
+        totals = dict(count=0, plain=0, budget=0, plain_time=0.0, budget_time=0.0)
+        for path in image_paths(args):
+            try:
+                im = PilImage.open(path)
+                im.load()
+            except IOError, e:
+                self.stderr.write('Skipping %s: %s' % (path, e))
+                continue
+            if im.mode not in ('L', 'RGB'):
+                im = im.convert('RGB')
+            im.thumbnail(THUMB_SIZE, PilImage.ANTIALIAS)
+
+            plain, plain_time = timed(plain_jpeg, im)
+            (data, quality), budget_time = timed(encoder.encode, im, budget)
+            self.stdout.write('%s: %d -> %d bytes at quality %d, %.1f -> %.1f ms' % (
+                path, len(plain), len(data), quality, plain_time * 1000, budget_time * 1000))
+            totals['count'] += 1
+            totals['plain'] += len(plain)
+            totals['budget'] += len(data)
+            totals['plain_time'] += plain_time
+            totals['budget_time'] += budget_time
+
+        if not totals['count']:
+            raise CommandError('No images found')
+        saved = totals['plain'] - totals['budget']
+        self.stdout.write('%d images: %d -> %d bytes (%d saved, %.1f%%), %.1f -> %.1f ms per image' % (
+            totals['count'], totals['plain'], totals['budget'], saved,
+            100.0 * saved / totals['plain'],
+            totals['plain_time'] * 1000 / totals['count'],
+            totals['budget_time'] * 1000 / totals['count']))
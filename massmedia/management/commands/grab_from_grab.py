@@ -1,91 +1,231 @@
-from django.core.files.base import ContentFile
-from django.core.management.base import BaseCommand, CommandError
-from django.template.defaultfilters import slugify
-from django.contrib.sites.models import Site
-from massmedia.models import GrabVideo,Image
-
+import os
 import urllib2
-import urllib
-from lxml import etree
-from datetime import datetime
 from base64 import b64encode
-import os
+from datetime import datetime
+from itertools import islice
+from multiprocessing.pool import ThreadPool
 from optparse import make_option
-import sha
+
+from lxml import etree
+
+from django.core.files.base import ContentFile
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from massmedia.fields import Metadata
+from massmedia.models import Image, Video
+
+GRAB_PLAYER_URL = 'http://player.grabnetworks.com/swf/cube.swf?a=%s&m=%s'
+FETCH_TIMEOUT = 30
+
+
+def grab_slug(asset_id):
+    """
+    The slug of the ``Video`` imported for a Grab asset id
+    """
+    return ('grab-%s' % asset_id).lower()
+
+
+def parse_video(element):
+    """
+    Convert a ``<video>`` element of the feed into a dictionary
+    """
+    d = {}
+    for e in element.iterchildren():
+        if e.tag == 'categories':
+            d[e.tag] = [unicode(x.text or '').strip()[:50] for x in e.iterchildren()]
+        elif e.tag == 'id':
+            d['id'] = 'V%s' % e.text
+        else:
+            d[e.tag] = e.text
+    keywords = unicode(d.get('keywords') or '')
+    separator = ',' if ',' in keywords else None
+    d['keywords'] = [x.strip()[:50] for x in keywords.split(separator) if x.strip()]
+    d.setdefault('categories', [])
+    return d
+
+
+def iter_videos(stream):
+    """
+    Incrementally parse the feed, yielding a dictionary for each video.
+
+    Each element is cleared, and detached from the tree, once it has been
+    read so memory use doesn't grow with the size of the feed.
+    """
+    for event, element in etree.iterparse(stream, events=('end', ), tag='video'):
+        yield parse_video(element)
+        element.clear()
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+
+
+def stored_files(image):
+    """
+    ``(storage, name)`` of the files saved for an ``Image``
+    """
+    return [(f.storage, f.name) for f in (image.file, image.thumbnail) if f]
+
+
+def delete_files(files):
+    for storage, name in files:
+        try:
+            storage.delete(name)
+        except Exception:
+            pass
+
+
+def fetch_preview(url):
+    """
+    Download a preview image, returning ``None`` if it can't be retrieved
+    """
+    if not url:
+        return None
+    try:
+        return urllib2.urlopen(url, timeout=FETCH_TIMEOUT).read()
+    except Exception:
+        return None
+
 
 class Command(BaseCommand):
-     option_list = BaseCommand.option_list + (
-          make_option('-l', '--layout', dest='layout', default='851501',
-             help='Grab layout id of the player to use (defaults to twt standard)'
-          ),
-     )     
-     def handle(self, *a, **kw):
-          asset_id = None
-          if len(a):
-               asset_id = a[0]
-          
-          try:
-               from massmedia.settings import GRAB_API_URL,GRAB_API_KEY
-               assert GRAB_API_KEY and GRAB_API_URL
-          except (ImportError, AssertionError):
-               raise CommandError('You must define your Grab networks settings!')
-          
-          if asset_id:
-               GRAB_API_URL = '%s%s' % (GRAB_API_URL, asset_id)
-          
-          req = urllib2.Request(GRAB_API_URL, None, {
-               'Authorization': 'Basic %s' % b64encode('%s:' % GRAB_API_KEY)
-          })
-          try:
-               response = urllib2.urlopen(req)
-          except urllib2.HTTPError, e:
-               raise CommandError('Grab networks had a problem request: %s' % e)
-          except urllib2.URLError, e:
-               raise CommandError('Failed to reach Grab networks: %s' % e)
-
-          parser = etree.XMLParser()
-          parser.feed(response.read().decode('latin1').encode('utf8'))
-          for element in parser.close().iter("*"):
-               if element.tag == 'video':
-                    d = {}
-                    for e in element.getchildren():
-                         if e.tag == 'categories':
-                              d[e.tag] = map(lambda x: unicode(x.text.strip())[:50], e.getchildren())
-                         elif e.tag == 'id':
-                              d['id'] = 'V%s' % e.text
-                         else:
-                              d[e.tag] = e.text
-                    
-                    title = d['title'] 
-                    time = datetime.strptime(d['created-at'],'%Y-%m-%dT%H:%M:%SZ')
-                    slug,s = sha.new(title).hexdigest(),sha.new(time.strftime("%d-%b-%Y %H:%M:%S").lower() + title).hexdigest()
+    args = '[<asset id>]'
+    help = 'Import videos from the Grab Networks feed as Video objects'
+    option_list = BaseCommand.option_list + (
+        make_option('-l', '--layout', dest='layout', default='851501',
+            help='Grab layout id of the player to use (defaults to twt standard)'
+        ),
+        make_option('-b', '--batch-size', dest='batch_size', default='100',
+            help='Number of videos to import in each transaction'
+        ),
+        make_option('-w', '--workers', dest='workers', default='4',
+            help='Number of preview images to download at the same time'
+        ),
+    )
+
+    def handle(self, *a, **kw):
+        asset_id = None
+        if len(a):
+            asset_id = a[0]
+
+        try:
+            from massmedia.settings import GRAB_API_URL, GRAB_API_KEY
+            assert GRAB_API_KEY and GRAB_API_URL
+        except (ImportError, AssertionError):
+            raise CommandError('You must define your Grab networks settings!')
+
+        if asset_id:
+            GRAB_API_URL = '%s%s' % (GRAB_API_URL, asset_id)
+
+        req = urllib2.Request(GRAB_API_URL, None, {
+            'Authorization': 'Basic %s' % b64encode('%s:' % GRAB_API_KEY)
+        })
+        try:
+            response = urllib2.urlopen(req)
+        except urllib2.HTTPError, e:
+            raise CommandError('Grab networks had a problem request: %s' % e)
+        except urllib2.URLError, e:
+            raise CommandError('Failed to reach Grab networks: %s' % e)
+
+        self.layout = kw.get('layout')
+        batch_size = int(kw.get('batch_size') or 100)
+        pool = ThreadPool(int(kw.get('workers') or 4))
+        imported = 0
+        try:
+            videos = iter_videos(response)
+            while True:
+                batch = list(islice(videos, batch_size))
+                if not batch:
+                    break
+                imported += self.import_batch(batch, pool)
+        except etree.XMLSyntaxError, e:
+            raise CommandError('Grab networks returned an invalid feed: %s' % e)
+        finally:
+            pool.close()
+            response.close()
+        print 'Imported %d videos' % imported
+
+    def import_batch(self, batch, pool):
+        """
+        Create the videos in ``batch`` that haven't already been imported,
+        returning the number created. A video that can't be created is
+        skipped; if the whole batch is rolled back, the preview files saved
+        for it are deleted again.
+        """
+        entries = []
+        for d in batch:
+            if d.get('id'):
+                entries.append((grab_slug(d['id']), d))
+            else:
+                self.stderr.write('Skipping a Grab video without an id')
+        seen = set(Video.objects.filter(slug__in=[slug for slug, d in entries])
+                   .values_list('slug', flat=True))
+        new_videos = []
+        for slug, d in entries:
+            if slug not in seen:
+                seen.add(slug)
+                new_videos.append((slug, d))
+        if not new_videos:
+            return 0
+
+        previews = pool.map(fetch_preview, [d.get('preview-url') for slug, d in new_videos])
+
+        created = 0
+        batch_files = []
+        try:
+            with transaction.atomic():
+                for (slug, d), preview in zip(new_videos, previews):
+                    files = []
                     try:
-                         video = GrabVideo.objects.get(title=title,slug=slug,creation_date=time)
-                         continue
-                    except GrabVideo.DoesNotExist:
-                         try:
-                              thumb,_ = Image.objects.get_or_create(slug=s)
-                         
-                              thumb.file.save(os.path.basename(d['preview-url']),
-                                   ContentFile(urllib.urlopen(d['preview-url']).read()))
-                              
-                              if not ',' in unicode(d['keywords'] or ''):
-                                   d['keywords'] = map(lambda x: unicode(x.strip())[:50], unicode(d['keywords'] or '').split())
-                              else:
-                                   d['keywords'] = map(lambda x: unicode(x.strip())[:50], unicode(d['keywords'] or '').split(','))
-                              video,_ = GrabVideo.objects.get_or_create(
-                                   title = title,
-                                   slug = slug,
-                                   creation_date = time,
-                                   one_off_author = d['provider-name'],
-                                   credit = unicode(d['copyright'] or '')[:150],
-                                   caption = unicode(d['summary'] or '')[:255],
-                                   asset_id = d['id'],
-                                   layout_id = kw.get('layout'),
-                                   thumbnail = thumb,
-                                   categories = ','.join(d['categories'])[:255],
-                                   keywords = ','.join(d['keywords'])[:255]
-                              )
-                              video.sites.add(Site.objects.get_current())
-                         except:
-                              continue
\ No newline at end of file
+                        with transaction.atomic():
+                            self.create_video(slug, d, preview, files)
+                    except Exception, e:
+                        delete_files(files)
+                        self.stderr.write('Skipping Grab video %s: %r' % (d['id'], e))
+                        continue
+                    batch_files.extend(files)
+                    created += 1
+        except BaseException:
+            delete_files(batch_files)
+            raise
+        return created
+
+    def create_video(self, slug, d, preview, files):
+        """
+        Create the ``Video`` for the feed entry ``d``, adding the files
+        saved for its preview image to ``files``
+        """
+        # Read before anything is saved
+        title = (d['title'] or slug)[:255]
+        created = None
+        if d.get('created-at'):
+            created = datetime.strptime(d['created-at'], '%Y-%m-%dT%H:%M:%SZ')
+
+        thumb = None
+        if preview:
+            thumb = Image(title=title, slug='%s-preview' % slug)
+            try:
+                thumb.file.save(os.path.basename(d['preview-url'].split('?')[0]),
+                                ContentFile(preview))
+            finally:
+                files.extend(stored_files(thumb))
+
+        video = Video(
+            title=title,
+            slug=slug,
+            one_off_author=unicode(d.get('provider-name') or '')[:100],
+            caption=unicode(d.get('summary') or ''),
+            external_url=GRAB_PLAYER_URL % (d['id'], self.layout),
+            mime_type='application/x-shockwave-flash',
+            thumbnail=thumb,
+            metadata=Metadata({
+                'asset_id': d['id'],
+                'layout_id': self.layout,
+                'copyright': unicode(d.get('copyright') or '')[:150],
+                'categories': d['categories'],
+                'keywords': d['keywords'],
+            }))
+        video.save()
+
+        # creation_date is auto_now_add, so keep Grab's date with an update
+        if created is not None:
+            Video.objects.filter(pk=video.pk).update(creation_date=created)
+        return video
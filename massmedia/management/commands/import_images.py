@@ -1,8 +1,8 @@
-import os, shutil
+import os, shutil, time, json
+from hashlib import sha1 as sha_constructor
 from django.core.management.base import BaseCommand
 from django.conf import settings
 from django.core.files.base import ContentFile
-from django.utils.hashcompat import sha_constructor
 from django.db import transaction
 
 from massmedia import settings as appsettings
@@ -23,6 +23,141 @@ except ImportError:
     except ImportError:
         PilImage = 0
 
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+MANIFEST_NAME = '.import_manifest.json'
+
+
+class ScanManifest(object):
+    """
+    A record of the files already seen in the drop directory, stored as JSON
+    as ``{name: [size, mtime, sha1]}``.
+
+    The size and mtime make it cheap to tell that a file is unchanged; the
+    hash is only computed once a file has settled and catches files that
+    were touched, but not actually modified. Files that leave the directory,
+    as imported ones do when they are archived, are forgotten.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.dirty = False
+        try:
+            self.entries = json.load(open(path))
+        except (IOError, OSError, ValueError):
+            self.entries = {}
+
+    @staticmethod
+    def stat(filepath):
+        try:
+            st = os.stat(filepath)
+        except OSError:
+            return None
+        return (st.st_size, st.st_mtime)
+
+    @staticmethod
+    def hash(filepath, blocksize=65536):
+        digest = sha_constructor()
+        f = open(filepath, 'rb')
+        try:
+            for block in iter(lambda: f.read(blocksize), ''):
+                digest.update(block)
+        finally:
+            f.close()
+        return digest.hexdigest()
+
+    def is_changed(self, name, stat, digest=None):
+        if name not in self.entries:
+            return True
+        size, mtime, old_digest = self.entries[name]
+        if digest is not None:
+            return digest != old_digest
+        return (size, mtime) != tuple(stat)
+
+    def update(self, name, stat, digest):
+        self.entries[name] = list(stat) + [digest]
+        self.dirty = True
+
+    def remove(self, name):
+        if self.entries.pop(name, None) is not None:
+            self.dirty = True
+
+    def prune(self, names):
+        """
+        Forget the files that are not in ``names``, the directory's listing
+        """
+        names = set(names)
+        for name in self.entries.keys():
+            if name not in names:
+                self.remove(name)
+
+    def save(self):
+        if not self.dirty:
+            return
+        tmp_path = '%s.tmp' % self.path
+        f = open(tmp_path, 'w')
+        try:
+            json.dump(self.entries, f)
+        finally:
+            f.close()
+        os.rename(tmp_path, self.path)
+        self.dirty = False
+
+
+class DirectoryWatcher(object):
+    """
+    Report the names in a directory that may have been added or changed.
+
+    Uses inotify when ``pyinotify`` is installed. Otherwise the directory is
+    only listed again when its mtime changes, which happens when files are
+    added or removed but not when one is rewritten in place; the files
+    already in the manifest are checked for that separately.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.notifier = None
+        self.events = []
+        self.mtime = None
+        self.listed = 0
+        if pyinotify is not None:
+            watcher = self
+
+            class Handler(pyinotify.ProcessEvent):
+                def process_default(self, event):
+                    watcher.events.append(event.name)
+
+            manager = pyinotify.WatchManager()
+            mask = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO
+            manager.add_watch(path, mask)
+            self.notifier = pyinotify.Notifier(manager, Handler(), timeout=0)
+            self.initial = True
+
+    def changed_names(self, interval):
+        if self.notifier is not None:
+            if self.initial:
+                # Pick up whatever was dropped while we weren't watching
+                self.initial = False
+                return os.listdir(self.path)
+            if self.notifier.check_events(int(interval * 1000)):
+                self.notifier.read_events()
+                self.notifier.process_events()
+            names, self.events = self.events, []
+            return names
+
+        time.sleep(interval)
+        try:
+            mtime = os.stat(self.path).st_mtime
+            # A change in the same clock tick as the last listing leaves the
+            # mtime as it was, so list again until a second has passed
+            if mtime == self.mtime and self.listed > mtime + 1:
+                return []
+            self.mtime, self.listed = mtime, time.time()
+            return os.listdir(self.path)
+        except OSError:
+            return []
+
 
 class Command(BaseCommand):
     option_list = BaseCommand.option_list + (
@@ -41,6 +176,18 @@ class Command(BaseCommand):
         make_option('-d', '--dir', dest='path', default='1',
             help='Indicates path for ftp.'
         ),
+        make_option('-w', '--watch', dest='watch', action='store_true', default=False,
+            help='Keep running and import new or changed local images as they arrive.'
+        ),
+        make_option('--interval', dest='interval', default='5',
+            help='Seconds between checks of the directory in watch mode.'
+        ),
+        make_option('--settle', dest='settle', default='2',
+            help='Seconds a file must stay unchanged before it is imported in watch mode.'
+        ),
+        make_option('--manifest', dest='manifest', default='',
+            help='Path of the scan manifest used in watch mode (defaults to %s in the import directory).' % MANIFEST_NAME
+        ),
     )
     @transaction.commit_manually
     def handle(self, *args, **options):
@@ -102,55 +249,137 @@ class Command(BaseCommand):
                     transport.close()
                 except:
                     pass
+        elif options.get('watch'):
+            print 'Watching %s for new images...' % path
+            self.watch(path, archived_path, options)
         else:
             print 'Using local options...'
             images = [os.path.join(path, x) for x in os.listdir(path) if is_image(x)]
-        
+
             for image in images:
-                print 'Processing image: %s' % image
-                try:
-                    try:
-                        im = PilImage.open(open(image,'rb'))
-                        im.verify()
-                    except Exception, e:
-                        print 'Image open exception: %s' % e
-                        try:
-                            print 'Tring to Move image to archive...'
-                            shutil.move(image, os.path.join(archived_path, os.path.basename(image)))
-                            print 'Move Complete'
-                        except Exception, e:
-                            print 'Move exception: %s' % e
-                            
-                        continue
-                        
-                    img = Image.objects.create(title=os.path.basename(image),slug=sha_constructor(image+str(os.stat(image).st_size)).hexdigest())
-                    img.file.save(os.path.basename(image),
-                        ContentFile(open(image,'rb').read()))
+                self.import_local_image(image, archived_path)
+
+        print 'Image import complete.'
+
+    def archive(self, image, archived_path):
+        try:
+            print 'Tring to Move image to archive...'
+            shutil.move(image, os.path.join(archived_path, os.path.basename(image)))
+            print 'Move Complete'
+        except Exception, e:
+            print 'Move exception: %s' % e
+
+    def import_local_image(self, image, archived_path):
+        """
+        Import a single image from the local file system and archive it.
+        Returns the new ``Image`` or ``None`` if the import failed.
+        """
+        print 'Processing image: %s' % image
+        try:
+            try:
+                im = PilImage.open(open(image,'rb'))
+                im.verify()
+            except Exception, e:
+                print 'Image open exception: %s' % e
+                self.archive(image, archived_path)
+                return None
+
+            img = Image.objects.create(title=os.path.basename(image),slug=sha_constructor(image+str(os.stat(image).st_size)).hexdigest())
+            img.file.save(os.path.basename(image),
+                ContentFile(open(image,'rb').read()))
+            transaction.commit()
+
+            # Archive processed file
+            self.archive(image, archived_path)
+
+            if isinstance(img.metadata, list) and len(img.metadata) > 0:
+                if 120 in img.metadata[0].keys():
+                    img.caption = img.metadata[0][120]
+                    img.save()
                     transaction.commit()
-                    
-                    # Archive processed file
-                    try:
-                        print 'Tring to Move image to archive...'
-                        shutil.move(image, os.path.join(archived_path, os.path.basename(image)))
-                        print 'Move Complete'
-                    except Exception, e:
-                        print 'Move exception: %s' % e
-                    
-                    if isinstance(img.metadata, list) and len(img.metadata) > 0:
-                        if 120 in img.metadata[0].keys():
-                            img.caption = img.metadata[0][120]
-                            img.save()
-                            transaction.commit()
-                        
-                except Exception, e:
-                    transaction.rollback()
-                    print 'Caught exception: %s' % e
-                    try:
-                        print 'Tring to Move image to archive...'
-                        shutil.move(image, os.path.join(archived_path, os.path.basename(image)))
-                        print 'Move Complete'
-                    except Exception, e:
-                        print 'Move exception: %s' % e
-                    continue
-        
-        print 'Image import complete.'    
\ No newline at end of file
+            return img
+
+        except Exception, e:
+            transaction.rollback()
+            print 'Caught exception: %s' % e
+            self.archive(image, archived_path)
+            return None
+
+    def watch(self, path, archived_path, options):
+        """
+        Keep importing images dropped into ``path`` until interrupted.
+
+        Only files that are new or changed according to the scan manifest are
+        imported, and only once their size and modification time have been
+        stable for ``--settle`` seconds, so half-written uploads are skipped.
+        """
+        interval = float(options.get('interval') or 5)
+        settle = float(options.get('settle') or 2)
+        manifest = ScanManifest(options.get('manifest') or
+                                os.path.join(path, MANIFEST_NAME))
+        manifest.prune(os.listdir(path))
+        watcher = DirectoryWatcher(path)
+        # Files that have been seen, but not yet imported:
+        # {name: (size, mtime, time the stat was last seen to change)}
+        pending = {}
+        try:
+            while True:
+                self.scan(path, archived_path, watcher, manifest, pending, interval, settle)
+        except KeyboardInterrupt:
+            manifest.save()
+
+    def scan(self, path, archived_path, watcher, manifest, pending, interval, settle):
+        """
+        Wait up to ``interval`` seconds for changes, and import the files
+        that have settled
+        """
+        names = watcher.changed_names(interval)
+        now = time.time()
+        # The watcher misses files rewritten in place when polling, so those
+        # already seen are checked, and forgotten once they have gone
+        for name in manifest.entries.keys():
+            if name in pending:
+                continue
+            stat = manifest.stat(os.path.join(path, name))
+            if stat is None:
+                manifest.remove(name)
+            elif manifest.is_changed(name, stat):
+                pending[name] = stat + (now, )
+        for name in names:
+            if name in pending or not is_image(name):
+                continue
+            stat = manifest.stat(os.path.join(path, name))
+            if stat is not None and manifest.is_changed(name, stat):
+                pending[name] = stat + (now, )
+
+        for name, (size, mtime, seen) in pending.items():
+            filepath = os.path.join(path, name)
+            stat = manifest.stat(filepath)
+            if stat is None:
+                del pending[name]
+                manifest.remove(name)
+            elif stat != (size, mtime):
+                # Still being written, start the debounce over
+                pending[name] = stat + (now, )
+            elif now - seen >= settle:
+                del pending[name]
+                digest = manifest.hash(filepath)
+                if not manifest.is_changed(name, stat, digest):
+                    pass
+                elif self.is_archived(name, digest, archived_path):
+                    # Dropped again as it was: don't import it twice
+                    self.archive(filepath, archived_path)
+                else:
+                    self.import_local_image(filepath, archived_path)
+                if os.path.exists(filepath):
+                    manifest.update(name, stat, digest)
+                else:
+                    manifest.remove(name)
+        manifest.save()
+
+    def is_archived(self, name, digest, archived_path):
+        """
+        Whether the archive has a file called ``name`` with this content
+        """
+        archived = os.path.join(archived_path, name)
+        return os.path.exists(archived) and ScanManifest.hash(archived) == digest
@@ -0,0 +1,28 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from massmedia import mediaindex
+from massmedia.models import SEARCH_MODELS
+
+
+class Command(BaseCommand):
+    args = '[<media type> ...]'
+    help = 'Rebuild the index listing the media of every type'
+    option_list = BaseCommand.option_list + (
+        make_option('-b', '--batch-size', dest='batch_size', default='500',
+            help='Number of objects to read and index at a time'
+        ),
+    )
+
+    def handle(self, *args, **options):
+        models = dict((m._meta.object_name.lower(), m) for m in SEARCH_MODELS)
+        for name in args:
+            if name not in models:
+                raise CommandError('Unknown media type %r, choose from %s' % (
+                    name, ', '.join(sorted(models))))
+        batch_size = int(options.get('batch_size') or 500)
+
+        for name in args or sorted(models):
+            count = mediaindex.rebuild(models[name], batch_size)
+            self.stdout.write('Indexed %d %s objects' % (count, name))
@@ -0,0 +1,43 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from massmedia import search
+from massmedia.models import SEARCH_MODELS
+
+
+class Command(BaseCommand):
+    args = '[<media type> ...]'
+    help = 'Index every media object for full-text search'
+    option_list = BaseCommand.option_list + (
+        make_option('-b', '--batch-size', dest='batch_size', default='500',
+            help='Number of objects to index in each transaction'
+        ),
+    )
+
+    def handle(self, *args, **options):
+        models = dict((m._meta.object_name.lower(), m) for m in SEARCH_MODELS)
+        for name in args:
+            if name not in models:
+                raise CommandError('Unknown media type %r, choose from %s' % (
+                    name, ', '.join(sorted(models))))
+        batch_size = int(options.get('batch_size') or 500)
+
+        search.create_index()
+        for name in args or sorted(models):
+            model = models[name]
+            indexed = 0
+            last_pk = 0
+            # Walk the table by primary key so each batch is a cheap query
+            while True:
+                batch = list(model._base_manager.filter(pk__gt=last_pk)
+                             .select_related('author').order_by('pk')[:batch_size])
+                if not batch:
+                    break
+                with transaction.atomic():
+                    for obj in batch:
+                        search.index_object(obj)
+                indexed += len(batch)
+                last_pk = batch[-1].pk
+            self.stdout.write('Indexed %d %s objects' % (indexed, name))
@@ -0,0 +1,119 @@
+import datetime
+import random
+import time
+import uuid
+from optparse import make_option
+
+from django.contrib.sites.models import Site
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from massmedia.models import SEARCH_MODELS, Collection
+
+PAGE_SIZE = 15
+DATE_GROUP_SIZE = 100
+
+
+def explain(queryset):
+    """
+    The database's plan for ``queryset``, where it can tell us
+    """
+    sql, params = queryset.query.sql_with_params()
+    if connection.vendor == 'sqlite':
+        prefix = 'EXPLAIN QUERY PLAN '
+    elif connection.vendor in ('postgresql', 'mysql'):
+        prefix = 'EXPLAIN '
+    else:
+        return ''
+    cursor = connection.cursor()
+    cursor.execute(prefix + sql, params)
+    if connection.vendor == 'sqlite':
+        # The other columns are ids of the plan's steps
+        return '\n'.join(row[-1] for row in cursor.fetchall())
+    return '\n'.join(' '.join(unicode(col) for col in row) for row in cursor.fetchall())
+
+
+class Command(BaseCommand):
+    args = '[<media type>]'
+    help = ('Fill a media table with generated public and private objects, then time '
+            'the public listing queries. Run it with --count=0 before and after '
+            'migrating to compare the queries with and without the listing indexes. '
+            'The objects are inserted in bulk, without signals, so run rebuild_search_index '
+            'and rebuild_media_index afterwards to search and list them.')
+    option_list = BaseCommand.option_list + (
+        make_option('-c', '--count', dest='count', default='1000000',
+            help='Number of objects to create'
+        ),
+        make_option('-b', '--batch-size', dest='batch_size', default='5000',
+            help='Number of objects to create in each transaction'
+        ),
+        make_option('-d', '--days', dest='days', default='3650',
+            help='Spread the creation dates over this many days back'
+        ),
+    )
+
+    def handle(self, *args, **options):
+        models = dict((m._meta.object_name.lower(), m) for m in SEARCH_MODELS)
+        models['collection'] = Collection
+        name = args[0] if args else 'image'
+        if name not in models or len(args) > 1:
+            raise CommandError('Give one media type, from %s' % ', '.join(sorted(models)))
+        model = models[name]
+        count = int(options.get('count') or 0)
+        batch_size = int(options.get('batch_size') or 5000)
+        days = int(options.get('days') or 1)
+
+        if count:
+            start = time.time()
+            self.seed(model, count, batch_size, days)
+            self.stdout.write('Created %d %s objects in %.1f s' % (count, name, time.time() - start))
+            if model in SEARCH_MODELS:
+                self.stdout.write('Run rebuild_search_index %s and rebuild_media_index %s '
+                                  'to index them' % (name, name))
+
+        total = model.objects.public().count()
+        queries = [
+            ('count', lambda: model.objects.public().count(), None),
+            ('first page', lambda: list(model.objects.public()[:PAGE_SIZE]),
+             model.objects.public()[:PAGE_SIZE]),
+            ('middle page', lambda: list(model.objects.public()[total // 2:total // 2 + PAGE_SIZE]),
+             model.objects.public()[total // 2:total // 2 + PAGE_SIZE]),
+        ]
+        for label, query, queryset in queries:
+            start = time.time()
+            query()
+            self.stdout.write('%s of %d public %s objects: %.1f ms' % (
+                label, total, name, (time.time() - start) * 1000))
+            if queryset is not None:
+                plan = explain(queryset)
+                if plan:
+                    self.stdout.write('  ' + plan.replace('\n', '\n  '))
+
+    def seed(self, model, count, batch_size, days):
+        site = Site.objects.get_current()
+        run = uuid.uuid4().hex[:8]
+        now = timezone.now()
+        rand = random.Random(run)
+        for offset in range(0, count, batch_size):
+            objects = []
+            for i in range(offset, min(offset + batch_size, count)):
+                obj = model(
+                    title='Seed %s %d' % (run, i),
+                    public=rand.random() < 0.9,
+                    site=site)
+                if hasattr(obj, 'slug'):
+                    obj.slug = 'seed-%s-%d' % (run, i)
+                objects.append(obj)
+            with transaction.atomic():
+                last_pk = model._base_manager.aggregate(last=Max('pk'))['last'] or 0
+                model._base_manager.bulk_create(objects)
+                # Spread the creation dates, which auto_now_add made all now,
+                # giving each group of rows its own date
+                pks = list(model._base_manager.filter(
+                    pk__gt=last_pk, title__startswith='Seed %s ' % run).values_list('pk', flat=True))
+                rand.shuffle(pks)
+                for start in range(0, len(pks), DATE_GROUP_SIZE):
+                    model._base_manager.filter(pk__in=pks[start:start + DATE_GROUP_SIZE]).update(
+                        creation_date=now - datetime.timedelta(seconds=rand.randint(0, days * 86400)))
@@ -0,0 +1,44 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from massmedia.models import Collection
+from massmedia.youtube import is_youtube_url
+from massmedia.youtube_sync import PlaylistSync
+
+
+class Command(BaseCommand):
+    args = '[<collection id> ...]'
+    help = 'Copy the videos of YouTube playlist collections into Embed objects'
+    option_list = BaseCommand.option_list + (
+        make_option('-w', '--workers', dest='workers', default='4',
+            help='Number of feed pages to fetch at the same time'
+        ),
+        make_option('-f', '--force', dest='force', action='store_true', default=False,
+            help='Check every video, even if the playlist has not been updated'
+        ),
+    )
+
+    def handle(self, *args, **options):
+        collections = Collection.objects.exclude(external_url='')
+        if args:
+            collections = collections.filter(pk__in=args)
+        failures = 0
+        for collection in collections:
+            if not is_youtube_url(collection.external_url):
+                continue
+            start = time.time()
+            try:
+                stats = PlaylistSync(collection, int(options.get('workers') or 4)).sync(
+                    force=options.get('force'))
+            except Exception, e:
+                failures += 1
+                self.stderr.write('%s FAILED: %s' % (collection, e))
+                continue
+            stats['collection'] = collection
+            stats['elapsed'] = time.time() - start
+            self.stdout.write('%(collection)s: %(created)d created, %(updated)d updated, '
+                '%(unchanged)d unchanged, %(removed)d removed in %(elapsed).2fs' % stats)
+        if failures:
+            raise CommandError('%d playlists could not be synchronized' % failures)
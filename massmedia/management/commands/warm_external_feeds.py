@@ -0,0 +1,56 @@
+import time
+from multiprocessing.pool import ThreadPool
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from massmedia.caching import set_value
+from massmedia.models import Collection
+from massmedia.youtube import feed_cache_key, fetch_playlist_data, is_youtube_url
+
+
+def warm_feed(url):
+    """
+    Fetch a feed into the cache used by ``{% get_youtube_feed %}``.
+    Returns ``(url, seconds taken, exception or None)``.
+    """
+    start = time.time()
+    try:
+        set_value(feed_cache_key(url), fetch_playlist_data(url))
+    except Exception, e:
+        return url, time.time() - start, e
+    return url, time.time() - start, None
+
+
+class Command(BaseCommand):
+    help = 'Fetch the feeds of all collections with an external URL into the cache'
+    option_list = BaseCommand.option_list + (
+        make_option('-w', '--workers', dest='workers', default='4',
+            help='Number of feeds to fetch at the same time'
+        ),
+    )
+
+    def handle(self, *args, **options):
+        urls = Collection.objects.exclude(external_url='').values_list(
+            'external_url', flat=True).distinct()
+        urls = [url for url in urls if is_youtube_url(url)]
+        if not urls:
+            self.stdout.write('No external feeds to warm')
+            return
+
+        start = time.time()
+        failures = 0
+        pool = ThreadPool(min(int(options.get('workers') or 4), len(urls)))
+        try:
+            for url, elapsed, error in pool.imap_unordered(warm_feed, urls):
+                if error is None:
+                    self.stdout.write('%6.2fs  %s' % (elapsed, url))
+                else:
+                    failures += 1
+                    self.stderr.write('%6.2fs  %s FAILED: %s' % (elapsed, url, error))
+        finally:
+            pool.close()
+        self.stdout.write('Warmed %d of %d feeds in %.2fs' % (
+            len(urls) - failures, len(urls), time.time() - start))
+        if failures:
+            raise CommandError('%d feeds could not be fetched' % failures)
@@ -0,0 +1,131 @@
+"""
+A single table listing the media of every type.
+
+Each media object has a ``MediaIndex`` row with what lists and links need:
+its type, slug, title, creation date, site, whether it is public and the URL
+of its thumbnail. ``post_save`` and ``post_delete`` signals keep the rows up
+to date, so "all media, newest first" is one indexed query instead of one
+per media type, and a slug can be found without knowing its type.
+"""
+from django.contrib.contenttypes.models import ContentType
+from django.db import IntegrityError, transaction
+
+from massmedia.search import terms
+from massmedia.utils import connect_media_signals
+
+
+def thumb_url(obj):
+    """
+    The URL of the thumbnail of an image, or of a video's image, or ``''``
+    """
+    from massmedia.models import Image, Video
+    if isinstance(obj, Video):
+        try:
+            obj = obj.thumbnail
+        except Image.DoesNotExist:
+            return ''
+    if isinstance(obj, Image) and obj.thumbnail:
+        try:
+            return obj.thumbnail.url
+        except ValueError:
+            pass
+    return ''
+
+
+def entry_values(obj):
+    return {
+        'slug': obj.slug,
+        'title': obj.title,
+        'creation_date': obj.creation_date,
+        'public': obj.public,
+        'site_id': obj.site_id,
+        'thumb_url': thumb_url(obj),
+    }
+
+
+def index_object(obj):
+    from massmedia.models import Image, MediaIndex, Video
+    ctype = ContentType.objects.get_for_model(obj)
+    entries = MediaIndex._base_manager.filter(content_type=ctype, object_id=obj.pk)
+    values = entry_values(obj)
+    # update() wants the name of the site field rather than its column
+    changes = dict(values)
+    changes['site'] = changes.pop('site_id')
+    if not entries.update(**changes):
+        try:
+            with transaction.atomic():
+                MediaIndex._base_manager.create(content_type=ctype, object_id=obj.pk, **values)
+        except IntegrityError:  # Created by another process in the meantime
+            entries.update(**changes)
+    if isinstance(obj, Image):
+        # The videos using it show its thumbnail
+        MediaIndex._base_manager.filter(
+            content_type=ContentType.objects.get_for_model(Video),
+            object_id__in=Video._base_manager.filter(thumbnail=obj).values('pk'),
+        ).update(thumb_url=values['thumb_url'])
+
+
+def remove_object(obj):
+    from massmedia.models import MediaIndex
+    MediaIndex._base_manager.filter(
+        content_type=ContentType.objects.get_for_model(obj), object_id=obj.pk).delete()
+
+
+def rebuild(model, batch_size=500):
+    """
+    Replace the entries of ``model`` with ones made from its objects.
+    Returns how many there are.
+    """
+    from massmedia.models import MediaIndex, Video
+    ctype = ContentType.objects.get_for_model(model)
+    objects = model._base_manager.order_by('pk')
+    if model is Video:
+        objects = objects.select_related('thumbnail')
+    count = 0
+    last_pk = 0
+    with transaction.atomic():
+        MediaIndex._base_manager.filter(content_type=ctype).delete()
+        # Walk the table by primary key so each batch is a cheap query
+        while True:
+            batch = list(objects.filter(pk__gt=last_pk)[:batch_size])
+            if not batch:
+                break
+            MediaIndex._base_manager.bulk_create([
+                MediaIndex(content_type=ctype, object_id=obj.pk, **entry_values(obj))
+                for obj in batch])
+            count += len(batch)
+            last_pk = batch[-1].pk
+    return count
+
+
+def find(query, queryset=None):
+    """
+    The entries whose titles contain every word of ``query``, public ones
+    of the current site unless another ``queryset`` is given
+    """
+    from massmedia.models import MediaIndex
+    if queryset is None:
+        queryset = MediaIndex.objects.public()
+    for word in terms(query):
+        queryset = queryset.filter(title__icontains=word)
+    return queryset
+
+
+def resolve(slug, queryset=None):
+    """
+    The entry of the public media with ``slug`` on the current site, of
+    whichever type; the newest if several types use the slug. ``None`` when
+    there is none.
+    """
+    from massmedia.models import MediaIndex
+    if queryset is None:
+        queryset = MediaIndex.objects.public()
+    entries = list(queryset.filter(slug=slug)[:1])
+    return entries[0] if entries else None
+
+
+def connect_signals(*models):
+    """
+    Keep the rows up to date as objects of ``models`` are saved and deleted
+    """
+    connect_media_signals(models, index_object, remove_object)
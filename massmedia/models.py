@@ -1,4 +1,5 @@
 import os
+import sys
 import zipfile
 try:
     from cStringIO import StringIO
@@ -15,16 +16,19 @@ from django.db import models
 from django.template.defaultfilters import slugify
 from django.template.loader import get_template
 from django.template import Template
+from django.utils import timezone
 from django.utils.translation import ugettext as _
 
 from .settings import (IMAGE_STORAGE, VIDEO_STORAGE, AUDIO_STORAGE,
     FLASH_STORAGE, DOC_STORAGE, IMAGE_UPLOAD_TO, THUMB_UPLOAD_TO, THUMB_SIZE,
     VIDEO_UPLOAD_TO, DOC_UPLOAD_TO, AUDIO_UPLOAD_TO, FLASH_UPLOAD_TO,
-    IMAGE_EXTS, VIDEO_EXTS, AUDIO_EXTS, FLASH_EXTS, DOC_EXTS)
+    IMAGE_EXTS, VIDEO_EXTS, AUDIO_EXTS, FLASH_EXTS, DOC_EXTS,
+    DEFER_EXTERNAL_FETCH, SEARCH_INDEX, MEDIA_INDEX, DERIVATIVES, AUTOCOMPLETE)
 
 
 from base_models import Media, PublicMediaManager
-from massmedia.utils import custom_upload_to
+from massmedia import encoder
+from massmedia.utils import custom_upload_to, defer
 
 try:
     from iptcinfo import IPTCInfo
@@ -55,7 +59,7 @@ class Image(Media):
         null=True,
         storage=IMAGE_STORAGE())
     thumbnail = models.ImageField(
-        upload_to=custom_upload_to(THUMB_UPLOAD_TO),
+        upload_to=custom_upload_to(THUMB_UPLOAD_TO, replace_suffix=True),
         blank=True,
         null=True,
         width_field='thumb_width',
@@ -64,6 +68,7 @@ class Image(Media):
         storage=IMAGE_STORAGE())
     thumb_width = models.IntegerField(blank=True, null=True, editable=False)
     thumb_height = models.IntegerField(blank=True, null=True, editable=False)
+    thumb_quality = models.PositiveSmallIntegerField(blank=True, null=True, editable=False)
     original = models.ForeignKey(
         'self',
         related_name="variations",
@@ -73,36 +78,38 @@ class Image(Media):
         generate_thumb = self.id is None
         super(Image, self).save(*args, **kwargs)
         if generate_thumb:
-            self._generate_thumbnail()
+            self._generate_derivatives()
 
-    def _generate_thumbnail(self):
+    def _generate_derivatives(self):
         """
+        Make the thumbnail and the ``DERIVATIVES`` of the image, decoding the
+        original only once.
+
         Be aware that this function handle very badly remote backends such as
         s3. You can add in your save() method something like::
 
             if 's3boto' in settings.DEFAULT_FILE_STORAGE:
                 self.external_url = self.image.file.url
+
+        With a ``THUMB_BYTES`` budget, the JPEG quality chosen for it is kept
+        in ``thumb_quality`` and reused when the thumbnail is made again.
         """
-        image = None
+        from massmedia import derivatives, mogrify
         if self.external_url:
             import urllib
             filepath, headers = urllib.urlretrieve(self.external_url)
-            image = PilImage.open(filepath)
-            filename = os.path.basename(filepath)
+            # Variants are made from the stored file, and there isn't one
+            variants = ()
         elif self.file:
-            image = PilImage.open(self.file.path)
-            filename = os.path.basename(self.file.name)
-        if image is None:
+            filepath = self.file.path
+            variants = DERIVATIVES
+        else:
             return
-        if image.mode not in ('L', 'RGB'):
-            image = image.convert('RGB')
-        image.thumbnail(THUMB_SIZE, PilImage.ANTIALIAS)
-
-        destination = StringIO()
-        image.save(destination, format='JPEG')
-        destination.seek(0)
+        thumb = derivatives.Target(*THUMB_SIZE)
+        names, copies = mogrify.generate_variants(self, variants, [thumb], filepath)
 
-        self.thumbnail.save(filename, ContentFile(destination.read()))
+        data, self.thumb_quality = encoder.encode(copies[thumb], quality=self.thumb_quality)
+        self.thumbnail.save(os.path.basename(filepath), ContentFile(data))
 
     def smart_fit(self, width=20000, height=20000):
         """
@@ -169,7 +176,7 @@ class Embed(Media):
     def media_url(self):
         return self.external_url
 
-    def get_template(self, template_type):
+    def get_template(self, template_type="detail"):
         return get_template('massmedia/embed.html')
 
 
@@ -213,7 +220,7 @@ class Audio(Media):
         blank=True, null=True,
         storage=AUDIO_STORAGE())
 
-    class Meta:
+    class Meta(Media.Meta):
         verbose_name = _("audio clip")
         verbose_name_plural = _("audio clips")
 
@@ -231,7 +238,7 @@ class Flash(Media):
         blank=True, null=True,
         storage=FLASH_STORAGE())
 
-    class Meta:
+    class Meta(Media.Meta):
         verbose_name = _("SWF File")
         verbose_name_plural = _("SWF Files")
 
@@ -250,7 +257,7 @@ class Document(Media):
         null=True,
         storage=DOC_STORAGE())
 
-    class Meta:
+    class Meta(Media.Meta):
         verbose_name = _("Document")
         verbose_name_plural = _("Documents")
 
@@ -276,11 +283,19 @@ for ext in DOC_EXTS:
     EXT_TO_MODEL_MAP[ext] = Document
 
 
+def is_image(filename):
+    """
+    Return True if the file name has one of the recognized image extensions
+    """
+    return os.path.splitext(filename)[1][1:].lower() in IMAGE_EXTS
+
+
 class Collection(models.Model):
     """
     An arbitrary collection of massmedia items
     """
     creation_date = models.DateTimeField(auto_now_add=True)
+    modified = models.DateTimeField(auto_now=True, db_index=True)
     title = models.CharField(max_length=255)
     caption = models.TextField(blank=True)
     zip_file = models.FileField(
@@ -301,37 +316,59 @@ class Collection(models.Model):
     class Meta:
         ordering = ['-creation_date']
         get_latest_by = 'creation_date'
+        index_together = [('site', 'public', 'creation_date')]
 
     def __unicode__(self):
         return self.title
 
+    def __init__(self, *args, **kwargs):
+        super(Collection, self).__init__(*args, **kwargs)
+        # Remember the saved URL so the feed is only fetched when it changes.
+        # Read from __dict__ so a deferred field isn't loaded just for this.
+        self._saved_external_url = self.__dict__.get('external_url')
+
     def save(self, *args, **kwargs):
         if self.site_id is None:
             self.site = Site.objects.get_current()
-        if self.external_url:
-            self.process_external_url()
+        external_url_changed = (self._state.adding or
+                                self.external_url != self._saved_external_url)
         super(Collection, self).save(*args, **kwargs)
         self.process_zipfile()
         super(Collection, self).save(*(), **{})
+        self._saved_external_url = self.external_url
+        if self.external_url and external_url_changed:
+            if DEFER_EXTERNAL_FETCH:
+                defer(fetch_external_url, self.pk)
+            else:
+                self.process_external_url()
 
     def process_external_url(self):
         """
-        Handle an external reference
+        Handle an external reference: fetch the feed, prime the cache the
+        templates read it from, and fill in a blank title or caption.
+
+        This makes a network call, so ``save`` only runs it when the URL has
+        changed, and by default as a deferred job.
         """
         # Get host for proper handling
         # Route to proper handler
-        from urlparse import urlparse
-        from youtube import YouTubeFeed
-        url_struct = urlparse(self.external_url)
-        if 'youtube' not in url_struct.hostname:
+        from youtube import YouTubeFeed, feed_cache_key, is_youtube_url
+        from caching import set_value
+        if not is_youtube_url(self.external_url):
             return
         feed = YouTubeFeed(self.external_url)
-        if feed:
-            if not self.title:
-                self.title = feed.metadata['title']
-            self.slug = slugify(self.title)
-            if not self.caption:
-                self.caption = feed.metadata['subtitle']
+        set_value(feed_cache_key(self.external_url), feed.playlist.data)
+        changes = {}
+        if not self.title:
+            changes['title'] = feed.metadata.get('title', '')
+        if not self.caption:
+            changes['caption'] = feed.metadata.get('subtitle', '')
+        for key, val in changes.items():
+            setattr(self, key, val)
+        if changes and self.pk:
+            # update() rather than save(), which would queue another fetch
+            self.modified = changes['modified'] = timezone.now()
+            Collection.objects.filter(pk=self.pk).update(**changes)
 
     def process_zipfile(self):
         """
@@ -395,6 +432,15 @@ class Collection(models.Model):
         except ValueError:
             pass
 
+
+def fetch_external_url(pk):
+    """
+    The deferred ``process_external_url`` of the collection ``pk``, on a
+    copy loaded by the job rather than the instance the request saved
+    """
+    for collection in Collection._base_manager.filter(pk=pk):
+        collection.process_external_url()
+
 COLLECTION_LIMITS = {
     'model__in': ('image', 'audio', 'video', 'document', 'flash', )
 }
@@ -418,11 +464,22 @@ class CollectionRelation(models.Model):
 
     class Meta:
         ordering = ['position', 'id']
+        index_together = [('collection', 'position', 'id')]
 
     def __unicode__(self):
         return self.collection.__unicode__() + u"'s " + unicode(self.content_object)
 
 
+def touch_collection(sender, instance, **kwargs):
+    """
+    Mark a collection modified when its contents change
+    """
+    Collection.objects.filter(pk=instance.collection_id).update(modified=timezone.now())
+
+models.signals.post_save.connect(touch_collection, sender=CollectionRelation)
+models.signals.post_delete.connect(touch_collection, sender=CollectionRelation)
+
+
 class MediaTemplate(models.Model):
     """
     Templates to display media, stored in the database
@@ -445,3 +502,80 @@ class MediaTemplate(models.Model):
         Return a Django Template object from the content of the record
         """
         return Template(self.content)
+
+
+class MediaChange(models.Model):
+    """
+    A log of saved and deleted media titles, read by each process's
+    autocomplete index to catch up with changes made by other processes
+    """
+    SAVE, DELETE = 's', 'd'
+
+    content_type = models.ForeignKey(ContentType)
+    object_id = models.PositiveIntegerField()
+    title = models.CharField(max_length=255, blank=True)
+    action = models.CharField(
+        max_length=1,
+        choices=((SAVE, _('Saved')), (DELETE, _('Deleted'))))
+    created = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        ordering = ['id']
+
+    def __unicode__(self):
+        return u"%s %s #%s" % (self.get_action_display(), self.content_type, self.object_id)
+
+
+class MediaIndex(models.Model):
+    """
+    One row for each media object of every type, kept up to date by
+    signals, to list, search and find media without knowing their type
+    """
+    content_type = models.ForeignKey(ContentType)
+    object_id = models.PositiveIntegerField()
+    content_object = generic.GenericForeignKey('content_type', 'object_id')
+    slug = models.SlugField()
+    title = models.CharField(max_length=255)
+    creation_date = models.DateTimeField()
+    public = models.BooleanField(default=True)
+    site = models.ForeignKey(Site)
+    thumb_url = models.CharField(max_length=255, blank=True)
+
+    objects = PublicMediaManager()
+
+    class Meta:
+        ordering = ('-creation_date',)
+        unique_together = [('content_type', 'object_id')]
+        index_together = [('site', 'public', 'creation_date')]
+        verbose_name_plural = _("media index")
+
+    def __unicode__(self):
+        return u"%s: %s" % (self.mediatype, self.title)
+
+    @property
+    def mediatype(self):
+        return ContentType.objects.get_for_id(self.content_type_id).model
+
+    @models.permalink
+    def get_absolute_url(self):
+        return ('massmedia_detail', (), {
+            'mediatype': self.mediatype,
+            'slug': self.slug
+        })
+
+
+SEARCH_MODELS = (Image, Video, Audio, Flash, Document, Embed)
+
+if SEARCH_INDEX:
+    from django.db.models.signals import post_syncdb
+    from massmedia import search
+    search.connect_signals(*SEARCH_MODELS)
+    post_syncdb.connect(search.create_index_table, sender=sys.modules[__name__])
+
+if AUTOCOMPLETE:
+    from massmedia import autocomplete
+    autocomplete.connect_signals(*SEARCH_MODELS)
+
+if MEDIA_INDEX:
+    from massmedia import mediaindex
+    mediaindex.connect_signals(*SEARCH_MODELS)
@@ -0,0 +1,262 @@
+"""
+Resized copies of images, made on request.
+
+A variant is named by a spec such as ``200x100``, ``200x`` or
+``200x100-crop`` and a format, and its URL carries an HMAC of both made with
+``MOGRIFY_KEY``, so only the variants the site links to can be requested.
+The first request makes the variant from the original and saves it in the
+image storage under ``MOGRIFY_UPLOAD_TO``; later ones are served from there.
+
+With the ``auto`` format the variant is encoded as AVIF or WebP for clients
+whose ``Accept`` header asks for them, when Pillow has the codec, and as
+JPEG or PNG otherwise. Each format is stored as a variant of its own.
+"""
+import hashlib
+import hmac
+import re
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+from django.core.files.base import ContentFile
+from django.core.urlresolvers import reverse
+from django.http import Http404, HttpResponse, HttpResponseForbidden, StreamingHttpResponse
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.crypto import constant_time_compare
+
+from massmedia import derivatives
+from massmedia.conditional import (add_cache_headers, etag_for, not_modified,
+    object_validators)
+from massmedia.locks import LockTimeout, single_flight
+from massmedia.models import Image
+from massmedia.settings import LOCK_WAIT, MOGRIFY_KEY, MOGRIFY_UPLOAD_TO
+from massmedia.streaming import file_iterator
+
+try:
+    import Image as PilImage
+except ImportError:
+    from PIL import Image as PilImage
+
+# URL extensions and the PIL formats they are saved in
+FORMATS = {
+    'jpg': 'JPEG',
+    'png': 'PNG',
+    'gif': 'GIF',
+}
+CONTENT_TYPES = {
+    'JPEG': 'image/jpeg',
+    'PNG': 'image/png',
+    'GIF': 'image/gif',
+    'WEBP': 'image/webp',
+    'AVIF': 'image/avif',
+}
+QUALITY = {
+    'JPEG': 85,
+    'WEBP': 80,
+    'AVIF': 60,
+}
+
+# The formats ``auto`` may choose for clients that accept them, best first
+PilImage.init()
+MODERN_FORMATS = [(ext, format) for ext, format in (('avif', 'AVIF'), ('webp', 'WEBP'))
+                  if format in PilImage.SAVE]
+FORMATS.update(MODERN_FORMATS)
+AUTO = 'auto'
+
+SPEC_RE = re.compile(r'^(\d*)x(\d*)(-crop)?$')
+
+
+def make_spec(width=None, height=None, crop=False):
+    spec = '%sx%s' % (width or '', height or '')
+    if crop:
+        spec += '-crop'
+    return spec
+
+
+def parse_spec(spec):
+    """
+    ``(width, height, crop)`` for a spec, ``None`` for a missing dimension
+    """
+    match = SPEC_RE.match(spec)
+    if not match or match.groups()[:2] == ('', ''):
+        raise ValueError('Invalid spec %r' % spec)
+    width, height, crop = match.groups()
+    return int(width) if width else None, int(height) if height else None, bool(crop)
+
+
+def sign(image_id, spec, ext):
+    return hmac.new(str(MOGRIFY_KEY), '%s/%s.%s' % (image_id, spec, ext),
+                    hashlib.sha1).hexdigest()[:20]
+
+
+def mogrify_url(image, width=None, height=None, crop=False, ext=AUTO):
+    """
+    The signed URL of a variant of ``image``, an ``Image`` or its id
+    """
+    image_id = getattr(image, 'pk', image)
+    spec = make_spec(width, height, crop)
+    return reverse('massmedia_mogrify', kwargs={
+        'image_id': image_id, 'spec': spec, 'ext': ext,
+        'signature': sign(image_id, spec, ext)})
+
+
+def variant_name(image, spec, ext):
+    """
+    The storage name of a variant. It includes a digest of the original's
+    name, so replacing the original's file makes new variants.
+    """
+    version = hashlib.md5(image.file.name.encode('utf-8')).hexdigest()[:8]
+    return '%s/%s/%s/%s.%s' % (MOGRIFY_UPLOAD_TO.rstrip('/'), image.pk, version, spec, ext)
+
+
+def accepted_types(accept):
+    """
+    The media types of an ``Accept`` header and their quality values
+    """
+    types = {}
+    for item in (accept or '').split(','):
+        params = item.strip().split(';')
+        q = 1.0
+        for param in params[1:]:
+            name, _, value = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        types[params[0].strip().lower()] = q
+    return types
+
+
+def negotiate(accept):
+    """
+    The extension of the best modern format named in ``accept``, or ``None``.
+    Only explicit types count: browsers that decode AVIF or WebP say so.
+    """
+    types = accepted_types(accept)
+    for ext, format in MODERN_FORMATS:
+        if types.get(CONTENT_TYPES[format], 0) > 0:
+            return ext
+    return None
+
+
+def fallback_ext(image):
+    """
+    The classic format for clients without a modern one: PNG for images that
+    may have transparency, JPEG for the rest
+    """
+    if image.file.name.lower().rsplit('.', 1)[-1] in ('png', 'gif'):
+        return 'png'
+    return 'jpg'
+
+
+def encode(im, format):
+    if format == 'JPEG' and im.mode not in ('L', 'RGB'):
+        im = im.convert('RGB')
+    elif format == 'GIF' and im.mode not in ('L', 'P'):
+        im = im.convert('P', palette=PilImage.ADAPTIVE)
+    elif format in ('WEBP', 'AVIF') and im.mode not in ('RGB', 'RGBA'):
+        im = im.convert('RGBA' if im.mode in ('LA', 'P', 'PA') else 'RGB')
+    out = StringIO()
+    im.save(out, format=format, quality=QUALITY.get(format, 85), optimize=True)
+    return out.getvalue()
+
+
+def generate(image, spec, ext):
+    """
+    Make the variant and save it, returning its storage name
+    """
+    names, copies = generate_variants(image, [(spec, ext)])
+    return names[(spec, ext)]
+
+
+def generate_variants(image, variants, targets=(), path=None):
+    """
+    Make and save several ``(spec, ext)`` variants of ``image``, and the
+    copies for other ``targets``, from a single decode of the original, or
+    of the file at ``path``.
+
+    Returns ``({(spec, ext): storage name}, {target: copy})``.
+    """
+    spec_targets = dict((spec, derivatives.Target(*parse_spec(spec))) for spec, ext in variants)
+    if path is None:
+        f = image.file.storage.open(image.file.name, 'rb')
+    else:
+        f = open(path, 'rb')
+    try:
+        copies = derivatives.make(f, spec_targets.values() + list(targets))
+    finally:
+        f.close()
+    names = {}
+    for spec, ext in variants:
+        data = encode(copies[spec_targets[spec]], FORMATS[ext])
+        names[(spec, ext)] = image.file.storage.save(variant_name(image, spec, ext),
+                                                     ContentFile(data))
+    return names, dict((target, copies[target]) for target in targets)
+
+
+def get_variant(image, spec, ext):
+    """
+    The storage name of the variant, made if it doesn't exist yet. Only one
+    process makes it; the others wait for it, or get ``LockTimeout``.
+    """
+    name = variant_name(image, spec, ext)
+    return single_flight('massmedia.mogrify.%s' % name,
+                         lambda: image.file.storage.exists(name) and name,
+                         lambda: generate(image, spec, ext), wait=LOCK_WAIT)
+
+
+def mogrify(request, image_id, spec, ext, signature):
+    """
+    A variant of a public image, when the URL's signature is right
+    """
+    if ext not in FORMATS and ext != AUTO:
+        raise Http404
+    if not constant_time_compare(signature, sign(image_id, spec, ext)):
+        return HttpResponseForbidden('Bad signature')
+    try:
+        parse_spec(spec)
+    except ValueError:
+        raise Http404
+    queryset = Image.objects.public().filter(pk=image_id)
+    last_modified, etag = object_validators(queryset)
+    negotiated = ext == AUTO
+    if negotiated:
+        modern_ext = negotiate(request.META.get('HTTP_ACCEPT'))
+        if etag:
+            etag = etag_for(etag, modern_ext)
+    response = not_modified(request, last_modified, etag)
+    if response is None:
+        try:
+            image = queryset.only('file', 'modified').get()
+        except Image.DoesNotExist:
+            raise Http404
+        if not image.file:
+            raise Http404
+        if negotiated:
+            ext = modern_ext or fallback_ext(image)
+        try:
+            response = serve_variant(request, image, spec, ext)
+        except LockTimeout:
+            # Still being made by another process
+            response = HttpResponse('Try again shortly', status=503, content_type='text/plain')
+            response['Retry-After'] = '1'
+            patch_cache_control(response, no_cache=True)
+            return response
+    if negotiated:
+        patch_vary_headers(response, ('Accept', ))
+    return add_cache_headers(response, last_modified, etag)
+
+
+def serve_variant(request, image, spec, ext):
+    name = get_variant(image, spec, ext)
+    storage = image.file.storage
+    content_type = CONTENT_TYPES[FORMATS[ext]]
+    if request.method == 'HEAD':
+        response = HttpResponse(content_type=content_type)
+    else:
+        response = StreamingHttpResponse(file_iterator(storage.open(name, 'rb')),
+                                         content_type=content_type)
+    response['Content-Length'] = str(storage.size(name))
+    return response
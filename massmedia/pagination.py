@@ -0,0 +1,157 @@
+"""
+Keyset pagination for the media lists.
+
+``OFFSET`` pagination makes the database read and throw away every row
+before the page, and counts the whole list for the page numbers, so deep
+pages of a large archive get slow. A keyset page instead starts after the
+last object of the previous one: newest first on ``(creation_date, pk)``,
+which the listing indexes give in order. The position is passed in an
+opaque ``cursor`` parameter, and there are next and previous links but no
+page numbers. The list's size is only shown as a cached, approximate count.
+"""
+import base64
+import hashlib
+
+from django.core.cache import cache
+from django.db.models import Q
+from django.http import Http404
+from django.utils.dateparse import parse_datetime
+from django.utils.encoding import force_bytes
+from django.views.generic.list import ListView
+
+from massmedia.settings import COUNT_CACHE_TTL
+
+NEXT = 'n'
+PREVIOUS = 'p'
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(direction, value, pk):
+    data = '%s%s|%s' % (direction, value.isoformat(), pk)
+    return base64.urlsafe_b64encode(data).rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    ``(direction, value, pk)`` from a cursor made by ``encode_cursor``
+    """
+    try:
+        data = base64.urlsafe_b64decode(str(cursor) + '=' * (-len(cursor) % 4))
+        value, pk = data[1:].split('|')
+        value, pk = parse_datetime(value), int(pk)
+    except (TypeError, ValueError, UnicodeError):
+        raise InvalidCursor(cursor)
+    if data[0] not in (NEXT, PREVIOUS) or value is None:
+        raise InvalidCursor(cursor)
+    return data[0], value, pk
+
+
+def approximate_count(queryset, ttl=COUNT_CACHE_TTL):
+    """
+    The number of objects in ``queryset``, counted at most once every
+    ``ttl`` seconds
+    """
+    key = 'massmedia.count.%s' % hashlib.md5(force_bytes(unicode(queryset.query))).hexdigest()
+    count = cache.get(key)
+    if count is None:
+        count = queryset.count()
+        cache.set(key, count, ttl)
+    return count
+
+
+class KeysetPage(object):
+    def __init__(self, object_list, paginator, next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.paginator = paginator
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __repr__(self):
+        return '<Keyset page of %d>' % len(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+
+class KeysetPaginator(object):
+    """
+    Pages of ``per_page`` objects of ``queryset``, newest ``field`` first
+    """
+    def __init__(self, queryset, per_page, field='creation_date'):
+        self.queryset = queryset
+        self.per_page = int(per_page)
+        self.field = field
+
+    @property
+    def count(self):
+        return approximate_count(self.queryset)
+
+    def cursor(self, direction, obj):
+        return encode_cursor(direction, getattr(obj, self.field), obj.pk)
+
+    def seek(self, cursor=None):
+        """
+        ``(direction, queryset)``: the objects after (or before, for a
+        previous cursor) the object the cursor was made from, nearest first
+        """
+        field = self.field
+        queryset = self.queryset.order_by('-%s' % field, '-pk')
+        if not cursor:
+            return NEXT, queryset
+        direction, value, pk = decode_cursor(cursor)
+        # The bound on field alone lets the database seek in its index
+        if direction == NEXT:
+            return direction, queryset.filter(
+                Q(**{'%s__lt' % field: value}) | Q(**{field: value, 'pk__lt': pk}),
+                **{'%s__lte' % field: value})
+        return direction, queryset.filter(
+            Q(**{'%s__gt' % field: value}) | Q(**{field: value, 'pk__gt': pk}),
+            **{'%s__gte' % field: value}).order_by(field, 'pk')
+
+    def page(self, cursor=None):
+        """
+        The page a cursor leads to; the first page without one
+        """
+        direction, queryset = self.seek(cursor)
+        object_list = list(queryset[:self.per_page + 1])
+        more = len(object_list) > self.per_page
+        object_list = object_list[:self.per_page]
+        if direction == PREVIOUS:
+            object_list.reverse()
+            has_next, has_previous = True, more
+        else:
+            has_next, has_previous = more, bool(cursor)
+        if not object_list:
+            return KeysetPage(object_list, self)
+        return KeysetPage(
+            object_list, self,
+            next_cursor=self.cursor(NEXT, object_list[-1]) if has_next else None,
+            previous_cursor=self.cursor(PREVIOUS, object_list[0]) if has_previous else None)
+
+
+class KeysetListView(ListView):
+    """
+    A ``ListView`` paginated with a ``cursor`` parameter instead of ``page``
+    """
+    def paginate_queryset(self, queryset, page_size):
+        paginator = KeysetPaginator(queryset, page_size)
+        try:
+            page = paginator.page(self.request.GET.get('cursor'))
+        except InvalidCursor:
+            raise Http404('Invalid cursor')
+        return (paginator, page, page.object_list, page.has_other_pages())
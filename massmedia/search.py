@@ -0,0 +1,364 @@
+"""
+Full-text search over the title, caption, author, keywords and selected
+metadata of media objects.
+
+The index is one table with a document per media object, kept up to date by
+``post_save`` and ``post_delete`` signals. How it is stored and ranked
+depends on the database: an FTS5 table ranked with bm25 on SQLite, a
+weighted ``tsvector`` ranked with ``ts_rank`` on PostgreSQL, and a plain
+table searched with ``LIKE`` anywhere else.
+"""
+import re
+from collections import namedtuple
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection
+
+from massmedia.fields import Metadata
+from massmedia.utils import connect_media_signals
+from massmedia.settings import (SEARCH_BACKEND, SEARCH_CONFIG, SEARCH_LIMIT,
+    SEARCH_METADATA_FIELDS)
+
+TABLE = 'massmedia_search'
+
+# IPTC keywords (25), supplemental categories (20) and category (15), and
+# the tags of imported videos
+KEYWORD_FIELDS = ('25', '20', '15', 'keywords', 'categories')
+
+# The indexed columns, their weight and their PostgreSQL weight label
+COLUMNS = (
+    ('title', 10.0, 'A'),
+    ('keywords', 6.0, 'B'),
+    ('author', 4.0, 'C'),
+    ('caption', 2.0, 'C'),
+    ('metadata', 1.0, 'D'),
+)
+COLUMN_NAMES = [name for name, weight, label in COLUMNS]
+
+SearchResult = namedtuple('SearchResult', 'content_type_id object_id rank')
+
+
+def _text(value):
+    if value is None:
+        return u''
+    if isinstance(value, (list, tuple)):
+        return u' '.join(_text(v) for v in value)
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    return unicode(value)
+
+
+def document(obj):
+    """
+    The text indexed for ``obj``, by column
+    """
+    metadata = obj.metadata if isinstance(obj.metadata, Metadata) else Metadata()
+    return {
+        'title': _text(obj.title),
+        'caption': _text(obj.caption),
+        'author': _text(obj.author_name),
+        'keywords': u' '.join(_text(metadata[key]) for key in KEYWORD_FIELDS),
+        'metadata': u' '.join(_text(metadata[key]) for key in SEARCH_METADATA_FIELDS),
+    }
+
+
+def terms(query):
+    """
+    Split a search query into lower case words
+    """
+    return re.findall(r'\w+', _text(query).lower(), re.UNICODE)
+
+
+class SearchBackend(object):
+    """
+    Stores and queries the index table. Subclasses implement it for a
+    database.
+    """
+    table = TABLE
+
+    def create_table(self, cursor):
+        raise NotImplementedError
+
+    def remove(self, cursor, content_type_id, object_id):
+        cursor.execute('DELETE FROM %s WHERE content_type_id = %%s AND object_id = %%s' % self.table,
+                       [content_type_id, object_id])
+
+    def index(self, cursor, content_type_id, obj, doc):
+        raise NotImplementedError
+
+    def search(self, cursor, words, content_type_ids=None, public=None, site_id=None,
+               limit=SEARCH_LIMIT):
+        """
+        Return ``SearchResult``\ s for the documents containing all of
+        ``words``, best match first
+        """
+        raise NotImplementedError
+
+    def matching(self, words, content_type_ids=None):
+        """
+        SQL selecting the object ids of the documents containing all of
+        ``words``, unranked and unlimited, and its parameters
+        """
+        raise NotImplementedError
+
+    def filters(self, content_type_ids=None, public=None, site_id=None):
+        """
+        SQL conditions and their parameters restricting the documents searched
+        """
+        where, params = [], []
+        if content_type_ids:
+            where.append('content_type_id IN (%s)' % ', '.join(['%s'] * len(content_type_ids)))
+            params.extend(content_type_ids)
+        if public is not None:
+            where.append('public = %s')
+            params.append(int(public))
+        if site_id is not None:
+            where.append('site_id = %s')
+            params.append(site_id)
+        return where, params
+
+
+class FTS5Backend(SearchBackend):
+    """
+    An SQLite FTS5 table, ranked with bm25. The rowid is derived from the
+    content type and object id so a document can be replaced without a scan.
+    """
+    def rowid(self, content_type_id, object_id):
+        return (content_type_id << 32) + object_id
+
+    def create_table(self, cursor):
+        cursor.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts5(content_type_id UNINDEXED, "
+            "object_id UNINDEXED, site_id UNINDEXED, public UNINDEXED, %s, "
+            "tokenize='porter unicode61')" % (self.table, ', '.join(COLUMN_NAMES)))
+
+    def remove(self, cursor, content_type_id, object_id):
+        cursor.execute('DELETE FROM %s WHERE rowid = %%s' % self.table,
+                       [self.rowid(content_type_id, object_id)])
+
+    def index(self, cursor, content_type_id, obj, doc):
+        self.remove(cursor, content_type_id, obj.pk)
+        cursor.execute(
+            'INSERT INTO %s (rowid, content_type_id, object_id, site_id, public, %s) '
+            'VALUES (%s)' % (self.table, ', '.join(COLUMN_NAMES), ', '.join(['%s'] * (5 + len(COLUMNS)))),
+            [self.rowid(content_type_id, obj.pk), content_type_id, obj.pk, obj.site_id,
+             int(obj.public)] + [doc[name] for name in COLUMN_NAMES])
+
+    def search(self, cursor, words, content_type_ids=None, public=None, site_id=None,
+               limit=SEARCH_LIMIT):
+        where, params = self.filters(content_type_ids, public, site_id)
+        match = ' '.join('"%s"' % word.replace('"', '""') for word in words)
+        weights = ', '.join(['0'] * 4 + [str(weight) for name, weight, label in COLUMNS])
+        cursor.execute(
+            'SELECT content_type_id, object_id, bm25(%s, %s) AS rank FROM %s '
+            'WHERE %s MATCH %%s %s ORDER BY rank LIMIT %%s' % (
+                self.table, weights, self.table, self.table, ''.join(' AND %s' % w for w in where)),
+            [match] + params + [limit])
+        # bm25 scores are negative, lower being better
+        return [SearchResult(int(ct), int(pk), -rank) for ct, pk, rank in cursor.fetchall()]
+
+    def matching(self, words, content_type_ids=None):
+        where, params = self.filters(content_type_ids)
+        match = ' '.join('"%s"' % word.replace('"', '""') for word in words)
+        return ('SELECT object_id FROM %s WHERE %s MATCH %%s %s' % (
+            self.table, self.table, ''.join(' AND %s' % w for w in where)), [match] + params)
+
+
+class PostgresBackend(SearchBackend):
+    """
+    A table with a weighted ``tsvector`` and a GIN index, ranked with ``ts_rank``
+    """
+    def create_table(self, cursor):
+        cursor.execute(
+            'CREATE TABLE IF NOT EXISTS %s (content_type_id integer NOT NULL, '
+            'object_id integer NOT NULL, site_id integer, public boolean, document tsvector, '
+            'PRIMARY KEY (content_type_id, object_id))' % self.table)
+        cursor.execute('CREATE INDEX IF NOT EXISTS %s_document ON %s USING gin(document)' % (
+            self.table, self.table))
+
+    def filters(self, content_type_ids=None, public=None, site_id=None):
+        where, params = super(PostgresBackend, self).filters(content_type_ids, None, site_id)
+        if public is not None:
+            where.append('public = %s')
+            params.append(bool(public))
+        return where, params
+
+    def index(self, cursor, content_type_id, obj, doc):
+        self.remove(cursor, content_type_id, obj.pk)
+        vector = ' || '.join(["setweight(to_tsvector(%%s, %%s), '%s')" % label
+                              for name, weight, label in COLUMNS])
+        params = [content_type_id, obj.pk, obj.site_id, bool(obj.public)]
+        for name in COLUMN_NAMES:
+            params.extend([SEARCH_CONFIG, doc[name]])
+        cursor.execute(
+            'INSERT INTO %s (content_type_id, object_id, site_id, public, document) '
+            'VALUES (%%s, %%s, %%s, %%s, %s)' % (self.table, vector), params)
+
+    def search(self, cursor, words, content_type_ids=None, public=None, site_id=None,
+               limit=SEARCH_LIMIT):
+        where, params = self.filters(content_type_ids, public, site_id)
+        cursor.execute(
+            'SELECT content_type_id, object_id, ts_rank(document, query) AS rank '
+            'FROM %s, plainto_tsquery(%%s, %%s) query WHERE document @@ query %s '
+            'ORDER BY rank DESC LIMIT %%s' % (self.table, ''.join(' AND %s' % w for w in where)),
+            [SEARCH_CONFIG, ' '.join(words)] + params + [limit])
+        return [SearchResult(ct, pk, rank) for ct, pk, rank in cursor.fetchall()]
+
+    def matching(self, words, content_type_ids=None):
+        where, params = self.filters(content_type_ids)
+        return ('SELECT object_id FROM %s WHERE document @@ plainto_tsquery(%%s, %%s) %s' % (
+            self.table, ''.join(' AND %s' % w for w in where)),
+            [SEARCH_CONFIG, ' '.join(words)] + params)
+
+
+class SimpleBackend(SearchBackend):
+    """
+    A plain table for databases without full-text search. Every word must
+    appear in the lower cased document; matches are ranked in Python by the
+    weighted number of times the words appear in each column.
+    """
+    def create_table(self, cursor):
+        cursor.execute(
+            'CREATE TABLE IF NOT EXISTS %s (content_type_id integer NOT NULL, '
+            'object_id integer NOT NULL, site_id integer, public integer, %s, document text, '
+            'PRIMARY KEY (content_type_id, object_id))' % (
+                self.table, ', '.join('%s text' % name for name in COLUMN_NAMES)))
+
+    def index(self, cursor, content_type_id, obj, doc):
+        self.remove(cursor, content_type_id, obj.pk)
+        values = [doc[name].lower() for name in COLUMN_NAMES]
+        cursor.execute(
+            'INSERT INTO %s (content_type_id, object_id, site_id, public, %s, document) '
+            'VALUES (%s)' % (self.table, ', '.join(COLUMN_NAMES), ', '.join(['%s'] * (5 + len(COLUMNS)))),
+            [content_type_id, obj.pk, obj.site_id, int(obj.public)] + values + [u' '.join(values)])
+
+    def search(self, cursor, words, content_type_ids=None, public=None, site_id=None,
+               limit=SEARCH_LIMIT):
+        where, params = self.filters(content_type_ids, public, site_id)
+        where = ['document LIKE %s'] * len(words) + where
+        params = ['%%%s%%' % word for word in words] + params
+        cursor.execute('SELECT content_type_id, object_id, %s FROM %s WHERE %s' % (
+            ', '.join(COLUMN_NAMES), self.table, ' AND '.join(where)), params)
+        results = []
+        for row in cursor.fetchall():
+            rank = sum(weight * row[2 + i].count(word)
+                       for i, (name, weight, label) in enumerate(COLUMNS) for word in words)
+            results.append(SearchResult(row[0], row[1], rank))
+        results.sort(key=lambda r: r.rank, reverse=True)
+        return results[:limit]
+
+    def matching(self, words, content_type_ids=None):
+        where, params = self.filters(content_type_ids)
+        where = ['document LIKE %s'] * len(words) + where
+        params = ['%%%s%%' % word for word in words] + params
+        return 'SELECT object_id FROM %s WHERE %s' % (self.table, ' AND '.join(where)), params
+
+
+BACKENDS = {
+    'fts5': FTS5Backend,
+    'postgresql': PostgresBackend,
+    'simple': SimpleBackend,
+}
+_backend = None
+
+
+def has_fts5():
+    cursor = connection.cursor()
+    cursor.execute('PRAGMA compile_options')
+    return 'ENABLE_FTS5' in [row[0] for row in cursor.fetchall()]
+
+
+def get_backend():
+    """
+    The backend named by the ``SEARCH_BACKEND`` setting, or the best one for
+    the database
+    """
+    global _backend
+    if _backend is None:
+        name = SEARCH_BACKEND
+        if not name:
+            if connection.vendor == 'sqlite' and has_fts5():
+                name = 'fts5'
+            elif connection.vendor == 'postgresql':
+                name = 'postgresql'
+            else:
+                name = 'simple'
+        _backend = BACKENDS[name]()
+    return _backend
+
+
+def create_index():
+    get_backend().create_table(connection.cursor())
+
+
+def index_object(obj):
+    ctype = ContentType.objects.get_for_model(obj)
+    get_backend().index(connection.cursor(), ctype.pk, obj, document(obj))
+
+
+def remove_object(obj):
+    ctype = ContentType.objects.get_for_model(obj)
+    get_backend().remove(connection.cursor(), ctype.pk, obj.pk)
+
+
+def search(query, models=None, public=None, site=None, limit=SEARCH_LIMIT):
+    """
+    Return ``SearchResult``\ s for the objects matching every word of
+    ``query``, best match first. The search can be limited to some
+    ``models``, to public or private objects and to a ``site``.
+    """
+    words = terms(query)
+    if not words:
+        return []
+    content_type_ids = None
+    if models:
+        content_type_ids = [ContentType.objects.get_for_model(m).pk for m in models]
+    site_id = getattr(site, 'pk', site)
+    return get_backend().search(connection.cursor(), words, content_type_ids, public,
+                                site_id, limit)
+
+
+def filter_matching(queryset, query):
+    """
+    The objects of ``queryset`` matching every word of ``query``, as a
+    subquery of the index rather than a list of ids, so there is no limit
+    """
+    model = queryset.model
+    content_type_id = ContentType.objects.get_for_model(model).pk
+    sql, params = get_backend().matching(terms(query), [content_type_id])
+    qn = connection.ops.quote_name
+    return queryset.extra(where=['%s.%s IN (%s)' % (
+        qn(model._meta.db_table), qn(model._meta.pk.column), sql)], params=params)
+
+
+def search_objects(query, querysets, limit=SEARCH_LIMIT, **kwargs):
+    """
+    Return the objects of ``querysets`` matching ``query``, best match first,
+    each with its score in ``search_rank``. There is one query per model
+    with results.
+    """
+    querysets = dict((ContentType.objects.get_for_model(qs.model).pk, qs) for qs in querysets)
+    results = search(query, [qs.model for qs in querysets.values()], limit=limit, **kwargs)
+    ids = {}
+    for result in results:
+        ids.setdefault(result.content_type_id, []).append(result.object_id)
+    found = dict(((ctype_id, pk), obj) for ctype_id, pks in ids.items()
+                 for pk, obj in querysets[ctype_id].in_bulk(pks).items())
+    objects = []
+    for result in results:
+        obj = found.get((result.content_type_id, result.object_id))
+        if obj is not None:
+            obj.search_rank = result.rank
+            objects.append(obj)
+    return objects
+
+
+def create_index_table(sender, **kwargs):
+    create_index()
+
+
+def connect_signals(*models):
+    """
+    Keep the index up to date as objects of ``models`` are saved and deleted
+    """
+    connect_media_signals(models, index_object, remove_object)
@@ -14,10 +14,41 @@ DEFAULT_SETTINGS = {
     "DOC_EXTS": ('pdf', 'xls', 'doc'),
     "INFO_QUALITY": 1.0,  # Information quality for parsing metadata (0.0=fastest, 1.0=best, and default is 0.5)
     "THUMB_SIZE": (200, 200),  # Size of thumbnail to take for the admin preview
+    "DERIVATIVES": (),  # (spec, format) resized copies made along with the thumbnail of a new image
+    "THUMB_BYTES": None,  # Byte budget for thumbnails; their JPEG quality is searched to fit it
+    "THUMB_QUALITY_RANGE": (30, 90),  # Lowest and highest JPEG quality tried for THUMB_BYTES
     "EXTRA_MIME_TYPES": {'.flv': 'video/x-flv', },  # Extra mime types to monkey patch to mimetypes.types_map
     "FS_TEMPLATES": True,  # Template mode, either off the fs (1) or through the admin (0)
     "IMPORT_LOCAL_TMP_DIR": '',
+    "UNIQUE_UPLOAD_NAMES": True,  # Add a short random suffix to uploaded file names so they never collide
+    "UPLOAD_SHARDS": 0,  # Levels of two-character subdirectories, from the suffix, under each upload directory
     "MOGRIFY_KEY": settings.SECRET_KEY,
+    "DEFER_EXTERNAL_FETCH": True,  # Fetch a collection's external feed in a background thread after saving
+    "DEFER_THREADS": 2,  # Background threads running deferred work such as feed fetches
+    "SEARCH_INDEX": True,  # Keep the full-text search index up to date as media is saved and deleted
+    "SEARCH_BACKEND": None,  # 'fts5', 'postgresql' or 'simple'; chosen from the database when None
+    "SEARCH_CONFIG": 'english',  # PostgreSQL text search configuration
+    "SEARCH_METADATA_FIELDS": ('Title', 'Author', 'copyright', '5', '80', '105', '110', '116', '120'),  # Metadata keys indexed besides the keywords
+    "MEDIA_INDEX": True,  # Keep the table listing the media of every type up to date as media is saved and deleted
+    "SEARCH_LIMIT": 500,  # Most results returned by a search
+    "AUTOCOMPLETE": True,  # Log title changes for the autocomplete view, which is off when False
+    "AUTOCOMPLETE_LIMIT": 20,  # Most suggestions returned by the autocomplete view
+    "AUTOCOMPLETE_REFRESH": 1,  # Seconds between checks of the change log for titles changed by other processes
+    "AUTOCOMPLETE_LOG_AGE": 24 * 3600,  # Seconds that title changes are kept in the change log
+    "API_LIMIT": 100,  # Most objects of one media type returned by a JSON API request
+    "SENDFILE_HEADER": None,  # 'X-Sendfile' or 'X-Accel-Redirect' to let the web server send media files
+    "SENDFILE_URL_PREFIX": '/protected/',  # The internal nginx location X-Accel-Redirect paths start with
+    "LOCK_TIMEOUT": 60,  # Seconds before a lock held in the cache expires, in case its holder died
+    "LOCK_WAIT": 10,  # Seconds to wait for another process making the same image variant
+    "LOCK_DIR": '',  # Directory of the lock files used when the cache isn't shared; a temporary one when empty
+    "KEYSET_PAGINATION": False,  # Page the media lists with next/previous cursors instead of page numbers
+    "COUNT_CACHE_TTL": 300,  # Seconds the size of a keyset paginated list is cached
+    "CACHED_STORAGE_BACKEND": settings.DEFAULT_FILE_STORAGE,  # Storage class wrapped by massmedia.storage.CachedStorage
+    "CACHED_STORAGE_CACHE": None,  # Cache alias sharing the remembered url/exists/size answers between processes
+    "CACHED_STORAGE_SIZE": 10000,  # Most answers CachedStorage remembers in each process
+    "CACHED_STORAGE_TTL": 300,  # Seconds CachedStorage remembers an answer
+    "CACHE_CONTROL": {'public': True, 'max_age': 300},  # Cache-Control directives sent with the public media files and API
+    "PAGE_CACHE_CONTROL": {'private': True, 'max_age': 300},  # Cache-Control directives sent with the HTML media pages
 }
 
 DEFAULT_SETTINGS.update(getattr(settings, 'MASSMEDIA_SETTINGS', {}))
@@ -51,6 +82,7 @@ UPLOAD_TO = {
     'AUDIO': 'audio/%Y/%m/%d',
     'FLASH': 'flash/%Y/%m/%d',
     'DOC': 'misc/%Y/%m/%d',
+    'MOGRIFY': 'mogrify',
 }
 
 UPLOAD_TO.update(getattr(settings, 'MASSMEDIA_UPLOAD_TO', {}))
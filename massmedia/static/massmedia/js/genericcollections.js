@@ -1,4 +1,12 @@
+/* Content type id to admin URL map, loaded from the collection inline's
+   data-content-types URL */
+var collectionContentTypes = null;
 function showGenericRelatedObjectLookupPopup(triggeringLink, ctArray) {
+    ctArray = ctArray || collectionContentTypes;
+    if (!ctArray) {
+        alert("The content types are still loading, try again.");
+        return false;
+    }
     var realName = triggeringLink.id.replace(/^lookup_/, '');
     var name = id_to_windowname(realName);
     realName = realName.replace(/object_id/, 'content_type');
@@ -23,6 +31,12 @@ function showGenericRelatedObjectLookupPopup(triggeringLink, ctArray) {
     Franck Bret, 2010 - franckbret@gmail.com
 */
 jQuery(function($) {
+    var contentTypesUrl = $('table[data-content-types]').attr('data-content-types');
+    if (contentTypesUrl) {
+        $.getJSON(contentTypesUrl, function(data) {
+            collectionContentTypes = data;
+        });
+    }
     /* We first need to be sure that a position field is here */
     if($(this).find('td.position input:text')){
         if ($('div.inline-group > div.tabular').size() > 0){
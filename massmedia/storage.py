@@ -0,0 +1,159 @@
+"""
+A storage that remembers the answers of a slower one.
+
+On remote or signing backends every ``url()``, ``exists()`` and ``size()``
+is a network call or a signature, and pages of thumbnails make hundreds of
+them. ``CachedStorage`` wraps the storage class named by the
+``CACHED_STORAGE_BACKEND`` setting and keeps those answers in a bounded LRU
+in each process, and optionally in a Django cache shared by all of them.
+Saving or deleting a file through it forgets what was known about it.
+
+Only files found to exist are remembered by ``exists()``: a file that is
+missing now may be saved by another process at any moment, and code such as
+``get_available_name`` or the image variant locks must see that.
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from django.core.cache import get_cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.storage import Storage, get_storage_class
+from django.utils.encoding import force_bytes
+
+from massmedia.settings import (CACHED_STORAGE_BACKEND, CACHED_STORAGE_CACHE,
+    CACHED_STORAGE_SIZE, CACHED_STORAGE_TTL)
+
+MISSING = object()
+
+
+class LRUCache(object):
+    """
+    At most ``max_size`` values, each kept for ``ttl`` seconds, dropping the
+    least recently used first
+    """
+    def __init__(self, max_size=CACHED_STORAGE_SIZE, ttl=CACHED_STORAGE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key, default=MISSING):
+        with self.lock:
+            try:
+                value, expires = self.data.pop(key)
+            except KeyError:
+                return default
+            if expires < time.time():
+                return default
+            self.data[key] = (value, expires)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = (value, time.time() + self.ttl)
+            while len(self.data) > self.max_size:
+                self.data.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+
+class CachedStorage(Storage):
+    """
+    A ``Storage`` remembering the ``url``, ``exists`` and ``size`` answers of
+    ``backend``, the ``CACHED_STORAGE_BACKEND`` storage class by default
+    """
+    CACHED_METHODS = ('url', 'exists', 'size')
+
+    def __init__(self, backend=None, cache_alias=CACHED_STORAGE_CACHE,
+                 max_size=CACHED_STORAGE_SIZE, ttl=CACHED_STORAGE_TTL):
+        if backend is None:
+            storage_class = get_storage_class(CACHED_STORAGE_BACKEND)
+            if issubclass(storage_class, CachedStorage):
+                raise ImproperlyConfigured('CACHED_STORAGE_BACKEND must be the storage class to wrap')
+            backend = storage_class()
+        self.backend = backend
+        self.ttl = ttl
+        self.local = LRUCache(max_size, ttl)
+        self.shared = get_cache(cache_alias) if cache_alias else None
+
+    def cache_key(self, method, name):
+        return 'massmedia.storage.%s.%s' % (method, hashlib.md5(force_bytes(name)).hexdigest())
+
+    def remembered(self, method, name, remember=lambda value: True):
+        """
+        The result of the backend's ``method`` for ``name``, from the caches
+        when they have it
+        """
+        key = self.cache_key(method, name)
+        value = self.local.get(key)
+        if value is not MISSING:
+            return value
+        if self.shared is not None:
+            value = self.shared.get(key, MISSING)
+            if value is not MISSING:
+                self.local.set(key, value)
+                return value
+        value = getattr(self.backend, method)(name)
+        if remember(value):
+            self.local.set(key, value)
+            if self.shared is not None:
+                self.shared.set(key, value, self.ttl)
+        return value
+
+    def forget(self, name):
+        for method in self.CACHED_METHODS:
+            key = self.cache_key(method, name)
+            self.local.delete(key)
+            if self.shared is not None:
+                self.shared.delete(key)
+
+    def url(self, name):
+        return self.remembered('url', name)
+
+    def exists(self, name):
+        return self.remembered('exists', name, remember=bool)
+
+    def size(self, name):
+        return self.remembered('size', name)
+
+    def _open(self, name, mode='rb'):
+        return self.backend.open(name, mode)
+
+    def _save(self, name, content):
+        # save() has already picked an available name through the backend
+        name = self.backend._save(name, content)
+        self.forget(name)
+        return name
+
+    def get_available_name(self, name):
+        return self.backend.get_available_name(name)
+
+    def get_valid_name(self, name):
+        return self.backend.get_valid_name(name)
+
+    def delete(self, name):
+        self.backend.delete(name)
+        self.forget(name)
+
+    def path(self, name):
+        return self.backend.path(name)
+
+    def listdir(self, path):
+        return self.backend.listdir(path)
+
+    def accessed_time(self, name):
+        return self.backend.accessed_time(name)
+
+    def created_time(self, name):
+        return self.backend.created_time(name)
+
+    def modified_time(self, name):
+        return self.backend.modified_time(name)
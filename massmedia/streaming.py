@@ -0,0 +1,146 @@
+"""
+Serve the files of public media from Django, with ``Range`` requests so
+players can seek without downloading the whole file again.
+
+The bytes are read from the storage's file object in chunks. When
+``SENDFILE_HEADER`` is set, only the headers are built here and the
+transfer is handed to the front web server with ``X-Sendfile`` (Apache,
+lighttpd) or ``X-Accel-Redirect`` (nginx).
+"""
+import mimetypes
+import re
+
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.utils.http import parse_http_date_safe, quote_etag
+
+from massmedia import models
+from massmedia.conditional import add_cache_headers, not_modified, object_validators, timestamp
+from massmedia.settings import SENDFILE_HEADER, SENDFILE_URL_PREFIX
+
+CHUNK_SIZE = 64 * 1024
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+FILE_TYPES = dict((m._meta.object_name.lower(), m) for m in models.SEARCH_MODELS
+                  if 'file' in [f.name for f in m._meta.fields])
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def parse_range(header, size):
+    """
+    The ``(start, end)`` byte positions, inclusive, of a single range
+    ``Range`` header, or ``None`` to send the whole file
+    """
+    match = RANGE_RE.match((header or '').replace(' ', ''))
+    if not match or match.groups() == ('', ''):
+        # Several ranges, or not a byte range: sending everything is allowed
+        return None
+    first, last = match.groups()
+    if not first:
+        # The last ``last`` bytes
+        if not int(last):
+            raise RangeNotSatisfiable
+        return max(size - int(last), 0), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        raise RangeNotSatisfiable
+    return start, end
+
+
+def if_range_matches(request, last_modified, etag):
+    """
+    Whether a ``Range`` may be honoured: the client has no ``If-Range``, or
+    its copy is still the current one
+    """
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if not if_range:
+        return True
+    if if_range.startswith('"') or if_range.startswith('W/'):
+        return if_range == quote_etag(etag)
+    date = parse_http_date_safe(if_range)
+    return date is not None and last_modified is not None and timestamp(last_modified) <= date
+
+
+def file_iterator(f, start=0, length=None, chunk_size=CHUNK_SIZE):
+    """
+    Yield ``length`` bytes of ``f`` from ``start``, closing it at the end
+    """
+    try:
+        f.seek(start)
+        while length is None or length > 0:
+            data = f.read(chunk_size if length is None else min(chunk_size, length))
+            if not data:
+                break
+            if length is not None:
+                length -= len(data)
+            yield data
+    finally:
+        f.close()
+
+
+def sendfile_response(name, storage):
+    """
+    An empty response telling the front web server which file to send
+    """
+    response = HttpResponse()
+    if SENDFILE_HEADER.lower() == 'x-accel-redirect':
+        response[SENDFILE_HEADER] = '%s/%s' % (SENDFILE_URL_PREFIX.rstrip('/'), name)
+    else:
+        response[SENDFILE_HEADER] = storage.path(name)
+    return response
+
+
+def serve_file(request, mediatype, object_id):
+    """
+    The file of a public media object, in whole or the ``Range`` asked for
+    """
+    model = FILE_TYPES.get(mediatype)
+    if model is None:
+        raise Http404
+    queryset = model.objects.public().filter(pk=object_id)
+    validators = object_validators(queryset)
+    response = not_modified(request, *validators)
+    if response is not None:
+        return response
+    obj = get_object_or_404(queryset.only('file', 'mime_type', 'modified'))
+    if not obj.file:
+        raise Http404
+    storage, name = obj.file.storage, obj.file.name
+    content_type = obj.mime_type or mimetypes.guess_type(name)[0] or 'application/octet-stream'
+
+    if SENDFILE_HEADER:
+        # The web server handles ranges itself
+        response = sendfile_response(name, storage)
+        response['Content-Type'] = content_type
+        return add_cache_headers(response, *validators)
+
+    size = storage.size(name)
+    try:
+        byte_range = None
+        if if_range_matches(request, *validators):
+            byte_range = parse_range(request.META.get('HTTP_RANGE'), size)
+    except RangeNotSatisfiable:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = 'bytes */%d' % size
+        return response
+
+    if byte_range is None:
+        start, length, status = 0, size, 200
+    else:
+        start, end = byte_range
+        length, status = end - start + 1, 206
+    if request.method == 'HEAD':
+        response = HttpResponse(status=status, content_type=content_type)
+    else:
+        response = StreamingHttpResponse(file_iterator(storage.open(name, 'rb'), start, length),
+                                         status=status, content_type=content_type)
+    response['Content-Length'] = str(length)
+    if byte_range is not None:
+        response['Content-Range'] = 'bytes %d-%d/%d' % (start, start + length - 1, size)
+    response['Accept-Ranges'] = 'bytes'
+    return add_cache_headers(response, *validators)
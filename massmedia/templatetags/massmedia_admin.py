@@ -1,4 +1,5 @@
-from django.contrib.admin.views.main import ALL_VAR, EMPTY_CHANGELIST_VALUE
+from django.contrib.admin.util import quote
+from django.contrib.admin.views.main import ALL_VAR, EMPTY_CHANGELIST_VALUE, ChangeList
 from django.contrib.admin.views.main import ORDER_VAR, ORDER_TYPE_VAR, PAGE_VAR, SEARCH_VAR
 from django.contrib.admin.options import IS_POPUP_VAR
 from django.contrib.admin.templatetags.admin_list import _boolean_icon
@@ -18,108 +19,156 @@ register = Library()
 
 quo_esc = lambda x: x.replace("'", r"\'")
 
-def thumbnails_for_result(cl, result, form):
+def _field_renderer(f):
     """
-    Basically does the same thing as django's items_for_result, but makes all the
-    items fit in one <td> element instead of separate elements for each field
+    Return a function that formats the value of model field ``f`` of a row
+    """
+    if isinstance(f.rel, models.ManyToOneRel):
+        def render(result):
+            if getattr(result, f.attname) is None:
+                return EMPTY_CHANGELIST_VALUE
+            return escape(getattr(result, f.name))
+        return render
+    # Dates and times are special: They're formatted in a certain way.
+    if isinstance(f, (models.DateField, models.TimeField)):
+        if isinstance(f, models.DateTimeField):
+            fmt, formatter = get_format('DATETIME_FORMAT'), dateformat.format
+        elif isinstance(f, models.TimeField):
+            fmt, formatter = get_format('TIME_FORMAT'), dateformat.time_format
+        else:
+            fmt, formatter = get_format('DATE_FORMAT'), dateformat.format
+
+        def render(result):
+            field_val = getattr(result, f.attname)
+            if field_val:
+                return capfirst(formatter(field_val, fmt))
+            return EMPTY_CHANGELIST_VALUE
+        return render
+    # Booleans are special: We use images.
+    if isinstance(f, (models.BooleanField, models.NullBooleanField)):
+        return lambda result: _boolean_icon(getattr(result, f.attname))
+    # DecimalFields are special: Zero-pad the decimals.
+    if isinstance(f, models.DecimalField):
+        decimal_format = '%%.%sf' % f.decimal_places
+
+        def render(result):
+            field_val = getattr(result, f.attname)
+            if field_val is None:
+                return EMPTY_CHANGELIST_VALUE
+            return decimal_format % field_val
+        return render
+    # Fields with choices are special: Use the representation
+    # of the choice.
+    if f.flatchoices:
+        choices = dict(f.flatchoices)
+        return lambda result: choices.get(getattr(result, f.attname), EMPTY_CHANGELIST_VALUE)
+    return lambda result: escape(getattr(result, f.attname))
+
+
+def _attr_renderer(cl, field_name):
+    """
+    Return a function that formats a ``list_display`` entry that isn't a
+    model field: a callable, a model admin method or a model attribute
+    """
+    if callable(field_name):
+        attr = field_name
+        get_value = field_name
+    elif hasattr(cl.model_admin, field_name) and \
+       not field_name == '__str__' and not field_name == '__unicode__':
+        attr = getattr(cl.model_admin, field_name)
+        get_value = attr
+    else:
+        attr = getattr(cl.model, field_name, None)
+        if callable(attr):
+            get_value = lambda result: getattr(result, field_name)()
+        else:
+            get_value = lambda result: getattr(result, field_name)
+    boolean = getattr(attr, 'boolean', False)
+    allow_tags = boolean or getattr(attr, 'allow_tags', False)
+
+    def render(result):
+        try:
+            value = get_value(result)
+        except (AttributeError, ObjectDoesNotExist):
+            return EMPTY_CHANGELIST_VALUE
+        if boolean:
+            return mark_safe(_boolean_icon(value))
+        # Strip HTML tags in the resulting text, except if the
+        # function has an "allow_tags" attribute set to True.
+        if allow_tags:
+            return mark_safe(smart_unicode(value))
+        return escape(smart_unicode(value))
+    return render
+
+
+def column_plan(cl):
+    """
+    Work out once per changelist how each ``list_display`` entry is rendered,
+    so the rows don't repeat the field lookups and attribute probing.
+
+    Returns a list of ``(field_name, render, is_link)`` tuples.
     """
-    
+    plan = []
     first = True
-    pk = cl.lookup_opts.pk.attname
     for field_name in cl.list_display:
-        row_class = ''
         try:
             f = cl.lookup_opts.get_field(field_name)
         except models.FieldDoesNotExist:
-            # For non-field list_display values, the value is either a method,
-            # property or returned via a callable.
-            try:
-                if callable(field_name):
-                    attr = field_name
-                    value = attr(result)
-                elif hasattr(cl.model_admin, field_name) and \
-                   not field_name == '__str__' and not field_name == '__unicode__':
-                    attr = getattr(cl.model_admin, field_name)
-                    value = attr(result)
-                else:
-                    attr = getattr(result, field_name)
-                    if callable(attr):
-                        value = attr()
-                    else:
-                        value = attr
-                allow_tags = getattr(attr, 'allow_tags', False)
-                boolean = getattr(attr, 'boolean', False)
-                if boolean:
-                    allow_tags = True
-                    result_repr = _boolean_icon(value)
-                else:
-                    result_repr = smart_unicode(value)
-            except (AttributeError, ObjectDoesNotExist):
-                result_repr = EMPTY_CHANGELIST_VALUE
-            else:
-                # Strip HTML tags in the resulting text, except if the
-                # function has an "allow_tags" attribute set to True.
-                if not allow_tags:
-                    result_repr = escape(result_repr)
-                else:
-                    result_repr = mark_safe(result_repr)
+            render = _attr_renderer(cl, field_name)
         else:
-            field_val = getattr(result, f.attname)
+            render = _field_renderer(f)
+        # If list_display_links not defined, add the link tag to the first field
+        is_link = (first and not cl.list_display_links) or field_name in cl.list_display_links
+        if is_link:
+            first = False
+        plan.append((field_name, render, is_link))
+    return plan
 
-            if isinstance(f.rel, models.ManyToOneRel):
-                if field_val is not None:
-                    result_repr = escape(getattr(result, f.name))
-                else:
-                    result_repr = EMPTY_CHANGELIST_VALUE
-            # Dates and times are special: They're formatted in a certain way.
-            elif isinstance(f, models.DateField) or isinstance(f, models.TimeField):
-                if field_val:
-                    if isinstance(f, models.DateTimeField):
-                        result_repr = capfirst(dateformat.format(field_val, get_format('DATETIME_FORMAT')))
-                    elif isinstance(f, models.TimeField):
-                        result_repr = capfirst(dateformat.time_format(field_val, get_format('TIME_FORMAT')))
-                    else:
-                        result_repr = capfirst(dateformat.format(field_val, get_format('DATE_FORMAT')))
-                else:
-                    result_repr = EMPTY_CHANGELIST_VALUE
-                row_class = ' class="nowrap"'
-            # Booleans are special: We use images.
-            elif isinstance(f, models.BooleanField) or isinstance(f, models.NullBooleanField):
-                result_repr = _boolean_icon(field_val)
-            # DecimalFields are special: Zero-pad the decimals.
-            elif isinstance(f, models.DecimalField):
-                if field_val is not None:
-                    result_repr = ('%%.%sf' % f.decimal_places) % field_val
-                else:
-                    result_repr = EMPTY_CHANGELIST_VALUE
-            # Fields with choices are special: Use the representation
-            # of the choice.
-            elif f.flatchoices:
-                result_repr = dict(f.flatchoices).get(field_val, EMPTY_CHANGELIST_VALUE)
-            else:
-                result_repr = escape(field_val)
+
+def change_url_for_result(cl):
+    """
+    Return a function giving the change URL of a row. The URL is reversed
+    once with a placeholder for the primary key, unless the changelist has
+    its own ``url_for_result``.
+    """
+    if getattr(cl.url_for_result, 'im_func', None) is not ChangeList.url_for_result.im_func:
+        return cl.url_for_result
+    placeholder = 'PKPLACEHOLDER'
+    row = type('Row', (object, ), {cl.pk_attname: placeholder})()
+    prefix, suffix = cl.url_for_result(row).split(placeholder)
+    return lambda result: u'%s%s%s' % (prefix, quote(getattr(result, cl.pk_attname)), suffix)
+
+
+def thumbnails_for_result(cl, result, form, plan=None, url_for_result=None):
+    """
+    Basically does the same thing as django's items_for_result, but makes all the
+    items fit in one <td> element instead of separate elements for each field
+    """
+    if plan is None:
+        plan = column_plan(cl)
+    if url_for_result is None:
+        url_for_result = cl.url_for_result
+    file_browser = cl.is_popup and cl.params[IS_POPUP_VAR] == u'2'
+    url = None
+    for field_name, render, is_link in plan:
+        result_repr = render(result)
         if force_unicode(result_repr) == '':
             result_repr = mark_safe('&nbsp;')
-        # If list_display_links not defined, add the link tag to the first field
-        if (first and not cl.list_display_links) or field_name in cl.list_display_links:
-            table_tag = {True:'th', False:'td'}[first]
-            first = False
-            url = cl.url_for_result(result)
-            # Convert the pk to something that can be used in Javascript.
-            # Problem cases are long ints (23L) and non-ASCII strings.
-            if cl.to_field:
-                attr = str(cl.to_field)
-            else:
-                attr = pk
-            value = result.serializable_value(attr)
-            result_id = repr(force_unicode(value))[1:]
-            if cl.is_popup and cl.params[IS_POPUP_VAR] == u'2':
+        if is_link:
+            if file_browser:
                 yield mark_safe(u'<a href="%s"%s>%s</a>' % \
-                ('#', (cl.is_popup and ' onclick="FileBrowserDialogue.fileSubmit(\'%s\', \'%s\', \'%s\'); return false;"' % (result.media_url or '', quo_esc(result.caption) or '', result.get_absolute_url())), conditional_escape(result_repr)))
-                #(url, (cl.is_popup and ' onclick="FileBrowserDialogue.fileSubmit(\'%s\'); return false;"' % result.get_absolute_url() or ''), conditional_escape(result_repr)))
+                ('#', ' onclick="FileBrowserDialogue.fileSubmit(\'%s\', \'%s\', \'%s\'); return false;"' % (result.media_url or '', quo_esc(result.caption) or '', result.get_absolute_url()), conditional_escape(result_repr)))
             else:
-                yield mark_safe(u'<a href="%s"%s>%s</a>' % \
-                (url, (cl.is_popup and ' onclick="opener.dismissRelatedLookupPopup(window, %s); return false;"' % result_id or ''), conditional_escape(result_repr)))
+                if url is None:
+                    url = url_for_result(result)
+                onclick = ''
+                if cl.is_popup:
+                    # Convert the pk to something that can be used in Javascript.
+                    # Problem cases are long ints (23L) and non-ASCII strings.
+                    value = result.serializable_value(str(cl.to_field or cl.lookup_opts.pk.attname))
+                    result_id = repr(force_unicode(value))[1:]
+                    onclick = ' onclick="opener.dismissRelatedLookupPopup(window, %s); return false;"' % result_id
+                yield mark_safe(u'<a href="%s"%s>%s</a>' % (url, onclick, conditional_escape(result_repr)))
         else:
             # By default the fields come from ModelAdmin.list_editable, but if we pull
             # the fields out of the form instead of list_editable custom admins
@@ -132,15 +181,17 @@ def thumbnails_for_result(cl, result, form):
             yield mark_safe(u'%s' % (result_repr))
     if form:
         yield mark_safe(force_unicode(form[cl.model._meta.pk.name]))
-    
+
 
 def results(cl):
+    plan = column_plan(cl)
+    url_for_result = change_url_for_result(cl)
     if cl.formset:
         for res, form in zip(cl.result_list, cl.formset.forms):
-            yield list(thumbnails_for_result(cl, res, form))
+            yield list(thumbnails_for_result(cl, res, form, plan, url_for_result))
     else:
         for res in cl.result_list:
-            yield list(thumbnails_for_result(cl, res, None))
+            yield list(thumbnails_for_result(cl, res, None, plan, url_for_result))
 
 def thumbnail_result_list(context, cl):
     if context.has_key('STATIC_URL'):
@@ -47,4 +47,18 @@ def snipshot_url(media):
         Site.objects.get_current().domain,
         reverse('massmedia_snipshot_callback',None,(media.pk,))
     )
-register.simple_tag(snipshot_url)
\ No newline at end of file
+register.simple_tag(snipshot_url)
+
+def mogrify_url(image, width=None, height=None, crop=False, format='auto'):
+    """
+    The signed URL of a resized copy of an image
+
+    Usage:
+        {% mogrify_url <image> <width> [<height>] [crop=True] [format="png"] %}
+
+    Example:
+        {% mogrify_url object 200 150 crop=True %}
+    """
+    from massmedia.mogrify import mogrify_url as make_url
+    return make_url(image, width, height, crop, format)
+register.simple_tag(mogrify_url)
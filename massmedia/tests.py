@@ -1,4 +1,5 @@
 import unittest
+from django.test import TestCase, TransactionTestCase
 from massmedia.models import Collection,CollectionRelation
 from django.contrib.sites.models import Site
 from django.conf import settings
@@ -143,4 +144,1899 @@ class CollectionTestCase(unittest.TestCase):
         c = Collection.objects.create(external_url="http://www.youtube.com/view_play_list?p=3C046B163FA3957C")
         testplate = Template("{% load mm_youtube %}{% get_youtube_feed c as t %}{{ t.metadata.title }}")
         t = testplate.render(Context({'c': c}))
-        self.assertEqual(t, "TWT Home")
\ No newline at end of file
+        self.assertEqual(t, "TWT Home")
+
+YOUTUBE_FIXTURE = os.path.join(os.path.dirname(__file__), 'fixtures', 'youtube_playlist.xml')
+
+class YouTubePlaylistTestCase(unittest.TestCase):
+    def setUp(self):
+        self.xml = open(YOUTUBE_FIXTURE).read()
+
+    def testParsePlaylist(self):
+        from massmedia.youtube import parse_playlist, YouTubePlaylist, PLAYLIST_VERSION
+        data = parse_playlist(self.xml)
+        self.assertEqual(data['version'], PLAYLIST_VERSION)
+        self.assertTrue(YouTubePlaylist.is_current(data))
+        playlist = YouTubePlaylist(data)
+        self.assertEqual(playlist.metadata['title'], 'TWT Home')
+        self.assertEqual(playlist.metadata['total_results'], '15')
+        self.assertEqual(len(playlist.entries), 15)
+        entry = playlist.entries[0]
+        self.assertEqual(entry['id'], 'DLyt64ZtZcw')
+        self.assertEqual(entry['media']['duration'], '45')
+        self.assertEqual(len(entry['media']['content']), 1)
+        self.assertEqual(entry['statistics']['view_count'], '151')
+
+        testplate = Template("{% load mm_youtube %}{{ t.metadata.title }}|{{ t.entries.0.media.player }}")
+        self.assertEqual(testplate.render(Context({'t': playlist})),
+            "TWT Home|http://www.youtube.com/watch?v=DLyt64ZtZcw&amp;feature=youtube_gdata_player")
+
+    def testCompactPayload(self):
+        """
+        The compact playlist must be smaller to cache than the gdata objects
+        run through convert_to_python. benchmark_playlists compares the time
+        they take to build.
+        """
+        import cPickle as pickle
+        from massmedia.management.commands.benchmark_playlists import legacy_playlist
+        from massmedia.youtube import parse_playlist
+
+        legacy_size = len(pickle.dumps(legacy_playlist(self.xml), pickle.HIGHEST_PROTOCOL))
+        compact_size = len(pickle.dumps(parse_playlist(self.xml), pickle.HIGHEST_PROTOCOL))
+        self.assertTrue(compact_size < legacy_size,
+            'Compact payload %d bytes >= legacy %d bytes' % (compact_size, legacy_size))
+
+
+class StaleWhileRevalidateTestCase(unittest.TestCase):
+    def setUp(self):
+        from django.core.cache import cache
+        self.key = 'massmedia.tests.swr'
+        cache.delete(self.key)
+        self.calls = []
+
+    def fetch(self, value):
+        def fetcher():
+            self.calls.append(value)
+            if isinstance(value, Exception):
+                raise value
+            return value
+        return fetcher
+
+    def expire(self):
+        from django.core.cache import cache
+        val, refresh_time, failures = cache.get(self.key)
+        cache.set(self.key, (val, 0, failures))
+
+    def testStaleValueIsServedWhileRefreshing(self):
+        from massmedia.caching import get_or_refresh
+        self.assertEqual(get_or_refresh(self.key, self.fetch('one'), background=False), 'one')
+        self.assertEqual(get_or_refresh(self.key, self.fetch('two'), background=False), 'one')
+        self.assertEqual(self.calls, ['one'])
+        self.expire()
+        # The reader that notices the value is stale still gets the old one
+        # while the refresh runs in the background
+        self.assertEqual(get_or_refresh(self.key, self.fetch('two')), 'one')
+        from massmedia.locks import get_lock
+        # Wait for the refresher to let go of the lock
+        lock = get_lock('%s.lock' % self.key)
+        self.assertTrue(lock.acquire(wait=1))
+        lock.release()
+        self.assertEqual(get_or_refresh(self.key, self.fetch('three'), background=False), 'two')
+        self.assertEqual(self.calls, ['one', 'two'])
+
+    def testSingleRefresher(self):
+        from massmedia.caching import get_or_refresh, acquire_lock
+        get_or_refresh(self.key, self.fetch('one'), background=False)
+        self.expire()
+        lock = acquire_lock(self.key)
+        self.assertTrue(lock)
+        self.assertEqual(get_or_refresh(self.key, self.fetch('two'), background=False), 'one')
+        self.assertEqual(self.calls, ['one'])
+        lock.release()
+
+    def testFailureKeepsLastGoodValueAndBacksOff(self):
+        from django.core.cache import cache
+        from massmedia.caching import get_or_refresh, RETRY_MIN
+        import time
+        get_or_refresh(self.key, self.fetch('one'), background=False)
+        self.expire()
+        self.assertEqual(get_or_refresh(self.key, self.fetch(IOError()), background=False), 'one')
+        val, refresh_time, failures = cache.get(self.key)
+        self.assertEqual((val, failures), ('one', 1))
+        self.assertTrue(refresh_time > time.time() + RETRY_MIN - 5)
+        # No new attempt during the backoff
+        self.assertEqual(get_or_refresh(self.key, self.fetch('two'), background=False), 'one')
+        self.expire()
+        get_or_refresh(self.key, self.fetch(IOError()), background=False)
+        val, refresh_time, failures = cache.get(self.key)
+        self.assertEqual(failures, 2)
+        self.assertTrue(refresh_time > time.time() + 2 * RETRY_MIN - 5)
+
+    def testColdFailureIsNotCachedForLong(self):
+        from massmedia.caching import get_or_refresh
+        self.assertEqual(get_or_refresh(self.key, self.fetch(IOError()), background=False), None)
+        self.expire()
+        self.assertEqual(get_or_refresh(self.key, self.fetch('one'), background=False), 'one')
+
+
+class CollectionExternalUrlTestCase(TestCase):
+    def setUp(self):
+        from massmedia import models
+        self.deferred = []
+        self._defer = models.defer
+        models.defer = lambda func, *args, **kwargs: self.deferred.append(func)
+
+    def tearDown(self):
+        from massmedia import models
+        models.defer = self._defer
+
+    def testFeedOnlyFetchedWhenUrlChanges(self):
+        c = Collection(title='test', external_url='http://www.youtube.com/view_play_list?p=3C046B163FA3957C')
+        c.save()
+        self.assertEqual(len(self.deferred), 1)
+        c.caption = 'A new caption'
+        c.save()
+        c = Collection.objects.get(pk=c.pk)
+        c.public = False
+        c.save()
+        self.assertEqual(len(self.deferred), 1)
+        c.external_url = 'http://www.youtube.com/view_play_list?p=ABCDEF0123456789'
+        c.save()
+        self.assertEqual(len(self.deferred), 2)
+        Collection(title='no feed').save()
+        self.assertEqual(len(self.deferred), 2)
+
+
+class FakeFeed(object):
+    def __init__(self, url):
+        from massmedia.youtube import YouTubePlaylist
+        self.metadata = {'title': 'TWT Home', 'subtitle': 'Videos from TWT'}
+        self.playlist = YouTubePlaylist({'version': 0, 'metadata': self.metadata, 'entries': []})
+
+
+class DeferTestCase(TransactionTestCase):
+    def setUp(self):
+        from massmedia import utils, youtube
+        self._run_in_background = utils.run_in_background
+        self._feed = youtube.YouTubeFeed
+        self.started = []
+        self.ran = []
+
+        def run_in_background(func, *args, **kwargs):
+            self.started.append(func)
+            func(*args, **kwargs)
+        utils.run_in_background = run_in_background
+        youtube.YouTubeFeed = FakeFeed
+
+    def tearDown(self):
+        from massmedia import utils, youtube
+        utils.run_in_background = self._run_in_background
+        youtube.YouTubeFeed = self._feed
+        utils.discard_deferred()
+
+    def testRunsAfterRequest(self):
+        from django.core.signals import got_request_exception, request_finished
+        from django.db import transaction
+        from massmedia.utils import defer
+        defer(self.ran.append, 'now')
+        self.assertEqual(self.ran, ['now'])
+        with transaction.atomic():
+            defer(self.ran.append, 'committed')
+            with transaction.atomic():
+                defer(self.ran.append, 'committed too')
+        self.assertEqual(self.ran, ['now'])
+        request_finished.send(sender=None)
+        self.assertEqual(self.ran, ['now', 'committed', 'committed too'])
+        with transaction.atomic():
+            defer(self.ran.append, 'failed')
+        got_request_exception.send(sender=None, request=None)
+        request_finished.send(sender=None)
+        self.assertEqual(self.ran, ['now', 'committed', 'committed too'])
+
+    def testBackgroundThreads(self):
+        import threading
+        done = threading.Event()
+        self._run_in_background(done.set)
+        self.assertTrue(done.wait(5))
+
+    def testExternalUrlFilledInAfterRequest(self):
+        from django.core.signals import request_finished
+        from django.db import transaction
+        from massmedia.models import fetch_external_url
+        with transaction.atomic():
+            c = Collection(external_url='http://www.youtube.com/view_play_list?p=3C046B163FA3957C')
+            c.save()
+        self.assertEqual(self.started, [])
+        request_finished.send(sender=None)
+        self.assertEqual(self.started, [fetch_external_url])
+        c = Collection.objects.get(pk=c.pk)
+        self.assertEqual((c.title, c.caption), ('TWT Home', 'Videos from TWT'))
+
+
+class WarmExternalFeedsTestCase(TestCase):
+    def setUp(self):
+        from massmedia import models
+        from massmedia.management.commands import warm_external_feeds
+        self.command = warm_external_feeds
+        self._fetch = warm_external_feeds.fetch_playlist_data
+        self._defer = models.defer
+        models.defer = lambda func, *args, **kwargs: None
+
+        def fetch(url):
+            if 'BROKEN' in url:
+                raise IOError('unreachable')
+            return {'version': 0, 'url': url}
+        warm_external_feeds.fetch_playlist_data = fetch
+
+    def tearDown(self):
+        from massmedia import models
+        self.command.fetch_playlist_data = self._fetch
+        models.defer = self._defer
+
+    def testWarmFillsTemplateCacheKeys(self):
+        from StringIO import StringIO
+        from django.core.cache import cache
+        from django.core.management import call_command
+        from django.core.management.base import CommandError
+        from massmedia.youtube import feed_cache_key
+        good = 'http://www.youtube.com/view_play_list?p=GOOD'
+        broken = 'http://www.youtube.com/view_play_list?p=BROKEN'
+        Collection(title='good', external_url=good).save()
+        Collection(title='broken', external_url=broken).save()
+        Collection(title='elsewhere', external_url='http://example.com/feed').save()
+        out, err = StringIO(), StringIO()
+        self.assertRaises(CommandError, call_command, 'warm_external_feeds', stdout=out, stderr=err)
+        self.assertEqual(cache.get(feed_cache_key(good))[0], {'version': 0, 'url': good})
+        self.assertEqual(cache.get(feed_cache_key(broken)), None)
+        self.assertTrue('Warmed 1 of 2 feeds' in out.getvalue())
+        self.assertTrue('BROKEN FAILED' in err.getvalue())
+
+
+class PlaylistSyncTestCase(TestCase):
+    def setUp(self):
+        from massmedia import models
+        from massmedia.youtube import parse_playlist
+        self._defer = models.defer
+        models.defer = lambda func, *args, **kwargs: None
+        self.data = parse_playlist(open(YOUTUBE_FIXTURE).read())
+        self.collection = Collection(title='TWT Home',
+            external_url='http://www.youtube.com/view_play_list?p=3C046B163FA3957C')
+        self.collection.save()
+
+    def tearDown(self):
+        from django.core.cache import cache
+        from massmedia import models
+        models.defer = self._defer
+        cache.clear()
+
+    def get_sync(self):
+        from massmedia.youtube_sync import PlaylistSync
+        data = self.data
+        pages = []
+
+        class FixtureSync(PlaylistSync):
+            def fetch_page(self, start):
+                pages.append(start)
+                page = dict(data)
+                page['entries'] = data['entries'][start - 1:start - 1 + self.page_size]
+                return page
+        sync = FixtureSync(self.collection, page_size=10)
+        sync.pages = pages
+        return sync
+
+    def testSync(self):
+        from massmedia.models import Embed
+        sync = self.get_sync()
+        stats = sync.sync()
+        self.assertEqual(sorted(sync.pages), [1, 11])
+        self.assertEqual((stats['created'], stats['updated']), (15, 0))
+        relations = CollectionRelation.objects.filter(collection=self.collection)
+        self.assertEqual([r.content_object.slug for r in relations],
+            ['youtube-%s' % e['id'] for e in self.data['entries']])
+        embed = Embed.objects.get(slug='youtube-DLyt64ZtZcw')
+        self.assertEqual(embed.metadata['duration'], '45')
+        self.assertEqual(embed.metadata['thumbnail'], 'http://i.ytimg.com/vi/DLyt64ZtZcw/0.jpg')
+
+        # Nothing has changed on YouTube, so only the first page is fetched
+        sync = self.get_sync()
+        self.assertEqual(sync.sync()['unchanged'], 0)
+        self.assertEqual(sync.pages, [1])
+
+        # Only the changed entry is saved, and removed videos are unlinked
+        self.data['entries'] = self.data['entries'][:-1]
+        self.data['entries'][0] = dict(self.data['entries'][0], updated='2012-01-01T00:00:00.000Z')
+        self.data['metadata'] = dict(self.data['metadata'], total_results='14')
+        stats = self.get_sync().sync(force=True)
+        self.assertEqual((stats['created'], stats['updated'], stats['unchanged'], stats['removed']),
+                         (0, 1, 13, 1))
+        self.assertEqual(CollectionRelation.objects.filter(collection=self.collection).count(), 14)
+
+    def testEmbedOfAnotherSite(self):
+        from massmedia.models import Embed
+        other = Site.objects.create(domain='other.example.com', name='Other')
+        Embed(title='Synced elsewhere', slug='youtube-DLyt64ZtZcw', site=other,
+              external_url='http://www.youtube.com/watch?v=DLyt64ZtZcw').save()
+        stats = self.get_sync().sync()
+        self.assertEqual((stats['created'], stats['updated']), (14, 1))
+        self.assertEqual(Embed._base_manager.filter(slug='youtube-DLyt64ZtZcw').count(), 1)
+
+
+from django.conf.urls import patterns, include, url
+from django.contrib import admin as django_admin
+import massmedia.admin
+
+urlpatterns = patterns('',
+    url(r'^admin/', include(django_admin.site.urls)),
+    url(r'^', include('massmedia.urls')),
+)
+
+
+class AdminChangeListQueriesTestCase(TestCase):
+    """
+    The number of queries of a changelist page mustn't grow with the
+    number of rows on it
+    """
+    urls = 'massmedia.tests'
+    max_queries = 8
+
+    def setUp(self):
+        from django.contrib.auth.models import User
+        User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        self.client.login(username='admin', password='admin')
+
+    def add_media(self, count):
+        from django.contrib.auth.models import User
+        from massmedia.models import Image, Video
+        start = Video.objects.count()
+        for i in range(start, start + count):
+            author = User.objects.create(username='author%d' % i, first_name='Author')
+            image = Image(title='Image %d' % i, slug='image-%d' % i, author=author,
+                mime_type='image/jpeg')
+            image.save()
+            video = Video(title='Video %d' % i, slug='video-%d' % i, author=author,
+                external_url='http://example.com/%d.flv' % i, mime_type='video/x-flv',
+                thumbnail=image)
+            video.save()
+
+    def count_queries(self, url):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return queries
+
+    def assertQueryBudget(self, url):
+        self.add_media(2)
+        few = len(self.count_queries(url))
+        self.add_media(20)
+        queries = self.count_queries(url)
+        self.assertEqual(len(queries), few)
+        self.assertTrue(len(queries) <= self.max_queries,
+                        '%d queries over budget' % len(queries))
+        return queries
+
+    def testVideoChangeList(self):
+        queries = self.assertQueryBudget('/admin/massmedia/video/')
+        results = [q['sql'] for q in queries if 'INNER JOIN "massmedia_image"' in q['sql']
+                   or 'LEFT OUTER JOIN "massmedia_image"' in q['sql']]
+        self.assertEqual(len(results), 1)
+        self.assertFalse('"metadata"' in results[0])
+        self.assertFalse('"caption"' in results[0])
+
+    def testImageChangeList(self):
+        queries = self.assertQueryBudget('/admin/massmedia/image/')
+        self.assertFalse([q for q in queries if '"massmedia_image"."metadata"' in q['sql']])
+
+    def testAudioChangeList(self):
+        self.assertQueryBudget('/admin/massmedia/audio/')
+
+    def testListEditableSave(self):
+        from massmedia.models import MediaIndex, Video
+        self.add_media(2)
+        videos = list(Video.objects.order_by('-creation_date', '-pk'))
+        data = {'form-TOTAL_FORMS': '2', 'form-INITIAL_FORMS': '2', '_save': 'Save'}
+        for i, video in enumerate(videos):
+            data['form-%d-id' % i] = str(video.pk)
+            if video.slug == 'video-1':
+                data['form-%d-public' % i] = 'on'
+        response = self.client.post('/admin/massmedia/video/', data)
+        self.assertEqual(response.status_code, 302)
+        self.assertFalse(Video.objects.get(slug='video-0').public)
+        self.assertEqual([e.slug for e in MediaIndex.objects.public().filter(slug__startswith='video')],
+                         ['video-1'])
+
+    def testAuthorName(self):
+        from django.contrib.auth.models import User
+        from massmedia.models import Video
+        self.add_media(1)
+        video = Video.objects.get(slug='video-0')
+        self.assertEqual(video.author_name, 'Author')
+        User.objects.filter(pk=video.author_id).update(first_name='')
+        self.assertEqual(Video.objects.get(slug='video-0').author_name, 'author0')
+
+
+class ThumbnailResultListTestCase(TestCase):
+    urls = 'massmedia.tests'
+    rows = 500
+
+    def setUp(self):
+        from massmedia.models import Image
+        site = Site.objects.get_current()
+        Image.objects.bulk_create([
+            Image(title='Image %d' % i, slug='image-%d' % i, site=site, mime_type='image/jpeg')
+            for i in range(self.rows)])
+
+    def get_changelist(self, list_display=None):
+        from massmedia.management.commands.benchmark_admin_grid import image_changelist
+        return image_changelist(self.rows, list_display)
+
+    def testColumnPlan(self):
+        """
+        The list_display entries are looked up once per changelist, not per row
+        """
+        from massmedia.templatetags.massmedia_admin import results
+        cl = self.get_changelist()
+        get_field = cl.lookup_opts.get_field
+        lookups = []
+
+        def counting_get_field(name, *args, **kwargs):
+            lookups.append(name)
+            return get_field(name, *args, **kwargs)
+        cl.lookup_opts.get_field = counting_get_field
+        try:
+            rows = list(results(cl))
+        finally:
+            del cl.lookup_opts.get_field
+        self.assertEqual(len(rows), self.rows)
+        self.assertEqual(lookups, list(cl.list_display))
+        first = cl.result_list[0]
+        self.assertEqual(rows[0][1], u'<a href="/admin/massmedia/image/%s/">%s</a>' % (
+            first.pk, first.title))
+
+    def testThumbnailGrid(self):
+        """
+        Rendering the grid with one column plan and one reversed change URL
+        must match working out every column and URL for each row, without
+        queries. benchmark_admin_grid compares the time both take.
+        """
+        from massmedia.management.commands.benchmark_admin_grid import GRID_COLUMNS, per_row
+        from massmedia.templatetags.massmedia_admin import results
+        cl = self.get_changelist(GRID_COLUMNS)
+        with self.assertNumQueries(0):
+            planned = list(results(cl))
+        self.assertEqual(len(planned), self.rows)
+        self.assertEqual(planned, per_row(cl))
+
+
+class CollectionContentTypesTestCase(TestCase):
+    urls = 'massmedia.tests'
+
+    def setUp(self):
+        from django.contrib.auth.models import User
+        from django.core.cache import cache
+        cache.clear()
+        User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        self.client.login(username='admin', password='admin')
+
+    def testContentTypeMap(self):
+        import json
+        from django.contrib.contenttypes.models import ContentType
+        from massmedia.admin import collection_content_types
+        from massmedia.models import Image
+        image_type = ContentType.objects.get_for_model(Image)
+        version, ct_map = collection_content_types()
+        self.assertEqual(ct_map[str(image_type.pk)], 'massmedia/image')
+        self.assertEqual(len(ct_map), 5)
+        self.assertNumQueries(0, collection_content_types)
+
+        response = self.client.get('/admin/massmedia/collection/add/')
+        url = '/admin/massmedia/collection/content_types/?v=%s' % version
+        self.assertContains(response, 'data-content-types="%s"' % url)
+
+        response = self.client.get(url)
+        self.assertEqual(json.loads(response.content), ct_map)
+        self.assertTrue('max-age=31536000' in response['Cache-Control'])
+        response = self.client.get('/admin/massmedia/collection/content_types/?v=old')
+        self.assertTrue('no-cache' in response['Cache-Control'])
+
+        # Changing a content type changes the version
+        changed = ContentType.objects.get(pk=image_type.pk)
+        changed.app_label = 'media'
+        changed.save()
+        self.assertNotEqual(collection_content_types()[0], version)
+
+
+class SearchTestCase(TestCase):
+    urls = 'massmedia.tests'
+
+    def setUp(self):
+        from django.contrib.auth.models import User
+        from massmedia.fields import Metadata
+        from massmedia.models import Image, Video
+        self.harbour = Image(title='Harbour at dawn', slug='harbour', mime_type='image/jpeg',
+            caption='Fishing boats leaving the port')
+        self.harbour.save()
+        self.boats = Image(title='Regatta', slug='regatta', mime_type='image/jpeg',
+            caption='Sail boats racing past the harbour wall',
+            metadata=Metadata({'25': ['sailing', 'harbour']}))
+        self.boats.save()
+        self.private = Video(title='Harbour cam', slug='harbour-cam', public=False,
+            mime_type='video/x-flv', external_url='http://example.com/cam.flv',
+            author=User.objects.create(username='ann', first_name='Ann', last_name='Cole'))
+        self.private.save()
+
+    def testIndex(self):
+        from massmedia import search
+        from massmedia.models import Image, Video
+        self.assertEqual(len(search.search('harbour')), 3)
+        # Title beats keywords and caption
+        results = search.search('harbour', [Image])
+        self.assertEqual([r.object_id for r in results], [self.harbour.pk, self.boats.pk])
+        self.assertTrue(results[0].rank > results[1].rank)
+
+        self.assertEqual([r.object_id for r in search.search('sailing')], [self.boats.pk])
+        self.assertEqual([r.object_id for r in search.search('ann cole')], [self.private.pk])
+        self.assertEqual([r.object_id for r in search.search('harbour', [Video])], [self.private.pk])
+        self.assertEqual(len(search.search('harbour', public=True)), 2)
+        self.assertEqual(search.search('harbour boats nowhere'), [])
+        self.assertEqual(search.search('  '), [])
+
+        # Saving and deleting update the index
+        self.harbour.title = 'Lighthouse'
+        self.harbour.save()
+        self.assertEqual([r.object_id for r in search.search('lighthouse')], [self.harbour.pk])
+        self.harbour.delete()
+        self.assertEqual(search.search('lighthouse'), [])
+
+        # Including deferred objects, whose class is a proxy of the model
+        boats = Image.objects.defer('caption', 'metadata').get(pk=self.boats.pk)
+        boats.title = 'Dinghies'
+        boats.save()
+        self.assertEqual([r.object_id for r in search.search('dinghies')], [self.boats.pk])
+        boats.delete()
+        self.assertEqual(search.search('dinghies'), [])
+
+    def testSimpleBackend(self):
+        from massmedia import search
+        from massmedia.models import Image
+        backend = search._backend
+        search._backend = search.SimpleBackend()
+        search._backend.table = 'massmedia_search_simple'
+        try:
+            search.create_index()
+            for obj in (self.harbour, self.boats, self.private):
+                search.index_object(obj)
+            self.assertEqual(len(search.search('harbour')), 3)
+            results = search.search('harbour', public=True)
+            self.assertEqual([r.object_id for r in results], [self.harbour.pk, self.boats.pk])
+            self.assertTrue(results[0].rank > results[1].rank)
+            self.assertEqual([r.object_id for r in search.search('sailing')], [self.boats.pk])
+            self.assertEqual(
+                sorted(search.filter_matching(Image.objects.all(), 'harbour').values_list('pk', flat=True)),
+                sorted([self.harbour.pk, self.boats.pk]))
+        finally:
+            search._backend = backend
+
+    def testSearchView(self):
+        import tempfile
+        # massmedia_base.html extends the project's site_base.html
+        template_dir = tempfile.mkdtemp()
+        try:
+            open(os.path.join(template_dir, 'site_base.html'), 'w').write(
+                '{% block content %}{% endblock %}')
+            with self.settings(TEMPLATE_DIRS=(template_dir, )):
+                response = self.client.get('/search/?q=harbour')
+                self.assertEqual([m.pk for m in response.context['object_list']],
+                                 [self.harbour.pk, self.boats.pk])
+                self.assertContains(response, 'Sail boats racing')
+                response = self.client.get('/search/?q=harbour&type=video')
+                self.assertEqual(list(response.context['object_list']), [])
+        finally:
+            shutil.rmtree(template_dir)
+
+    def testAdminSearch(self):
+        from django.contrib.auth.models import User
+        from massmedia.models import Image
+        User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        self.client.login(username='admin', password='admin')
+        response = self.client.get('/admin/massmedia/image/', {'q': 'sailing'})
+        self.assertEqual([m.pk for m in response.context['cl'].result_list], [self.boats.pk])
+        # search_fields the index doesn't have are still searched
+        Image.objects.filter(pk=self.harbour.pk).update(file='img/2013/0501/pier-01.jpg')
+        response = self.client.get('/admin/massmedia/image/', {'q': 'pier-01'})
+        self.assertEqual([m.pk for m in response.context['cl'].result_list], [self.harbour.pk])
+        response = self.client.get('/admin/massmedia/image/', {'q': 'sailing pier'})
+        self.assertEqual(list(response.context['cl'].result_list), [])
+        response = self.client.get('/admin/massmedia/image/', {'q': 'harbour'})
+        self.assertEqual(sorted(m.pk for m in response.context['cl'].result_list),
+                         sorted([self.harbour.pk, self.boats.pk]))
+
+    def testRebuild(self):
+        from StringIO import StringIO
+        from django.core.management import call_command
+        from django.db import connection
+        from massmedia import search
+        connection.cursor().execute('DELETE FROM %s' % search.TABLE)
+        self.assertEqual(search.search('harbour'), [])
+        out = StringIO()
+        call_command('rebuild_search_index', 'image', 'video', stdout=out)
+        self.assertTrue('Indexed 2 image objects' in out.getvalue())
+        self.assertEqual(len(search.search('harbour')), 3)
+
+
+class AutocompleteTestCase(TestCase):
+    urls = 'massmedia.tests'
+
+    def setUp(self):
+        from massmedia.autocomplete import titles
+        titles.index = None
+
+    def testPrefixIndex(self):
+        from massmedia.autocomplete import PrefixIndex
+        index = PrefixIndex()
+        index.load([(1, 1, u'Harbour at dawn'), (1, 2, u'Harbor Lights'), (2, 1, u'Dawn Patrol')])
+        self.assertEqual(index.lookup('har'), [(1, 2, u'Harbor Lights'), (1, 1, u'Harbour at dawn')])
+        self.assertEqual(index.lookup('DAWN'), [(1, 1, u'Harbour at dawn'), (2, 1, u'Dawn Patrol')])
+        self.assertEqual(index.lookup('dawn har'), [(1, 1, u'Harbour at dawn')])
+        self.assertEqual(index.lookup('dawn', content_type_ids=set([2])), [(2, 1, u'Dawn Patrol')])
+        self.assertEqual(index.lookup('dawn', limit=1), [(1, 1, u'Harbour at dawn')])
+        self.assertEqual(index.lookup(' '), [])
+
+        index.add(1, 1, u'Lighthouse')
+        self.assertEqual(index.lookup('light'), [(1, 1, u'Lighthouse'), (1, 2, u'Harbor Lights')])
+        self.assertEqual(index.lookup('harbour'), [])
+        index.remove(1, 2)
+        self.assertEqual(index.lookup('light'), [(1, 1, u'Lighthouse')])
+        self.assertEqual(len(index), 2)
+        self.assertEqual(len(index.entries), 3)
+
+    def testManyTitles(self):
+        """
+        Lookups in 50,000 titles find the titles matching every word, up to
+        the limit. benchmark_autocomplete times them.
+        """
+        from massmedia.autocomplete import PrefixIndex, words
+        from massmedia.management.commands.benchmark_autocomplete import random_titles, sample_queries
+        vocabulary, items = random_titles(50000)
+        index = PrefixIndex()
+        index.load(items)
+        for query in sample_queries(vocabulary):
+            results = index.lookup(query, limit=20)
+            matches = [(ct_id, pk, title) for ct_id, pk, title in items
+                       if all(any(w.startswith(q) for w in words(title)) for q in words(query))]
+            self.assertEqual(len(results), min(20, len(matches)))
+            self.assertEqual(len(set(results)), len(results))
+            self.assertTrue(set(results) <= set(matches))
+
+    def testChangeLog(self):
+        from django.contrib.contenttypes.models import ContentType
+        from massmedia.autocomplete import titles as index
+        from massmedia.models import Image, Video, MediaChange
+        image = Image(title='Harbour at dawn', slug='harbour', mime_type='image/jpeg')
+        image.save()
+        self.assertEqual([r[2] for r in index.lookup('harb')], ['Harbour at dawn'])
+
+        # A save in another process only reaches this one through the log
+        video_type = ContentType.objects.get_for_model(Video)
+        MediaChange.objects.create(content_type=video_type, object_id=42,
+                                   title='Harbour cam', action=MediaChange.SAVE)
+        self.assertEqual(len(index.lookup('harb')), 1)
+        index.checked -= 60
+        self.assertEqual([r[2] for r in index.lookup('harb', [Video])], ['Harbour cam'])
+
+        # Changes in this process are applied straight away
+        image.delete()
+        self.assertEqual([r[2] for r in index.lookup('harb')], ['Harbour cam'])
+
+        # Including those to deferred objects, whose class is a proxy
+        video = Video(title='Lighthouse', slug='lighthouse', mime_type='video/x-flv',
+                      external_url='http://example.com/lighthouse.flv')
+        video.save()
+        video = Video.objects.defer('caption', 'metadata').get(pk=video.pk)
+        video.title = 'Lighthouse keeper'
+        video.save()
+        self.assertEqual([r[2] for r in index.lookup('light')], ['Lighthouse keeper'])
+
+    def testChangeLogWrites(self):
+        import datetime
+        from django.utils import timezone
+        from massmedia.autocomplete import titles as index
+        from massmedia.models import Image, MediaChange
+        # Media.save saves twice, but the title is only logged once
+        image = Image(title='Harbour at dawn', slug='harbour', mime_type='image/jpeg')
+        image.save()
+        self.assertEqual(MediaChange.objects.count(), 1)
+        image.caption = 'Boats'
+        image.save()
+        self.assertEqual(MediaChange.objects.count(), 1)
+
+        # Old changes are pruned by the writers, without an index being built
+        MediaChange.objects.update(created=timezone.now() - datetime.timedelta(days=2))
+        index.pruned = 0
+        image.title = 'Harbour at dusk'
+        image.save()
+        self.assertEqual(list(MediaChange.objects.values_list('title', flat=True)), ['Harbour at dusk'])
+        self.assertEqual(index.index, None)
+
+    def testReplayOverlap(self):
+        from django.contrib.contenttypes.models import ContentType
+        from massmedia.autocomplete import titles as index
+        from massmedia.models import Video, MediaChange
+        self.assertEqual(index.lookup('harb'), [])
+        # A change committed after one with a higher id is still replayed
+        video_type = ContentType.objects.get_for_model(Video)
+        late = MediaChange.objects.create(content_type=video_type, object_id=42,
+                                          title='Harbour cam', action=MediaChange.SAVE)
+        early = MediaChange.objects.create(content_type=video_type, object_id=43,
+                                           title='Harbour pier', action=MediaChange.SAVE)
+        index.last_change_id = early.pk
+        index.checked -= 60
+        self.assertEqual(sorted(r[2] for r in index.lookup('harb')), ['Harbour cam', 'Harbour pier'])
+        self.assertEqual(index.last_change_id, early.pk)
+
+    def testDisabled(self):
+        from django.contrib.auth.models import User
+        from massmedia import settings as massmedia_settings
+        User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        self.client.login(username='admin', password='admin')
+        massmedia_settings.AUTOCOMPLETE = False
+        try:
+            self.assertEqual(self.client.get('/autocomplete/?q=harb').status_code, 404)
+        finally:
+            massmedia_settings.AUTOCOMPLETE = True
+
+    def testView(self):
+        import json
+        from django.contrib.auth.models import User
+        from massmedia.models import Image, Video
+        Image(title='Harbour at dawn', slug='harbour', mime_type='image/jpeg').save()
+        Video(title='Harbour cam', slug='harbour-cam', mime_type='video/x-flv',
+              external_url='http://example.com/cam.flv').save()
+        # Only staff get suggestions
+        self.assertFalse('Harbour' in self.client.get('/autocomplete/?q=harb').content)
+        User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        self.client.login(username='admin', password='admin')
+        response = self.client.get('/autocomplete/?q=harb')
+        self.assertEqual(response['Content-Type'], 'application/json')
+        self.assertEqual(sorted((s['type'], s['title']) for s in json.loads(response.content)),
+                         [('image', 'Harbour at dawn'), ('video', 'Harbour cam')])
+        response = self.client.get('/autocomplete/?q=harb&type=image&limit=5')
+        self.assertEqual([s['title'] for s in json.loads(response.content)], ['Harbour at dawn'])
+        response = self.client.get('/autocomplete/?q=harb&limit=1')
+        self.assertEqual(len(json.loads(response.content)), 1)
+
+
+class ConditionalGetTestCase(TestCase):
+    urls = 'massmedia.tests'
+
+    def setUp(self):
+        import tempfile
+        from massmedia.models import Embed
+        self.embed = Embed(title='Harbour at dawn', slug='harbour',
+                           external_url='http://example.com/harbour')
+        self.embed.save()
+        # massmedia_base.html extends the project's site_base.html
+        self.template_dir = tempfile.mkdtemp()
+        open(os.path.join(self.template_dir, 'site_base.html'), 'w').write(
+            '{% block content %}{% endblock %}')
+
+    def tearDown(self):
+        shutil.rmtree(self.template_dir)
+
+    def get(self, path, **headers):
+        context_processors = settings.TEMPLATE_CONTEXT_PROCESSORS + (
+            'django.core.context_processors.request', )
+        with self.settings(TEMPLATE_DIRS=(self.template_dir, ),
+                           TEMPLATE_CONTEXT_PROCESSORS=context_processors):
+            return self.client.get(path, **headers)
+
+    def testDetail(self):
+        for path in ('/embed/harbour/', '/widget/%s/embed/' % self.embed.pk):
+            response = self.get(path)
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue('max-age=300' in response['Cache-Control'])
+            # The pages extend the site's templates, which may be per user
+            self.assertTrue('private' in response['Cache-Control'])
+            etag = response['ETag']
+
+            response = self.get(path, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.content, '')
+            self.assertEqual(response.templates, [])
+            self.assertEqual(response['ETag'], etag)
+
+            response = self.get(path, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+            self.assertEqual(response.status_code, 304)
+            response = self.get(path, HTTP_IF_NONE_MATCH='"stale"',
+                                HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+            self.assertEqual(response.status_code, 200)
+
+        self.embed.title = 'Lighthouse'
+        self.embed.save()
+        response = self.get('/embed/harbour/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(self.get('/embed/missing/', HTTP_IF_NONE_MATCH='*').status_code, 404)
+
+    def testUnpublishedWidget(self):
+        from massmedia.models import Embed
+        Embed.objects.filter(pk=self.embed.pk).update(public=False)
+        response = self.get('/widget/%s/embed/' % self.embed.pk)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Cache-Control'], 'private')
+        response = self.get('/widget/%s/embed/' % self.embed.pk,
+                            HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['Cache-Control'], 'private')
+
+    def testLastModifiedOfLocalTime(self):
+        import time
+        from django.utils.http import parse_http_date
+        from massmedia.models import Embed
+        modified = Embed.objects.get(pk=self.embed.pk).modified
+        with self.settings(USE_TZ=False):
+            response = self.get('/embed/harbour/')
+        self.assertEqual(parse_http_date(response['Last-Modified']),
+                         int(time.mktime(modified.timetuple())))
+
+    def testList(self):
+        from massmedia.models import Embed
+        response = self.get('/embed/')
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        self.assertEqual(self.get('/embed/', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        # Removing an item doesn't change the newest timestamp, but the etag
+        Embed(title='Regatta', slug='regatta', external_url='http://example.com/regatta').save()
+        etag = self.get('/embed/')['ETag']
+        Embed.objects.get(slug='regatta').delete()
+        self.assertEqual(self.get('/embed/', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def testCollectionRelation(self):
+        from django.contrib.contenttypes.models import ContentType
+        collection = Collection.objects.create(title='Harbour', public=True)
+        modified = Collection.objects.get(pk=collection.pk).modified
+        Collection.objects.filter(pk=collection.pk).update(modified=modified.replace(year=2000))
+        CollectionRelation.objects.create(collection=collection, object_id=self.embed.pk,
+            content_type=ContentType.objects.get_for_model(self.embed))
+        self.assertTrue(Collection.objects.get(pk=collection.pk).modified.year > 2000)
+
+
+class MediaAPITestCase(TestCase):
+    urls = 'massmedia.tests'
+
+    def setUp(self):
+        from django.contrib.auth.models import User
+        from massmedia.models import Image, Video
+        author = User.objects.create(username='ann', first_name='Ann', last_name='Cole')
+        self.images = []
+        for i in range(3):
+            image = Image(title='Harbour %s' % i, slug='harbour-%s' % i, author=author,
+                          mime_type='image/jpeg', external_url=None)
+            image.save()
+            self.images.append(image)
+        self.rendition = Image(title='Harbour small', slug='harbour-small', width=50,
+                               original=self.images[0])
+        self.rendition.save()
+        # Set the files without saving, which would generate thumbnails
+        Image.objects.filter(pk=self.rendition.pk).update(file='image/small.jpg')
+        Image.objects.filter(pk=self.images[1].pk).update(thumbnail='thumb/harbour.jpg')
+        self.video = Video(title='Harbour cam', slug='harbour-cam', mime_type='video/x-flv',
+                           external_url='http://example.com/cam.flv', thumbnail=self.images[1])
+        self.video.save()
+
+    def testBatch(self):
+        import json
+        ids = '%s,%s' % (self.images[1].pk, self.images[0].pk)
+        # The validators, then the objects and their thumbnails or renditions
+        with self.assertNumQueries(6):
+            response = self.client.get('/api/', {'image': ids, 'video': self.video.pk})
+        data = json.loads(response.content)
+        self.assertEqual([i['id'] for i in data['image']], [self.images[1].pk, self.images[0].pk])
+        self.assertEqual(data['image'][0]['thumbnail'], '/media/thumb/harbour.jpg')
+        self.assertEqual(data['image'][0]['author'], 'Ann Cole')
+        self.assertEqual(data['image'][1]['renditions'], [{
+            'id': self.rendition.pk, 'url': '/media/image/small.jpg', 'width': 50, 'height': None}])
+        self.assertEqual(data['image'][1]['url'], '/image/harbour-0/')
+        self.assertEqual(data['video'][0]['thumbnail'], '/media/thumb/harbour.jpg')
+        self.assertEqual(data['video'][0]['media_url'], 'http://example.com/cam.flv')
+
+    def testSparseFields(self):
+        import json
+        from django.test.utils import CaptureQueriesContext
+        from django.db import connection
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/image/', {'fields': 'id,title', 'limit': 2})
+        self.assertEqual(json.loads(response.content)['objects'], [
+            {'id': self.rendition.pk, 'title': 'Harbour small'},
+            {'id': self.images[2].pk, 'title': 'Harbour 2'}])
+        select = queries[-1]['sql']
+        self.assertTrue('"title"' in select)
+        self.assertFalse('"caption"' in select or '"metadata"' in select)
+
+        self.assertEqual(self.client.get('/api/image/', {'fields': 'secret'}).status_code, 400)
+        self.assertEqual(self.client.get('/api/image/', {'ids': '1,x'}).status_code, 400)
+        for limit in ('-1', '0', 'x'):
+            self.assertEqual(self.client.get('/api/image/', {'limit': limit}).status_code, 400)
+        self.assertEqual(self.client.get('/api/collectionrelation/').status_code, 404)
+
+    def testETag(self):
+        response = self.client.get('/api/image/', {'ids': self.images[0].pk})
+        etag = response['ETag']
+        response = self.client.get('/api/image/', {'ids': self.images[0].pk},
+                                   HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        # Other objects and other fields don't share the etag
+        self.assertNotEqual(self.client.get('/api/image/', {'ids': self.images[1].pk})['ETag'], etag)
+        self.assertNotEqual(self.client.get('/api/image/', {'ids': self.images[0].pk,
+                                                            'fields': 'id'})['ETag'], etag)
+        self.images[0].save()
+        response = self.client.get('/api/image/', {'ids': self.images[0].pk},
+                                   HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+
+class StreamingTestCase(TestCase):
+    urls = 'massmedia.tests'
+
+    def setUp(self):
+        from django.core.files.base import ContentFile
+        from massmedia.models import Audio
+        self.audio = Audio(title='Harbour sounds', slug='harbour-sounds', mime_type='audio/mpeg')
+        self.audio.save()
+        self.data = ''.join(chr(i % 256) for i in range(200000))
+        storage = Audio._meta.get_field('file').storage
+        self.name = storage.save('audio/harbour.mp3', ContentFile(self.data))
+        Audio.objects.filter(pk=self.audio.pk).update(file=self.name)
+        self.url = '/file/audio/%s/' % self.audio.pk
+
+    def tearDown(self):
+        from massmedia.models import Audio
+        Audio._meta.get_field('file').storage.delete(self.name)
+
+    def testRanges(self):
+        from massmedia.streaming import parse_range, RangeNotSatisfiable
+        self.assertEqual(parse_range('bytes=0-99', 1000), (0, 99))
+        self.assertEqual(parse_range('bytes=900-', 1000), (900, 999))
+        self.assertEqual(parse_range('bytes=-100', 1000), (900, 999))
+        self.assertEqual(parse_range('bytes=990-2000', 1000), (990, 999))
+        self.assertEqual(parse_range('bytes=0-1,5-6', 1000), None)
+        self.assertEqual(parse_range('items=0-1', 1000), None)
+        self.assertRaises(RangeNotSatisfiable, parse_range, 'bytes=1000-', 1000)
+        self.assertRaises(RangeNotSatisfiable, parse_range, 'bytes=5-1', 1000)
+
+    def testServe(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'audio/mpeg')
+        self.assertEqual(response['Content-Length'], '200000')
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertEqual(''.join(response.streaming_content), self.data)
+
+        response = self.client.get(self.url, HTTP_RANGE='bytes=100000-100099')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 100000-100099/200000')
+        self.assertEqual(''.join(response.streaming_content), self.data[100000:100100])
+
+        response = self.client.get(self.url, HTTP_RANGE='bytes=300000-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */200000')
+
+        etag = self.client.head(self.url)['ETag']
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        # A stale If-Range gets the whole file
+        response = self.client.get(self.url, HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get(self.url, HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE=etag)
+        self.assertEqual(response.status_code, 206)
+
+        self.assertEqual(self.client.get('/file/embed/%s/' % self.audio.pk).status_code, 404)
+        self.audio.public = False
+        self.audio.save()
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+
+    def testSendfile(self):
+        from massmedia import streaming
+        header = streaming.SENDFILE_HEADER
+        try:
+            streaming.SENDFILE_HEADER = 'X-Accel-Redirect'
+            response = self.client.get(self.url, HTTP_RANGE='bytes=0-9')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response['X-Accel-Redirect'], '/protected/%s' % self.name)
+            self.assertEqual(response.content, '')
+            streaming.SENDFILE_HEADER = 'X-Sendfile'
+            response = self.client.get(self.url)
+            self.assertTrue(response['X-Sendfile'].endswith(self.name))
+        finally:
+            streaming.SENDFILE_HEADER = header
+
+
+class MogrifyTestCase(TestCase):
+    urls = 'massmedia.tests'
+
+    def setUp(self):
+        from StringIO import StringIO
+        from django.core.files.base import ContentFile
+        from PIL import Image as PilImage
+        from massmedia.models import Image
+        self.image = Image(title='Harbour', slug='harbour', mime_type='image/png')
+        self.image.save()
+        data = StringIO()
+        PilImage.new('RGB', (400, 300), (0, 90, 160)).save(data, 'PNG')
+        self.storage = Image._meta.get_field('file').storage
+        self.name = self.storage.save('image/harbour.png', ContentFile(data.getvalue()))
+        Image.objects.filter(pk=self.image.pk).update(file=self.name)
+        self.image = Image.objects.get(pk=self.image.pk)
+
+    def tearDown(self):
+        import shutil
+        self.storage.delete(self.name)
+        shutil.rmtree(self.storage.path('mogrify/%s' % self.image.pk), ignore_errors=True)
+
+    def fetch(self, url):
+        from StringIO import StringIO
+        from PIL import Image as PilImage
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return PilImage.open(StringIO(''.join(response.streaming_content)))
+
+    def testTag(self):
+        from massmedia.mogrify import mogrify_url
+        t = Template('{% load media_widgets %}{% mogrify_url image 200 150 crop=True format="png" %}')
+        url = t.render(Context({'image': self.image}))
+        self.assertEqual(url, mogrify_url(self.image.pk, 200, 150, True, 'png'))
+        self.assertTrue(url.startswith('/mogrify/%s/200x150-crop/' % self.image.pk))
+        self.assertTrue(url.endswith('.png'))
+
+    def testResize(self):
+        from massmedia import mogrify
+        im = self.fetch(mogrify.mogrify_url(self.image, 200, ext='jpg'))
+        self.assertEqual((im.format, im.size), ('JPEG', (200, 150)))
+        im = self.fetch(mogrify.mogrify_url(self.image, 100, 100, crop=True, ext='png'))
+        self.assertEqual((im.format, im.size), ('PNG', (100, 100)))
+        # Never scaled up
+        self.assertEqual(self.fetch(mogrify.mogrify_url(self.image, None, 600)).size, (400, 300))
+
+        # Made once, then read from storage
+        generate = mogrify.generate
+        mogrify.generate = lambda *args: self.fail('Variant made again')
+        try:
+            self.fetch(mogrify.mogrify_url(self.image, 200, ext='jpg'))
+        finally:
+            mogrify.generate = generate
+        self.assertTrue(self.storage.exists(mogrify.variant_name(self.image, '200x', 'jpg')))
+
+    def testSignature(self):
+        from massmedia.mogrify import mogrify_url
+        url = mogrify_url(self.image, 200, ext='jpg')
+        self.assertEqual(self.client.get(url.replace('200x', '201x')).status_code, 403)
+        self.assertEqual(self.client.get(url.replace('.jpg', '.png')).status_code, 403)
+        self.assertEqual(self.client.get(mogrify_url(self.image, 200, ext='tif')).status_code, 404)
+        self.assertEqual(self.client.get(mogrify_url(self.image.pk + 1, 200)).status_code, 404)
+
+    def testBusy(self):
+        from massmedia import mogrify
+        from massmedia.locks import get_lock
+        lock = get_lock('massmedia.mogrify.%s' % mogrify.variant_name(self.image, '200x', 'jpg'))
+        lock.acquire()
+        lock_wait, mogrify.LOCK_WAIT = mogrify.LOCK_WAIT, 0.1
+        try:
+            response = self.client.get(mogrify.mogrify_url(self.image, 200, ext='jpg'))
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response['Retry-After'], '1')
+        finally:
+            mogrify.LOCK_WAIT = lock_wait
+            lock.release()
+        self.fetch(mogrify.mogrify_url(self.image, 200, ext='jpg'))
+
+    def testNegotiation(self):
+        from StringIO import StringIO
+        from PIL import Image as PilImage
+        from massmedia import mogrify
+        self.assertEqual(mogrify.negotiate('image/webp,image/*;q=0.8'),
+                         'webp' if 'WEBP' in mogrify.PilImage.SAVE else None)
+        self.assertEqual(mogrify.negotiate('image/webp;q=0,*/*'), None)
+        self.assertEqual(mogrify.negotiate('*/*'), None)
+        self.assertEqual(mogrify.negotiate(None), None)
+
+        url = mogrify.mogrify_url(self.image, 200)
+        response = self.client.get(url, HTTP_ACCEPT='image/png,image/*')
+        self.assertEqual(response['Content-Type'], 'image/png')
+        self.assertTrue('Accept' in response['Vary'])
+        etag = response['ETag']
+        if 'WEBP' in mogrify.PilImage.SAVE:
+            response = self.client.get(url, HTTP_ACCEPT='image/webp,*/*', HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response['Content-Type'], 'image/webp')
+            im = PilImage.open(StringIO(''.join(response.streaming_content)))
+            self.assertEqual(im.size, (200, 150))
+            self.assertTrue(self.storage.exists(mogrify.variant_name(self.image, '200x', 'webp')))
+        response = self.client.get(url, HTTP_ACCEPT='image/png', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertTrue('Accept' in response['Vary'])
+        self.assertFalse('Vary' in self.client.get(mogrify.mogrify_url(self.image, 200, ext='png')))
+
+
+class EncoderTestCase(unittest.TestCase):
+    def setUp(self):
+        import random
+        from PIL import Image as PilImage
+        rand = random.Random(1)
+        # Noise compresses badly, so quality makes a big difference
+        self.im = PilImage.new('RGB', (200, 150))
+        self.im.putdata([(rand.randint(0, 255), rand.randint(0, 120), 90) for i in range(200 * 150)])
+
+    def testBudget(self):
+        from StringIO import StringIO
+        from PIL import Image as PilImage
+        from massmedia import encoder
+        data, quality = encoder.encode(self.im, budget=20000)
+        self.assertTrue(len(data) <= 20000)
+        self.assertTrue(30 <= quality < 90)
+        # The next quality up doesn't fit
+        self.assertTrue(len(encoder.encode_jpeg(self.im, quality + 1)) > 20000)
+        im = PilImage.open(StringIO(data))
+        self.assertEqual(im.format, 'JPEG')
+        self.assertTrue(im.info.get('progressive') or im.info.get('progression'))
+        self.assertFalse('exif' in im.info)
+
+        # A recorded quality gives the same bytes without searching
+        self.assertEqual(encoder.encode(self.im, budget=20000, quality=quality), (data, quality))
+        # Too small a budget gets the lowest quality
+        self.assertEqual(encoder.encode(self.im, budget=100)[1], 30)
+        self.assertEqual(encoder.encode(self.im, budget=None)[1], encoder.DEFAULT_QUALITY)
+
+    def testBenchmark(self):
+        import tempfile
+        from StringIO import StringIO
+        from django.core.management import call_command
+        directory = tempfile.mkdtemp()
+        try:
+            self.im.save(os.path.join(directory, 'noise.png'))
+            open(os.path.join(directory, 'notes.txt'), 'w').write('not an image')
+            out = StringIO()
+            call_command('benchmark_thumbnails', directory, budget='8000', stdout=out)
+            self.assertTrue('noise.png' in out.getvalue())
+            self.assertTrue('1 images:' in out.getvalue())
+        finally:
+            shutil.rmtree(directory)
+
+
+class DerivativesTestCase(TestCase):
+    def setUp(self):
+        import tempfile
+        from PIL import Image as PilImage
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'harbour.jpg')
+        PilImage.new('RGB', (2400, 1600), (0, 90, 160)).save(self.path, 'JPEG')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testCascade(self):
+        from massmedia import derivatives
+        from massmedia.derivatives import Target
+        targets = [Target(200, 200), Target(1200), Target(300, 300, crop=True), Target(4000)]
+        opened = []
+        open_image = derivatives.PilImage.open
+        derivatives.PilImage.open = lambda f: opened.append(f) or open_image(f)
+        try:
+            with open(self.path, 'rb') as f:
+                copies = derivatives.make(f, targets)
+            self.assertEqual(len(opened), 1)
+            independent = derivatives.make_independently(self.path, targets)
+            self.assertEqual(len(opened), 5)
+        finally:
+            derivatives.PilImage.open = open_image
+        sizes = [(200, 133), (1200, 800), (300, 300), (2400, 1600)]
+        self.assertEqual([copies[t].size for t in targets], sizes)
+        self.assertEqual([independent[t].size for t in targets], sizes)
+
+    def testDraft(self):
+        from massmedia import derivatives
+        from massmedia.derivatives import Target
+        with open(self.path, 'rb') as f:
+            im = derivatives.decode(f, [Target(200, 200), Target(500)])
+        # Decoded at 1/4 scale, still big enough for the 500 pixel copy
+        self.assertEqual(im.size, (600, 400))
+
+    def testImageSave(self):
+        from django.core.files.base import ContentFile
+        from massmedia import models, mogrify
+        derivative_settings = models.DERIVATIVES
+        models.DERIVATIVES = (('800x', 'jpg'), ('100x100-crop', 'png'))
+        image = models.Image(title='Harbour', slug='harbour')
+        try:
+            image.file.save('harbour.jpg', ContentFile(open(self.path, 'rb').read()), save=False)
+            image.save()
+            storage = image.file.storage
+            self.assertEqual((image.thumb_width, image.thumb_height), (200, 133))
+            for spec, ext in models.DERIVATIVES:
+                self.assertTrue(storage.exists(mogrify.variant_name(image, spec, ext)))
+        finally:
+            models.DERIVATIVES = derivative_settings
+            shutil.rmtree(storage.path('mogrify/%s' % image.pk), ignore_errors=True)
+            storage.delete(image.thumbnail.name)
+            storage.delete(image.file.name)
+
+
+def _locked_generation(key, directory, start):
+    """
+    Make the file ``result`` in ``directory`` under a lock, logging each
+    time it is made, as a web process making an image variant would
+    """
+    import time
+    from massmedia.locks import single_flight
+    result = os.path.join(directory, 'result')
+
+    def make():
+        open(os.path.join(directory, 'made.log'), 'a').write('made\n')
+        time.sleep(0.2)
+        open(result, 'w').write('variant')
+        return result
+
+    start.wait()
+    single_flight(key, lambda: os.path.exists(result) and result, make)
+
+
+class LockTestCase(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testLocks(self):
+        from massmedia.locks import CacheLock, FileLock, get_lock
+        for lock_class in (CacheLock, FileLock):
+            first, second = lock_class('massmedia.tests.lock'), lock_class('massmedia.tests.lock')
+            self.assertTrue(first.acquire())
+            self.assertFalse(second.acquire())
+            self.assertFalse(second.acquire(wait=0.1))
+            first.release()
+            self.assertTrue(second.acquire())
+            second.release()
+        # The test cache is local to the process
+        self.assertTrue(isinstance(get_lock('massmedia.tests.lock'), FileLock))
+
+    def testSingleFlight(self):
+        from massmedia.locks import LockTimeout, get_lock, single_flight
+        calls = []
+        make = lambda: calls.append(1) or 'made'
+        self.assertEqual(single_flight('massmedia.tests.lock', lambda: 'done', make), 'done')
+        self.assertEqual(single_flight('massmedia.tests.lock', lambda: None, make), 'made')
+        self.assertEqual(calls, [1])
+        lock = get_lock('massmedia.tests.lock')
+        lock.acquire()
+        try:
+            self.assertRaises(LockTimeout, single_flight, 'massmedia.tests.lock',
+                              lambda: None, make, wait=0.1)
+        finally:
+            lock.release()
+
+    def testOneGenerationAcrossProcesses(self):
+        import multiprocessing
+        start = multiprocessing.Event()
+        processes = [multiprocessing.Process(target=_locked_generation,
+                                             args=('massmedia.tests.stampede', self.directory, start))
+                     for i in range(8)]
+        for process in processes:
+            process.start()
+        start.set()
+        for process in processes:
+            process.join(10)
+            self.assertEqual(process.exitcode, 0)
+        self.assertEqual(open(os.path.join(self.directory, 'made.log')).read(), 'made\n')
+
+
+class CountingStorage(object):
+    """
+    Wraps a storage, counting the calls that would go over the network
+    """
+    def __init__(self, storage):
+        self.storage = storage
+        self.calls = []
+
+    def __getattr__(self, name):
+        method = getattr(self.storage, name)
+        def counted(*args, **kwargs):
+            self.calls.append(name)
+            return method(*args, **kwargs)
+        return counted
+
+
+class CachedStorageTestCase(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        from django.core.files.storage import FileSystemStorage
+        from massmedia.storage import CachedStorage
+        self.directory = tempfile.mkdtemp()
+        self.backend = CountingStorage(FileSystemStorage(self.directory, '/files/'))
+        self.storage = CachedStorage(self.backend, cache_alias='default')
+
+    def tearDown(self):
+        from django.core.cache import cache
+        cache.clear()
+        shutil.rmtree(self.directory)
+
+    def testRemembers(self):
+        from django.core.files.base import ContentFile
+        name = self.storage.save('thumb/a.jpg', ContentFile('thumbnail'))
+        del self.backend.calls[:]
+        for i in range(100):
+            self.assertEqual(self.storage.url(name), '/files/thumb/a.jpg')
+            self.assertTrue(self.storage.exists(name))
+            self.assertEqual(self.storage.size(name), 9)
+        self.assertEqual(sorted(self.backend.calls), ['exists', 'size', 'url'])
+
+        # Another process finds the answers in the shared cache
+        from massmedia.storage import CachedStorage
+        other = CountingStorage(self.backend.storage)
+        self.assertEqual(CachedStorage(other, cache_alias='default').size(name), 9)
+        self.assertEqual(other.calls, [])
+
+    def testMissingFilesAreNotRemembered(self):
+        from django.core.files.base import ContentFile
+        self.assertFalse(self.storage.exists('a.txt'))
+        self.backend.storage.save('a.txt', ContentFile('made elsewhere'))
+        self.assertTrue(self.storage.exists('a.txt'))
+        # Taken names are still avoided
+        self.assertNotEqual(self.storage.save('a.txt', ContentFile('again')), 'a.txt')
+
+    def testSaveAndDeleteForget(self):
+        from django.core.files.base import ContentFile
+        name = self.storage.save('a.txt', ContentFile('short'))
+        self.assertEqual(self.storage.size(name), 5)
+        self.assertTrue(self.storage.exists(name))
+        self.storage.delete(name)
+        self.assertFalse(self.storage.exists(name))
+        self.storage.save(name, ContentFile('much longer'))
+        self.assertEqual(self.storage.size(name), 11)
+
+    def testSaveLooksForAFreeNameOnce(self):
+        from django.core.files.base import ContentFile
+        from django.core.files.storage import FileSystemStorage
+        from massmedia.storage import CachedStorage
+        probes = []
+
+        class ProbedStorage(FileSystemStorage):
+            def exists(self, name):
+                probes.append(name)
+                return super(ProbedStorage, self).exists(name)
+        storage = CachedStorage(ProbedStorage(self.directory, '/files/'), cache_alias=None)
+        self.assertEqual(storage.save('b.txt', ContentFile('first')), 'b.txt')
+        self.assertEqual(probes, ['b.txt'])
+        del probes[:]
+        name = storage.save('b.txt', ContentFile('second'))
+        self.assertNotEqual(name, 'b.txt')
+        self.assertEqual(probes, ['b.txt', name])
+        self.assertEqual(storage.open(name).read(), 'second')
+
+    def testBounded(self):
+        from massmedia.storage import LRUCache
+        lru = LRUCache(max_size=2, ttl=60)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        lru.get('a')
+        lru.set('c', 3)
+        self.assertEqual((lru.get('a'), lru.get('c'), lru.get('b', None)), (1, 3, None))
+        self.assertEqual(len(lru), 2)
+        expired = LRUCache(ttl=-1)
+        expired.set('a', 1)
+        self.assertEqual(expired.get('a', None), None)
+
+
+class UploadNameTestCase(unittest.TestCase):
+    def testUniqueNames(self):
+        import re
+        from time import strftime
+        from massmedia.models import Image
+        from massmedia.utils import custom_upload_to, unique_filename
+        upload_to = custom_upload_to('image/%Y/%m')
+        names = set(upload_to(None, 'IMG 0001.JPG') for i in range(1000))
+        self.assertEqual(len(names), 1000)
+        for name in names:
+            self.assertTrue(re.match(r'^%s/img-0001-[0-9a-f]{8}\.jpg$' % strftime('image/%Y/%m'), name), name)
+
+        # Only the suffix of a stored name is replaced, as for thumbnails
+        self.assertEqual(unique_filename('image/img-0001-3f9c2a1b.jpg', 'a1b2c3d4', replace_suffix=True),
+                         'img-0001-a1b2c3d4.jpg')
+        self.assertEqual(unique_filename('holiday-20240101.jpg', 'a1b2c3d4'),
+                         'holiday-20240101-a1b2c3d4.jpg')
+        thumb_upload_to = Image._meta.get_field('thumbnail').upload_to
+        self.assertTrue(re.search(r'/img-0001-[0-9a-f]{8}\.jpg$', thumb_upload_to(None, 'img-0001-3f9c2a1b.jpg')))
+        self.assertEqual(unique_filename(u'\u6771\u4eac.png', 'a1b2c3d4'), 'a1b2c3d4.png')
+        self.assertEqual(unique_filename('README', 'a1b2c3d4'), 'readme-a1b2c3d4')
+        self.assertEqual(len(unique_filename('x' * 200 + '.jpg')), 50 + 9 + 4)
+
+    def testShards(self):
+        import re
+        from massmedia import utils
+        original = utils.UPLOAD_SHARDS
+        utils.UPLOAD_SHARDS = 2
+        try:
+            name = utils.custom_upload_to('doc')(None, 'report.pdf')
+        finally:
+            utils.UPLOAD_SHARDS = original
+        match = re.match(r'^doc/([0-9a-f]{2})/([0-9a-f]{2})/report-([0-9a-f]{8})\.pdf$', name)
+        self.assertTrue(match, name)
+        self.assertTrue(match.group(3).startswith(match.group(1) + match.group(2)))
+
+
+    def testSettingOff(self):
+        from massmedia import utils
+        original = utils.UNIQUE_UPLOAD_NAMES, utils.UPLOAD_SHARDS
+        utils.UNIQUE_UPLOAD_NAMES, utils.UPLOAD_SHARDS = False, 2
+        try:
+            self.assertEqual(utils.custom_upload_to('image')(None, 'Holiday-20240101.JPG'),
+                             'image/holiday-20240101.jpg')
+            self.assertEqual(utils.unique_filename('thumb/img-0001-3f9c2a1b.jpg', replace_suffix=True),
+                             'img-0001-3f9c2a1b.jpg')
+        finally:
+            utils.UNIQUE_UPLOAD_NAMES, utils.UPLOAD_SHARDS = original
+
+
+class ListingIndexTestCase(TestCase):
+    def plan(self, queryset):
+        from django.db import connection
+        sql, params = queryset.query.sql_with_params()
+        cursor = connection.cursor()
+        cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+        return ' '.join(row[-1] for row in cursor.fetchall())
+
+    def index_on(self, model, columns):
+        from django.db import connection
+        cursor = connection.cursor()
+        cursor.execute('PRAGMA index_list(%s)' % model._meta.db_table)
+        for index in cursor.fetchall():
+            cursor.execute('PRAGMA index_info(%s)' % index[1])
+            if [row[2] for row in cursor.fetchall()] == columns:
+                return index[1]
+
+    def testPublicListings(self):
+        from django.db import connection
+        from massmedia.models import Audio, Document, Embed, Flash, Image, Video
+        if connection.vendor != 'sqlite':
+            return
+        for model in (Collection, Image, Video, Audio, Flash, Document, Embed):
+            index = self.index_on(model, ['site_id', 'public', 'creation_date'])
+            self.assertTrue(index, model)
+            plan = self.plan(model.objects.public()[15:30])
+            self.assertTrue(index in plan, (model, plan))
+            # The index gives the order too
+            self.assertFalse('TEMP B-TREE' in plan, (model, plan))
+
+    def testCollectionContents(self):
+        from django.db import connection
+        if connection.vendor != 'sqlite':
+            return
+        index = self.index_on(CollectionRelation, ['collection_id', 'position', 'id'])
+        self.assertTrue(index)
+        plan = self.plan(CollectionRelation.objects.filter(collection=1))
+        self.assertTrue(index in plan, plan)
+        self.assertFalse('TEMP B-TREE' in plan, plan)
+
+    def testSeed(self):
+        from StringIO import StringIO
+        from django.core.management import call_command
+        from massmedia.models import Video
+        out = StringIO()
+        call_command('seed_media', 'video', count='250', batch_size='100', stdout=out)
+        self.assertEqual(Video.objects.count(), 250)
+        self.assertTrue(Video.objects.dates('creation_date', 'year').count() > 1)
+        self.assertTrue(Video._meta.get_field('creation_date').auto_now_add)
+        self.assertTrue('Created 250 video objects' in out.getvalue())
+        self.assertTrue('rebuild_search_index video' in out.getvalue())
+        self.assertTrue('first page of' in out.getvalue())
+
+
+class KeysetPaginationTestCase(TestCase):
+    urls = 'massmedia.tests'
+
+    def setUp(self):
+        import datetime
+        import tempfile
+        from massmedia.models import Embed
+        for i in range(40):
+            Embed(title='Boat %d' % i, slug='boat-%d' % i,
+                  external_url='http://example.com/boat-%d' % i).save()
+        # Every other pair shares its creation date, to check the ties
+        start = datetime.datetime(2013, 1, 1)
+        for embed in Embed.objects.all():
+            Embed.objects.filter(pk=embed.pk).update(
+                creation_date=start + datetime.timedelta(hours=embed.pk // 2))
+        self.expected = list(Embed.objects.order_by('-creation_date', '-pk').values_list('pk', flat=True))
+        self.template_dir = tempfile.mkdtemp()
+        open(os.path.join(self.template_dir, 'site_base.html'), 'w').write(
+            '{% block content %}{% endblock %}')
+
+    def tearDown(self):
+        from django.core.cache import cache
+        cache.clear()
+        shutil.rmtree(self.template_dir)
+
+    def testWalk(self):
+        from massmedia.models import Embed
+        from massmedia.pagination import KeysetPaginator
+        paginator = KeysetPaginator(Embed.objects.public(), 15)
+        pages = [paginator.page()]
+        while pages[-1].has_next():
+            pages.append(paginator.page(pages[-1].next_cursor))
+        self.assertEqual([len(page) for page in pages], [15, 15, 10])
+        self.assertEqual([obj.pk for page in pages for obj in page], self.expected)
+        self.assertFalse(pages[0].has_previous())
+
+        # And back again
+        page = pages[-1]
+        for expected in reversed(pages[:-1]):
+            page = paginator.page(page.previous_cursor)
+            self.assertEqual(list(page), list(expected))
+        self.assertFalse(page.has_previous())
+        self.assertTrue(page.has_next())
+
+    def testApproximateCount(self):
+        from massmedia.models import Embed
+        from massmedia.pagination import KeysetPaginator
+        paginator = KeysetPaginator(Embed.objects.public(), 15)
+        self.assertEqual(paginator.count, 40)
+        Embed.objects.filter(pk=self.expected[0]).delete()
+        with self.assertNumQueries(0):
+            self.assertEqual(paginator.count, 40)
+
+    def testSeek(self):
+        from django.db import connection
+        from massmedia.models import Embed
+        from massmedia.pagination import KeysetPaginator
+        if connection.vendor != 'sqlite':
+            return
+        paginator = KeysetPaginator(Embed.objects.public(), 15)
+        direction, queryset = paginator.seek(paginator.page().next_cursor)
+        sql, params = queryset[:16].query.sql_with_params()
+        cursor = connection.cursor()
+        cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+        plan = ' '.join(row[-1] for row in cursor.fetchall())
+        self.assertTrue('creation_date<' in plan, plan)
+        self.assertFalse('TEMP B-TREE' in plan, plan)
+        self.assertFalse('OFFSET' in sql)
+
+    def testView(self):
+        from massmedia import urls
+        context_processors = settings.TEMPLATE_CONTEXT_PROCESSORS + (
+            'django.core.context_processors.request', )
+        urls.KEYSET_PAGINATION = True
+        try:
+            with self.settings(TEMPLATE_DIRS=(self.template_dir, ),
+                               TEMPLATE_CONTEXT_PROCESSORS=context_processors):
+                response = self.client.get('/embed/')
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual([obj.pk for obj in response.context['object_list']], self.expected[:15])
+                self.assertTrue('About 40 items' in response.content)
+                cursor = response.context['page_obj'].next_cursor
+                self.assertTrue('?cursor=%s' % cursor in response.content)
+                response = self.client.get('/embed/', {'cursor': cursor})
+                self.assertEqual([obj.pk for obj in response.context['object_list']], self.expected[15:30])
+                self.assertEqual(self.client.get('/embed/', {'cursor': 'nonsense'}).status_code, 404)
+        finally:
+            urls.KEYSET_PAGINATION = False
+        with self.settings(TEMPLATE_DIRS=(self.template_dir, )):
+            response = self.client.get('/embed/', {'page': 2})
+        self.assertTrue('Page 2 of 3' in response.content)
+        self.assertTrue('?page=3' in response.content)
+
+
+class MediaIndexTestCase(TestCase):
+    urls = 'massmedia.tests'
+
+    def setUp(self):
+        import tempfile
+        from massmedia.models import Document, Embed
+        self.embed = Embed(title='Harbour at dawn', slug='harbour',
+                           external_url='http://example.com/harbour')
+        self.embed.save()
+        self.document = Document(title='Harbour fees', slug='fees')
+        self.document.save()
+        self.private = Embed(title='Harbour plans', slug='plans', public=False,
+                             external_url='http://example.com/plans')
+        self.private.save()
+        self.template_dir = tempfile.mkdtemp()
+        open(os.path.join(self.template_dir, 'site_base.html'), 'w').write(
+            '{% block content %}{% endblock %}')
+
+    def tearDown(self):
+        shutil.rmtree(self.template_dir)
+
+    def get(self, path, data=None):
+        context_processors = settings.TEMPLATE_CONTEXT_PROCESSORS + (
+            'django.core.context_processors.request', )
+        with self.settings(TEMPLATE_DIRS=(self.template_dir, ),
+                           TEMPLATE_CONTEXT_PROCESSORS=context_processors):
+            return self.client.get(path, data or {})
+
+    def testSignals(self):
+        from massmedia.models import MediaIndex
+        self.assertEqual([(e.mediatype, e.slug) for e in MediaIndex.objects.all()],
+                         [('embed', 'plans'), ('document', 'fees'), ('embed', 'harbour')])
+        self.assertEqual(MediaIndex.objects.get(slug='plans').public, False)
+        self.document.title = 'Harbour dues'
+        self.document.save()
+        self.assertEqual(MediaIndex.objects.get(slug='fees').title, 'Harbour dues')
+        self.document.delete()
+        self.assertEqual(MediaIndex.objects.filter(slug='fees').count(), 0)
+
+        # A deferred object, as the changelist saves, is a proxy class instance
+        from massmedia.models import Embed
+        embed = Embed.objects.defer('caption', 'metadata').get(pk=self.embed.pk)
+        self.assertTrue(embed._deferred)
+        embed.public = False
+        embed.save()
+        self.assertEqual(list(MediaIndex.objects.public()), [])
+        embed.delete()
+        self.assertEqual(MediaIndex.objects.filter(slug='harbour').count(), 0)
+
+    def testOneWritePerSave(self):
+        from massmedia import utils
+        from massmedia.models import Embed, MediaIndex
+        saved = []
+        utils.connect_media_signals([Embed], saved.append, lambda obj: None)
+        try:
+            self.embed.title = 'Harbour at dusk'
+            self.embed.save()
+            created = Embed.objects.create(title='Regatta', slug='regatta',
+                                           external_url='http://example.com/regatta')
+        finally:
+            utils._media_handlers[Embed].pop()
+        self.assertEqual(saved, [self.embed, created])
+        self.assertEqual(MediaIndex.objects.get(slug='regatta').title, 'Regatta')
+
+    def testListing(self):
+        from massmedia import mediaindex
+        from massmedia.models import MediaIndex
+        with self.assertNumQueries(1):
+            self.assertEqual([e.slug for e in MediaIndex.objects.public()], ['fees', 'harbour'])
+        self.assertEqual([e.slug for e in mediaindex.find('dawn HARBOUR')], ['harbour'])
+        self.assertEqual(mediaindex.resolve('harbour').content_object, self.embed)
+        self.assertEqual(mediaindex.resolve('plans'), None)
+
+    def testThumbnails(self):
+        from massmedia.mediaindex import index_object, thumb_url
+        from massmedia.models import Image, MediaIndex, Video
+        image = Image(title='Still', slug='still')
+        image.save()
+        video = Video(title='Regatta', slug='regatta', thumbnail=image)
+        video.save()
+        self.assertEqual(MediaIndex.objects.get(slug='regatta').thumb_url, '')
+        Image.objects.filter(pk=image.pk).update(thumbnail='thumb/still.jpg', thumb_width=200, thumb_height=150)
+        image = Image.objects.get(pk=image.pk)
+        # What saving it does, without reading the missing file
+        index_object(image)
+        self.assertEqual(thumb_url(image), '/media/thumb/still.jpg')
+        self.assertEqual(MediaIndex.objects.get(slug='still').thumb_url, '/media/thumb/still.jpg')
+        self.assertEqual(MediaIndex.objects.get(slug='regatta').thumb_url, '/media/thumb/still.jpg')
+
+    def testViews(self):
+        response = self.get('/latest/')
+        self.assertEqual([e.slug for e in response.context['object_list']], ['fees', 'harbour'])
+        self.assertTrue('Harbour at dawn' in response.content)
+        response = self.get('/latest/', {'q': 'fees'})
+        self.assertEqual([e.slug for e in response.context['object_list']], ['fees'])
+        self.assertEqual(self.get('/latest/', {'cursor': 'nonsense'}).status_code, 404)
+
+        response = self.get('/find/harbour/')
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response['Location'].endswith('/embed/harbour/'))
+        self.assertEqual(self.get('/find/plans/').status_code, 404)
+
+        response = self.get('/widget/harbour/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['media'], self.embed)
+
+        response = self.get('/')
+        self.assertEqual([e.slug for e in response.context['latest']], ['fees', 'harbour'])
+
+    def testRebuild(self):
+        from StringIO import StringIO
+        from django.core.management import call_command
+        from massmedia.models import MediaIndex
+        MediaIndex.objects.all().delete()
+        MediaIndex.objects.create(content_type_id=self.embed.pk + 100, object_id=1, slug='gone',
+                                  title='Gone', creation_date=self.embed.creation_date,
+                                  site_id=self.embed.site_id)
+        out = StringIO()
+        call_command('rebuild_media_index', 'embed', stdout=out)
+        self.assertTrue('Indexed 2 embed objects' in out.getvalue())
+        call_command('rebuild_media_index', stdout=out)
+        self.assertEqual(sorted(MediaIndex.objects.values_list('slug', flat=True)),
+                         ['fees', 'gone', 'harbour', 'plans'])
+
+
+class ImportWatchTestCase(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        from massmedia.management.commands import import_images
+        self.directory = tempfile.mkdtemp()
+        self.archive = os.path.join(self.directory, 'archive')
+        os.mkdir(self.archive)
+        self.manifest = import_images.ScanManifest(os.path.join(self.directory, 'manifest.json'))
+        self.watcher = import_images.DirectoryWatcher(self.directory)
+        self.pending = {}
+        imported = self.imported = []
+
+        class Command(import_images.Command):
+            def import_local_image(self, image, archived_path):
+                imported.append(open(image, 'rb').read())
+                self.archive(image, archived_path)
+
+        self.command = Command()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def drop(self, name, data, mtime=1000000000):
+        path = os.path.join(self.directory, name)
+        open(path, 'wb').write(data)
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def scan(self, settle=0):
+        import sys
+        from StringIO import StringIO
+        stdout, sys.stdout = sys.stdout, StringIO()
+        try:
+            self.command.scan(self.directory, self.archive, self.watcher, self.manifest,
+                              self.pending, 0, settle)
+        finally:
+            sys.stdout = stdout
+
+    def testImportAndPrune(self):
+        self.drop('a.jpg', 'first')
+        self.drop('notes.txt', 'not an image')
+        self.scan(settle=60)  # Not settled yet
+        self.assertEqual(self.imported, [])
+        self.scan()
+        self.assertEqual(self.imported, ['first'])
+        self.assertTrue(os.path.exists(os.path.join(self.archive, 'a.jpg')))
+        # Archived files aren't kept in the manifest
+        self.assertEqual(self.manifest.entries, {})
+        self.manifest.update('gone.jpg', (1, 1), 'x')
+        self.scan()
+        self.assertEqual(self.manifest.entries, {})
+
+    def testEditedInPlace(self):
+        # A file the archive couldn't take stays in the manifest
+        self.command.archive = lambda image, archived_path: None
+        path = self.drop('a.jpg', 'first')
+        self.scan()
+        self.scan()
+        self.assertEqual(self.imported, ['first'])
+        self.assertTrue('a.jpg' in self.manifest.entries)
+        self.assertEqual(len(self.imported), 1)
+        # The directory isn't listed again while its mtime stays the same
+        os.utime(self.directory, (1000000000, 1000000000))
+        self.scan()
+        listdir, listings = os.listdir, []
+        os.listdir = lambda path: listings.append(path) or listdir(path)
+        try:
+            self.scan()
+            self.assertEqual(listings, [])
+            # Rewriting a file doesn't change the directory's mtime
+            self.drop('a.jpg', 'second', mtime=1000000100)
+            os.utime(self.directory, (1000000000, 1000000000))
+            self.scan()
+            self.assertEqual(listings, [])
+        finally:
+            os.listdir = listdir
+        self.assertEqual(self.imported, ['first', 'second'])
+        # Touched without a change, it isn't imported again
+        os.utime(path, (1000000200, 1000000200))
+        self.scan()
+        self.scan()
+        self.assertEqual(len(self.imported), 2)
+
+    def testDroppedAgain(self):
+        self.drop('a.jpg', 'first')
+        self.scan()
+        self.scan()
+        self.drop('a.jpg', 'first', mtime=1000000100)
+        self.scan()
+        self.scan()
+        # Archived without importing it twice
+        self.assertEqual(self.imported, ['first'])
+        self.assertFalse(os.path.exists(os.path.join(self.directory, 'a.jpg')))
+        self.assertEqual(self.manifest.entries, {})
+        # Different content under the same name is imported
+        self.drop('a.jpg', 'second')
+        self.scan()
+        self.scan()
+        self.assertEqual(self.imported, ['first', 'second'])
+
+
+GRAB_FEED = """<?xml version="1.0" encoding="UTF-8"?>
+<videos>
+  <video><id>101</id><title>Regatta</title><summary>Boats</summary>
+    <preview-url>http://example.com/previews/regatta.png?size=large</preview-url>
+    <created-at>2013-05-01T10:00:00Z</created-at><keywords>boats, sails</keywords></video>
+  <video><id>102</id><summary>No title</summary></video>
+  <video><id>103</id><title>Bad date</title>
+    <preview-url>http://example.com/previews/baddate.png</preview-url>
+    <created-at>yesterday</created-at></video>
+  <video><title>No id</title></video>
+  <video><id>104</id><title>Harbour</title></video>
+</videos>
+"""
+
+
+class FakePool(object):
+    def __init__(self, data):
+        self.data = data
+
+    def map(self, func, urls):
+        return [self.data if url else None for url in urls]
+
+
+class GrabImportTestCase(TestCase):
+    def setUp(self):
+        from StringIO import StringIO
+        from PIL import Image as PilImage
+        from massmedia.management.commands import grab_from_grab
+        out = StringIO()
+        PilImage.new('RGB', (40, 30), (0, 80, 160)).save(out, 'PNG')
+        self.pool = FakePool(out.getvalue())
+        self.command = grab_from_grab.Command()
+        self.command.layout = '851501'
+        self.command.stderr = StringIO()
+        self.batch = list(grab_from_grab.iter_videos(StringIO(GRAB_FEED)))
+
+    def previews(self, prefix):
+        import fnmatch
+        found = []
+        for dirpath, dirnames, filenames in os.walk(settings.MEDIA_ROOT):
+            found.extend(name for name in filenames if fnmatch.fnmatch(name, prefix + '*'))
+        return found
+
+    def testBadEntriesAreSkipped(self):
+        from massmedia.models import Video
+        self.assertEqual(self.command.import_batch(self.batch, self.pool), 2)
+        self.assertEqual(sorted(Video.objects.values_list('slug', flat=True)),
+                         ['grab-v101', 'grab-v104'])
+        video = Video.objects.get(slug='grab-v101')
+        self.assertEqual(video.creation_date.year, 2013)
+        self.assertEqual(video.metadata['keywords'], ['boats', 'sails'])
+        self.assertTrue(video.thumbnail.file.name)
+        errors = self.command.stderr.getvalue()
+        self.assertTrue('V102' in errors and 'V103' in errors and 'without an id' in errors)
+        self.assertFalse(self.previews('baddate'))
+        # Imported videos are skipped the next time
+        self.assertEqual(self.command.import_batch(self.batch, self.pool), 0)
+
+    def testFailedVideoPreviewsAreDeleted(self):
+        from massmedia.models import Image, Video
+        create_video = self.command.create_video
+
+        def failing(slug, d, preview, files):
+            create_video(slug, d, preview, files)
+            if slug == 'grab-v101':
+                raise ValueError('Broken')
+
+        self.command.create_video = failing
+        existing = self.previews('regatta')
+        self.assertEqual(self.command.import_batch(self.batch, self.pool), 1)
+        self.assertEqual(list(Video.objects.values_list('slug', flat=True)), ['grab-v104'])
+        self.assertFalse(Image.objects.filter(slug='grab-v101-preview').exists())
+        self.assertEqual(self.previews('regatta'), existing)
+        self.assertTrue('Broken' in self.command.stderr.getvalue())
+
+    def testRolledBackPreviewsAreDeleted(self):
+        from massmedia.models import Video
+        create_video = self.command.create_video
+
+        def interrupted(slug, d, preview, files):
+            if slug == 'grab-v104':
+                raise KeyboardInterrupt
+            return create_video(slug, d, preview, files)
+
+        self.command.create_video = interrupted
+        existing = self.previews('regatta')
+        self.assertRaises(KeyboardInterrupt, self.command.import_batch, self.batch, self.pool)
+        self.assertEqual(Video.objects.count(), 0)
+        self.assertEqual(self.previews('regatta'), existing)
@@ -3,7 +3,11 @@ from django.views.generic.detail import DetailView
 from django.views.generic.list import ListView
 from django.views.generic.base import TemplateView
 from django.http import HttpResponseNotFound
-from models import Collection, Image, Video, Audio, Flash, Document, Embed
+from conditional import (add_cache_headers, list_validators, not_modified,
+    object_validators)
+from models import Collection, Image, Video, Audio, Flash, Document, Embed, MediaIndex
+from pagination import KeysetListView
+from settings import KEYSET_PAGINATION, PAGE_CACHE_CONTROL
 
 
 media_dict = {
@@ -29,13 +33,15 @@ class MediaIndexView(TemplateView):
 
     def get_context_data(self, **kwargs):
         kwargs['media'] = media_dict
+        kwargs['latest'] = MediaIndex.objects.public()[:10]
         return super(MediaIndexView, self).get_context_data(**kwargs)
 
 
 def generic_wrapper(request, *args, **kwargs):
     """
     This allows us to get the mediatype variable from the url and pass the
-    correct queryset to the generic view
+    correct queryset to the generic view, answering conditional requests
+    without rendering it
     """
     if 'mediatype' in kwargs and kwargs['mediatype'] in media_dict:
         mediatype = kwargs.pop('mediatype')
@@ -47,11 +53,25 @@ def generic_wrapper(request, *args, **kwargs):
         if 'enlarge' in kwargs:
             kwargs.pop('enlarge')
             kwargs['template_name'] = 'massmedia/enlarge_%s_detail.html' % mediatype
-        if 'slug' in kwargs or 'object_id' in kwargs:
-            return DetailView.as_view(queryset=queryset)(request, *args, **kwargs)
-        if 'template_name' not in kwargs:
-            kwargs['template_name'] = 'massmedia/list.html'
-        return ListView.as_view(queryset=queryset)(request, *args, **kwargs)
+        if 'slug' in kwargs:
+            validators = object_validators(queryset.filter(slug=kwargs['slug']))
+            view = DetailView
+        elif 'object_id' in kwargs:
+            kwargs['pk'] = kwargs.pop('object_id')
+            validators = object_validators(queryset.filter(pk=kwargs['pk']))
+            view = DetailView
+        else:
+            if 'template_name' not in kwargs:
+                kwargs['template_name'] = 'massmedia/list.html'
+            validators = list_validators(queryset)
+            view = KeysetListView if KEYSET_PAGINATION else ListView
+        response = not_modified(request, *validators, cache_control=PAGE_CACHE_CONTROL)
+        if response is None:
+            initkwargs = dict((key, kwargs.pop(key)) for key in ('template_name', 'paginate_by')
+                              if key in kwargs)
+            response = view.as_view(queryset=queryset, **initkwargs)(request, *args, **kwargs)
+            add_cache_headers(response, *validators, cache_control=PAGE_CACHE_CONTROL)
+        return response
     return HttpResponseNotFound()
 
 urlpatterns = patterns('',
@@ -59,6 +79,42 @@ urlpatterns = patterns('',
         r'^$',
         MediaIndexView.as_view(),
         name="massmedia_index"),
+    url(
+        r'^search/$',
+        'massmedia.views.search',
+        name="massmedia_search"),
+    url(
+        r'^autocomplete/$',
+        'massmedia.views.autocomplete',
+        name="massmedia_autocomplete"),
+    url(
+        r'^api/$',
+        'massmedia.api.media_batch',
+        name="massmedia_api"),
+    url(
+        r'^api/(?P<mediatype>\w+)/$',
+        'massmedia.api.media_list',
+        name="massmedia_api_list"),
+    url(
+        r'^file/(?P<mediatype>\w+)/(?P<object_id>\d+)/$',
+        'massmedia.streaming.serve_file',
+        name="massmedia_file"),
+    url(
+        r'^mogrify/(?P<image_id>\d+)/(?P<spec>[-\w]+)/(?P<signature>[0-9a-f]+)\.(?P<ext>\w+)$',
+        'massmedia.mogrify.mogrify',
+        name="massmedia_mogrify"),
+    url(
+        r'^latest/$',
+        'massmedia.views.latest',
+        name="massmedia_latest"),
+    url(
+        r'^find/(?P<slug>[-\w]+)/$',
+        'massmedia.views.find',
+        name="massmedia_find"),
+    url(
+        r'^widget/(?P<slug>[-\w]+)/$',
+        'massmedia.views.widget_by_slug',
+        name="massmedia_widget_by_slug"),
     url(
         r'^(?P<enlarge>enlarge)/(?P<mediatype>\w+)/(?P<slug>[-\w]+)/$',
         generic_wrapper,
@@ -2,10 +2,34 @@
 Miscellaneous utility functions
 """
 
+import logging
 import os
+import re
+import threading
+import uuid
+from multiprocessing.pool import ThreadPool
 from time import strftime
+from django.core.signals import got_request_exception, request_finished
+from django.db import connection
+from django.db.models.signals import post_delete, post_save
 from django.template.defaultfilters import slugify
 
+from massmedia.settings import DEFER_THREADS, UNIQUE_UPLOAD_NAMES, UPLOAD_SHARDS
+
+logger = logging.getLogger(__name__)
+
+# The calls deferred by each thread, and the threads running them
+_deferred = threading.local()
+_pool = None
+_pool_lock = threading.Lock()
+
+# The (on_save, on_delete) handlers of each media model, set by connect_media_signals
+_media_handlers = {}
+
+UNIQUE_SUFFIX_LENGTH = 8
+UNIQUE_SUFFIX_RE = re.compile(r'-[0-9a-f]{%d}$' % UNIQUE_SUFFIX_LENGTH)
+MAX_SLUG_LENGTH = 50  # Leaves room for the directories in a 100 character FileField
+
 
 def value_or_list(val):
     """
@@ -41,23 +65,140 @@ def super_force_ascii(bad_string):
     return output.encode('ascii', 'xmlcharrefreplace')
 
 
-def custom_upload_to(prefix_path):
+def unique_filename(filename, token=None, replace_suffix=False):
     """
-    return a function that will build a custom file name
+    ``filename`` as a slug with a short random suffix, which makes names
+    unique without asking the storage which ones are taken. With
+    ``replace_suffix``, ``filename`` is a name made here, such as that of
+    the original a thumbnail is made from, and its suffix is replaced rather
+    than added to. Without ``UNIQUE_UPLOAD_NAMES`` it is only slugified.
+    """
+    filename = os.path.basename(filename)
+    name, dot, extension = filename.rpartition('.')
+    if not UNIQUE_UPLOAD_NAMES:
+        return '%s.%s' % (slugify(name), extension.lower())
+    if not dot:
+        name, extension = extension, ''
+    slug = slugify(name)
+    if replace_suffix:
+        slug = UNIQUE_SUFFIX_RE.sub('', slug)
+    slug = slug[:MAX_SLUG_LENGTH].strip('-_')
+    token = token or uuid.uuid4().hex[:UNIQUE_SUFFIX_LENGTH]
+    slug = '%s-%s' % (slug, token) if slug else token
+    if extension:
+        return '%s.%s' % (slug, extension.lower())
+    return slug
+
+
+def custom_upload_to(prefix_path, replace_suffix=False):
+    """
+    return a function that will build a custom file name. ``replace_suffix``
+    is for fields whose files are named after files stored by another one.
     """
     def upload_callback(instance, filename):
         """
         Clean the initial file name and build a destination path based on
-        settings as prefix_path
+        settings as prefix_path, spread over ``UPLOAD_SHARDS`` levels of
+        subdirectories named from the file's random suffix
         """
-        # Split and clean the filename with slugify
-        filename = os.path.basename(filename)
-        name, dot, extension = filename.rpartition('.')
-        slug = slugify(name)
-        clean_filename = '%s.%s' % (slug, extension.lower())
+        token = uuid.uuid4().hex[:UNIQUE_SUFFIX_LENGTH]
+        clean_filename = unique_filename(filename, token, replace_suffix)
+        shards = []
+        if UNIQUE_UPLOAD_NAMES:
+            shards = [token[i * 2:i * 2 + 2] for i in range(min(UPLOAD_SHARDS, len(token) // 2))]
         # Build a destination path with previous cleaned string.
-        destination_path = os.path.join(strftime(prefix_path), clean_filename)
+        destination_path = os.path.join(strftime(prefix_path), *(shards + [clean_filename]))
 
         return destination_path
 
     return upload_callback
+
+
+def run_in_background(func, *args, **kwargs):
+    """
+    Run ``func`` on one of ``DEFER_THREADS`` background threads so the
+    caller doesn't wait for it. Exceptions are logged, since there is nobody
+    to raise them to.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPool(DEFER_THREADS)
+    _pool.apply_async(_run, (func, args, kwargs))
+
+
+def _run(func, args, kwargs):
+    try:
+        func(*args, **kwargs)
+    except Exception:
+        logger.exception("Deferred call to %r failed", func)
+    finally:
+        # Each thread has its own database connection, don't leak it
+        connection.close()
+
+
+def defer(func, *args, **kwargs):
+    """
+    Run ``func`` in the background once the current request has finished,
+    or straight away outside of a transaction. The background threads have
+    their own database connections, which can't see what the request hasn't
+    committed yet.
+
+    The calls are kept for the thread making them and started by the
+    ``request_finished`` signal, or dropped by ``got_request_exception``.
+    Code deferring calls in a transaction outside of a request, such as a
+    management command, calls ``run_deferred`` once it has committed.
+    """
+    if not connection.in_atomic_block:
+        run_in_background(func, *args, **kwargs)
+        return
+    if not hasattr(_deferred, 'calls'):
+        _deferred.calls = []
+    _deferred.calls.append((func, args, kwargs))
+
+
+def run_deferred(sender=None, **kwargs):
+    """
+    Start the calls deferred by this thread
+    """
+    calls, _deferred.calls = getattr(_deferred, 'calls', []), []
+    for func, args, kwargs in calls:
+        run_in_background(func, *args, **kwargs)
+
+
+def discard_deferred(sender=None, **kwargs):
+    """
+    Drop the calls deferred by this thread, whose transaction failed
+    """
+    _deferred.calls = []
+
+
+request_finished.connect(run_deferred, dispatch_uid='massmedia.utils.run_deferred')
+got_request_exception.connect(discard_deferred, dispatch_uid='massmedia.utils.discard_deferred')
+
+
+def connect_media_signals(models, on_save, on_delete):
+    """
+    Call ``on_save(obj)`` and ``on_delete(obj)`` as objects of ``models`` are
+    saved and deleted. Every caller shares one pair of receivers, connected
+    for every sender since deferred objects, such as those a changelist
+    saves, are instances of a proxy class.
+    """
+    for model in models:
+        handlers = _media_handlers.setdefault(model, [])
+        if (on_save, on_delete) not in handlers:
+            handlers.append((on_save, on_delete))
+    post_save.connect(media_saved, dispatch_uid='massmedia.utils.media_saved')
+    post_delete.connect(media_deleted, dispatch_uid='massmedia.utils.media_deleted')
+
+
+def media_saved(sender, instance, raw=False, **kwargs):
+    if raw or instance.__dict__.get('_incomplete'):
+        return
+    for on_save, on_delete in _media_handlers.get(instance._meta.concrete_model, ()):
+        on_save(instance)
+
+
+def media_deleted(sender, instance, **kwargs):
+    for on_save, on_delete in _media_handlers.get(instance._meta.concrete_model, ()):
+        on_delete(instance)
@@ -1,13 +1,24 @@
-from massmedia import models
+import json
+
+from massmedia import models, settings
 
 from django.contrib.contenttypes.models import ContentType
+from django.contrib.sites.models import Site
 from django.core.exceptions import ObjectDoesNotExist
+from django.core.paginator import Paginator, InvalidPage
 from django.http import Http404, HttpResponse
-from django.shortcuts import render_to_response, get_object_or_404
+from django.shortcuts import redirect, render_to_response, get_object_or_404
 from django.template import RequestContext
 
 
 from django.contrib.admin.options import IS_POPUP_VAR
+from django.contrib.admin.views.decorators import staff_member_required
+
+from massmedia import mediaindex
+from massmedia.autocomplete import titles
+from massmedia.conditional import add_cache_headers, not_modified, object_validators
+from massmedia.pagination import InvalidCursor, KeysetPaginator
+from massmedia.search import search_objects
 
 
 def widget(request, id, type):
@@ -16,15 +27,66 @@ def widget(request, id, type):
         model = getattr(models, type.capitalize())
     except AssertionError:
         raise Http404
+    validators = object_validators(model.objects.filter(pk=id))
+    # The editor inlines unpublished media too, which mustn't be shared
+    if model.objects.public().filter(pk=id).exists():
+        cache_control = settings.PAGE_CACHE_CONTROL
+    else:
+        cache_control = {'private': True}
+    response = not_modified(request, *validators, cache_control=cache_control)
+    if response is not None:
+        return response
     try:
-        return render_to_response('massmedia/inline.html', {
+        response = render_to_response('massmedia/inline.html', {
             'media': model.objects.get(pk=id),
             'type': type
         }, context_instance=RequestContext(request))
+        return add_cache_headers(response, *validators, cache_control=cache_control)
     except model.DoesNotExist:
         return HttpResponse('%s #%s not found' % (type, id))
 
 
+def widget_by_slug(request, slug):
+    """
+    The widget of the public media with ``slug``, whatever its type
+    """
+    entry = mediaindex.resolve(slug)
+    if entry is None:
+        raise Http404
+    return widget(request, entry.object_id, entry.mediatype)
+
+
+def find(request, slug):
+    """
+    Redirect to the public media with ``slug``, whatever its type
+    """
+    entry = mediaindex.resolve(slug)
+    if entry is None:
+        raise Http404
+    return redirect(entry.get_absolute_url())
+
+
+def latest(request, paginate_by=15, template_name='massmedia/latest.html'):
+    """
+    Public media of every type, newest first, paged with a ``cursor``
+    parameter. A ``q`` parameter keeps the media whose titles contain its
+    words.
+    """
+    query = request.GET.get('q', '').strip()
+    paginator = KeysetPaginator(mediaindex.find(query), paginate_by)
+    try:
+        page = paginator.page(request.GET.get('cursor'))
+    except InvalidCursor:
+        raise Http404
+    return render_to_response(template_name, {
+        'query': query,
+        'object_list': page.object_list,
+        'page_obj': page,
+        'paginator': paginator,
+        'is_paginated': page.has_other_pages(),
+    }, context_instance=RequestContext(request))
+
+
 def list_by_collection_by_type(request, slug, type):
     ctype = get_object_or_404(ContentType, name=type)
     return render_to_response('massmedia/list.html', {
@@ -35,6 +97,54 @@ def list_by_collection_by_type(request, slug, type):
     }, context_instance=RequestContext(request))
 
 
+def search(request, paginate_by=15, template_name='massmedia/search.html'):
+    """
+    Public media matching the ``q`` parameter, best match first. A ``type``
+    parameter limits the search to one media type.
+    """
+    query = request.GET.get('q', '').strip()
+    mediatype = request.GET.get('type', '')
+    querysets = [model.objects.public() for model in models.SEARCH_MODELS
+                 if not mediatype or model._meta.object_name.lower() == mediatype]
+    object_list = []
+    if query and querysets:
+        object_list = search_objects(query, querysets, public=True,
+                                     site=Site.objects.get_current())
+    paginator = Paginator(object_list, paginate_by)
+    try:
+        page = paginator.page(request.GET.get('page', 1))
+    except InvalidPage:
+        raise Http404
+    return render_to_response(template_name, {
+        'query': query,
+        'mediatype': mediatype,
+        'object_list': page.object_list,
+        'page': page,
+        'is_paginated': page.has_other_pages(),
+    }, context_instance=RequestContext(request))
+
+
+@staff_member_required
+def autocomplete(request):
+    """
+    Media whose titles have words starting with the words of ``q``, as JSON.
+    ``type`` limits the suggestions to a comma separated list of media types
+    and ``limit`` lowers the number returned.
+    """
+    if not settings.AUTOCOMPLETE:
+        raise Http404
+    types = dict((m._meta.object_name.lower(), m) for m in models.SEARCH_MODELS)
+    ctypes = dict((ContentType.objects.get_for_model(m).pk, name) for name, m in types.items())
+    wanted = [types[t] for t in request.GET.get('type', '').split(',') if t in types]
+    try:
+        limit = int(request.GET.get('limit', settings.AUTOCOMPLETE_LIMIT))
+    except ValueError:
+        limit = settings.AUTOCOMPLETE_LIMIT
+    suggestions = [{'type': ctypes[ct_id], 'id': pk, 'title': title} for ct_id, pk, title in
+                   titles.lookup(request.GET.get('q', ''), wanted, limit)]
+    return HttpResponse(json.dumps(suggestions), content_type='application/json')
+
+
 def mediatype_detail(request, queryset, object_id=None, slug=None,
             slug_field='slug', template_name=None, template_name_field=None,
             template_loader=None, extra_context=None,
@@ -50,6 +160,10 @@ def mediatype_detail(request, queryset, object_id=None, slug=None,
         queryset = queryset.filter(**{slug_field: slug})
     else:
         raise AttributeError("Generic media detail view must be called with either an object_id or a slug/slug_field.")
+    validators = object_validators(queryset)
+    response = not_modified(request, *validators, cache_control=settings.PAGE_CACHE_CONTROL)
+    if response is not None:
+        return response
     try:
         obj = queryset.get()
     except ObjectDoesNotExist:
@@ -64,7 +178,7 @@ def mediatype_detail(request, queryset, object_id=None, slug=None,
         else:
             c[key] = value
     response = HttpResponse(t.render(c), mimetype=mimetype)
-    return response
+    return add_cache_headers(response, *validators, cache_control=settings.PAGE_CACHE_CONTROL)
 
 
 def browse(request):
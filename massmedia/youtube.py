@@ -1,8 +1,135 @@
+try:
+    from xml.etree import cElementTree as ElementTree
+except ImportError:
+    from xml.etree import ElementTree
+
+from hashlib import md5
+
 from gdata.youtube.service import YouTubeService, YOUTUBE_PLAYLIST_FEED_URI
 from massmedia import settings
+from massmedia.caching import get_or_refresh
 from django.http import QueryDict
+from django.utils.encoding import smart_str
 from urlparse import urlparse
 
+# Bump when the layout returned by parse_playlist changes, so cached copies
+# in the old layout are ignored.
+PLAYLIST_VERSION = 1
+
+ATOM = '{http://www.w3.org/2005/Atom}'
+MEDIA = '{http://search.yahoo.com/mrss/}'
+OPENSEARCH = '{http://a9.com/-/spec/opensearchrss/1.0/}'
+YT = '{http://gdata.youtube.com/schemas/2007}'
+
+
+def _parse_media_group(group):
+    """
+    Return the parts of a ``<media:group>`` that the templates use
+    """
+    media = {'thumbnail': [], 'content': []}
+    for child in group:
+        tag = child.tag
+        if tag == MEDIA + 'thumbnail':
+            media['thumbnail'].append({
+                'url': child.get('url'),
+                'width': child.get('width'),
+                'height': child.get('height'),
+            })
+        elif tag == MEDIA + 'content':
+            if child.get('isDefault'):
+                media['content'].append({
+                    'url': child.get('url'),
+                    'type': child.get('type'),
+                    'duration': child.get('duration'),
+                })
+        elif tag == MEDIA + 'player':
+            media['player'] = child.get('url')
+        elif tag == YT + 'duration':
+            media['duration'] = child.get('seconds')
+        elif tag == YT + 'videoid':
+            media['videoid'] = child.text
+        elif tag in (MEDIA + 'title', MEDIA + 'description', MEDIA + 'keywords'):
+            media[tag[len(MEDIA):]] = child.text or ''
+    return media
+
+
+def _parse_entry(element):
+    entry = {}
+    for child in element:
+        tag = child.tag
+        if tag in (ATOM + 'title', ATOM + 'updated', ATOM + 'published'):
+            entry[tag[len(ATOM):]] = child.text or ''
+        elif tag == ATOM + 'content':
+            entry['description'] = child.text or ''
+        elif tag == ATOM + 'link' and child.get('rel') == 'alternate':
+            entry['url'] = child.get('href')
+        elif tag == MEDIA + 'group':
+            entry['media'] = _parse_media_group(child)
+        elif tag == YT + 'statistics':
+            entry['statistics'] = {
+                'view_count': child.get('viewCount'),
+                'favorite_count': child.get('favoriteCount'),
+            }
+        elif tag == YT + 'position':
+            entry['position'] = child.text
+    entry['id'] = entry.get('media', {}).get('videoid')
+    return entry
+
+
+def parse_playlist(xml):
+    """
+    Convert the XML of a playlist feed into the compact form that is cached::
+
+        {'version': PLAYLIST_VERSION,
+         'metadata': {'title', 'subtitle', 'updated', 'playlistId', 'logo',
+                      'url', 'total_results', 'start_index', 'items_per_page'},
+         'entries': [{'id', 'title', 'description', 'published', 'updated',
+                      'url', 'position', 'statistics',
+                      'media': {'title', 'description', 'keywords', 'player',
+                                'duration', 'videoid', 'thumbnail',
+                                'content'}}, ...]}
+
+    It only contains plain dicts, lists and strings, and is built in a single
+    pass over the elements of the feed.
+    """
+    metadata = {}
+    entries = []
+    for child in ElementTree.fromstring(xml):
+        tag = child.tag
+        if tag == ATOM + 'entry':
+            entries.append(_parse_entry(child))
+        elif tag in (ATOM + 'title', ATOM + 'subtitle', ATOM + 'updated', ATOM + 'logo'):
+            metadata[tag[len(ATOM):]] = child.text or ''
+        elif tag == ATOM + 'link' and child.get('rel') == 'alternate':
+            metadata['url'] = child.get('href')
+        elif tag == OPENSEARCH + 'totalResults':
+            metadata['total_results'] = child.text
+        elif tag == OPENSEARCH + 'startIndex':
+            metadata['start_index'] = child.text
+        elif tag == OPENSEARCH + 'itemsPerPage':
+            metadata['items_per_page'] = child.text
+        elif tag == YT + 'playlistId':
+            metadata['playlistId'] = child.text
+    return {'version': PLAYLIST_VERSION, 'metadata': metadata, 'entries': entries}
+
+
+class YouTubePlaylist(object):
+    """
+    A playlist built from the compact data returned by ``parse_playlist``.
+    This is what the templates see, and only its ``data`` gets cached.
+    """
+    def __init__(self, data):
+        self.data = data
+        self.metadata = data['metadata']
+        self.entries = data['entries']
+
+    @staticmethod
+    def is_current(data):
+        """
+        Is ``data`` in the layout produced by this version of ``parse_playlist``?
+        """
+        return isinstance(data, dict) and data.get('version') == PLAYLIST_VERSION
+
 
 class YouTubeBase(object):
     """
@@ -133,10 +260,57 @@ class YouTubeFeed(YouTubeBase):
         """
         Process the feed url and set the metadata and entries
         """
-        if 'gdata.youtube.com' not in self.url:
-            playlist_id = QueryDict(urlparse(self.url).query)['list']
-            self.url = "%s/%s" % (YOUTUBE_PLAYLIST_FEED_URI, playlist_id)
-        feed = self.get_service().GetYouTubeVideoFeed(uri=self.url)
-        self.metadata = self.convert_to_python(feed.__dict__)
-        self.entries = self.metadata['entry'][:]
-        del self.metadata['entry']
+        self.url = get_feed_url(self.url)
+        xml = self.get_service().Get(self.url, converter=lambda body: body)
+        self.playlist = YouTubePlaylist(parse_playlist(xml))
+        self.metadata = self.playlist.metadata
+        self.entries = self.playlist.entries
+
+
+def get_feed_url(url):
+    """
+    Convert the URL of a playlist page into the URL of its gdata feed
+    """
+    if 'gdata.youtube.com' in url:
+        return url
+    query = QueryDict(urlparse(url).query)
+    playlist_id = query.get('list') or query['p']
+    return "%s/%s" % (YOUTUBE_PLAYLIST_FEED_URI, playlist_id)
+
+
+def fetch_feed_xml(url):
+    """
+    Return the raw XML of a gdata feed
+    """
+    return YouTubeBase().get_service().Get(url, converter=lambda body: body)
+
+
+def is_youtube_url(url):
+    """
+    Can this url be handled as a YouTube feed?
+    """
+    return 'youtube' in (urlparse(url).hostname or '')
+
+
+def feed_cache_key(url):
+    """
+    The cache key of the compact playlist for a feed url
+    """
+    return "get_youtube_feed.%s.%s" % (PLAYLIST_VERSION, md5(smart_str(url)).hexdigest())
+
+
+def fetch_playlist_data(url):
+    return YouTubeFeed(url).playlist.data
+
+
+def get_cached_playlist(url, background=True):
+    """
+    Return the ``YouTubePlaylist`` for a feed url from the cache, refreshing
+    it when it is stale. Returns ``None`` if it has never been fetched.
+    """
+    data = get_or_refresh(feed_cache_key(url),
+                          lambda: fetch_playlist_data(url),
+                          background=background)
+    if YouTubePlaylist.is_current(data):
+        return YouTubePlaylist(data)
+    return None
@@ -0,0 +1,159 @@
+"""
+Copy the videos of a YouTube playlist into local ``Embed`` objects related to
+the playlist's ``Collection``, so playlist pages can be built from the
+database instead of the YouTube API.
+"""
+from multiprocessing.pool import ThreadPool
+from urllib import urlencode
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.db import transaction
+
+from massmedia.fields import Metadata
+from massmedia.models import CollectionRelation, Embed
+from massmedia.youtube import fetch_feed_xml, get_feed_url, parse_playlist
+
+PAGE_SIZE = 50  # The most entries the API returns per page
+SYNC_CACHE_LENGTH = 7 * 24 * 3600
+
+
+def youtube_slug(video_id):
+    """
+    The slug of the ``Embed`` made for a YouTube video id
+    """
+    return 'youtube-%s' % video_id
+
+
+def page_url(url, start, page_size=PAGE_SIZE):
+    separator = '&' if '?' in url else '?'
+    return '%s%s%s' % (url, separator, urlencode([
+        ('start-index', start), ('max-results', page_size)]))
+
+
+class PlaylistSync(object):
+    """
+    Synchronize the playlist in a collection's ``external_url``.
+
+    All pages after the first are fetched concurrently. Each video becomes an
+    ``Embed`` with the slug ``youtube-<video id>``; its feed ``updated``
+    timestamp is kept in the metadata, so a video is only saved again when
+    it has changed on YouTube. The collection's relations are reordered to
+    match the playlist, and relations to videos that left it are removed.
+    """
+    def __init__(self, collection, workers=4, page_size=PAGE_SIZE):
+        self.collection = collection
+        self.url = get_feed_url(collection.external_url)
+        self.workers = workers
+        self.page_size = page_size
+
+    def fetch_page(self, start):
+        """
+        Return the compact data of the page of the feed starting at ``start``
+        """
+        return parse_playlist(fetch_feed_xml(page_url(self.url, start, self.page_size)))
+
+    def fetch_entries(self, first_page):
+        """
+        Return the entries of every page, in playlist order
+        """
+        total = int(first_page['metadata'].get('total_results') or 0)
+        starts = range(1 + self.page_size, total + 1, self.page_size)
+        entries = list(first_page['entries'])
+        if starts:
+            pool = ThreadPool(min(self.workers, len(starts)))
+            try:
+                for page in pool.map(self.fetch_page, starts):
+                    entries.extend(page['entries'])
+            finally:
+                pool.close()
+        return entries
+
+    @property
+    def sync_key(self):
+        return 'massmedia.youtube_sync.%s' % self.collection.pk
+
+    def sync(self, force=False):
+        """
+        Bring the collection up to date with the playlist. Unless ``force``
+        is set, nothing is done when the playlist's ``updated`` timestamp is
+        the same as at the last sync.
+
+        Returns a dictionary with the counts of ``created``, ``updated``,
+        ``unchanged`` and ``removed`` videos.
+        """
+        stats = dict(created=0, updated=0, unchanged=0, removed=0)
+        first_page = self.fetch_page(1)
+        playlist_updated = first_page['metadata'].get('updated')
+        if not force and playlist_updated and cache.get(self.sync_key) == playlist_updated:
+            return stats
+
+        entries = [e for e in self.fetch_entries(first_page) if e.get('id')]
+        with transaction.atomic():
+            embeds = self.update_embeds(entries, stats)
+            self.update_relations(embeds, stats)
+        cache.set(self.sync_key, playlist_updated, SYNC_CACHE_LENGTH)
+        return stats
+
+    def update_embeds(self, entries, stats):
+        """
+        Create or update an ``Embed`` for each entry, returning them in order
+        """
+        slugs = [youtube_slug(e['id']) for e in entries]
+        # slug is unique across the sites, not only the current one
+        existing = dict((e.slug, e) for e in Embed._base_manager.filter(slug__in=slugs))
+        embeds = []
+        for slug, entry in zip(slugs, entries):
+            embed = existing.get(slug)
+            if embed is None:
+                embed = Embed(slug=slug)
+                stats['created'] += 1
+            elif (isinstance(embed.metadata, Metadata) and
+                  embed.metadata['updated'] == entry.get('updated')):
+                stats['unchanged'] += 1
+                embeds.append(embed)
+                continue
+            else:
+                stats['updated'] += 1
+            self.copy_entry(entry, embed)
+            embed.save()
+            existing[slug] = embed
+            embeds.append(embed)
+        return embeds
+
+    def copy_entry(self, entry, embed):
+        media = entry.get('media', {})
+        content = media.get('content') or [{}]
+        thumbnails = media.get('thumbnail') or [{}]
+        thumbnail = max(thumbnails, key=lambda t: int(t.get('width') or 0) * int(t.get('height') or 0))
+        embed.title = (entry.get('title') or embed.slug)[:255]
+        embed.caption = entry.get('description', '')
+        embed.external_url = content[0].get('url') or entry.get('url')
+        embed.mime_type = content[0].get('type')
+        embed.metadata = Metadata({
+            'youtube_id': entry['id'],
+            'updated': entry.get('updated'),
+            'published': entry.get('published'),
+            'duration': media.get('duration'),
+            'keywords': media.get('keywords', ''),
+            'player': media.get('player'),
+            'thumbnail': thumbnail.get('url'),
+            'url': entry.get('url'),
+        })
+
+    def update_relations(self, embeds, stats):
+        ctype = ContentType.objects.get_for_model(Embed)
+        relations = dict((r.object_id, r) for r in CollectionRelation.objects.filter(
+            collection=self.collection, content_type=ctype))
+        for position, embed in enumerate(embeds):
+            relation = relations.pop(embed.pk, None)
+            if relation is None:
+                CollectionRelation.objects.create(collection=self.collection,
+                    content_type=ctype, object_id=embed.pk, position=position)
+            elif relation.position != position:
+                relation.position = position
+                relation.save()
+        if relations:
+            stats['removed'] = len(relations)
+            CollectionRelation.objects.filter(
+                pk__in=[r.pk for r in relations.values()]).delete()
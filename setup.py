@@ -26,6 +26,7 @@ setup(
         'templates/*/*.html',
         'templates/*/*/*.html',
         'templates/*/*/*/*.html',
+        'fixtures/*',
         ]},
     include_package_data=True,
     install_requires = reqs,